@@ -1,60 +1,215 @@
+import time
+_module_started_at = time.perf_counter()
+
 import logging
 
 import azure.functions as func
 
-from azure_monitor import AzureMonitorSpanExporter
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchExportSpanProcessor
-from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-
 import os
+import importlib
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine
-import urllib
 
-from .business_layer_adls import BusinessLayer
+from . import telemetry
+from .budget import get_time_budget_seconds
 
-trace.set_tracer_provider(TracerProvider())
-tracer = trace.get_tracer(__name__)
+# GENERATOR_BACKEND picks the layer, only its dependencies get imported
+backend_modules = {
+    "adls": ".business_layer_adls",
+    "stg": ".business_layer_stg",
+    "sql": ".business_layer",
+    # one generation run written to every sink in GENERATOR_SINKS
+    "fanout": ".fanout"
+}
+
+startup_timings = {}
+_tracer = None
+_business_layer = None
+_engine = None
+_ip_address = None
+
+
+@contextmanager
+def timed(name):
+    _started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round(time.perf_counter() - _started_at, 4)
 
-instrumentation_key = os.environ["APPINSIGHTS_INSTRUMENTATIONKEY"]
 
-# SpanExporter receives the spans and send them to the target location
-exporter = AzureMonitorSpanExporter(connection_string='InstrumentationKey=' +
-                                    instrumentation_key, )
+def get_backend():
+    return os.environ.get("GENERATOR_BACKEND", "adls")
+
+
+def get_pooled_connection():
+    # the adls layer uploads a tick's minutes concurrently when set
+    return os.environ.get("GENERATOR_POOLED_CONNECTION",
+                          "").lower() in ("1", "true")
 
-span_processor = BatchExportSpanProcessor(exporter)
-trace.get_tracer_provider().add_span_processor(span_processor)
 
-# connection_string = os.environ["SQL_CONNECTION_STRING"]
+def get_max_in_flight():
+    # uploads in flight at once, also the size of the connection pool
+    return int(os.environ.get("GENERATOR_MAX_IN_FLIGHT", "10"))
 
-# params = urllib.parse.quote_plus(
-#     connection_string)  # urllib.parse.quote_plus for python 3
 
-# conn_str = 'mssql+pyodbc:///?odbc_connect={}'.format(params)
-# engine = create_engine(conn_str, echo=True)
+def get_pipelined():
+    # the stg layer serializes on this thread and uploads on others
+    return os.environ.get("GENERATOR_PIPELINED", "").lower() in ("1", "true")
 
-# SQLAlchemyInstrumentor().instrument(
-#     engine=engine,
-#     service="GenerateTimeSeriesData",
-# )
 
-def log_ip():
-    import requests
-    import json 
-    response = requests.get("https://api.ipify.org?format=json")
-    obj = response.json()
-    logging.info("IP Address is: %s" % obj['ip'])
+def get_queue_depth():
+    return int(os.environ.get("GENERATOR_QUEUE_DEPTH", "20"))
+
+
+def get_output_settings():
+    # "json", "hourly" or "daily", and the record encoding of json files
+    return {
+        "output_mode": os.environ.get("GENERATOR_OUTPUT_MODE", "json"),
+        "record_encoding": os.environ.get("GENERATOR_RECORD_ENCODING",
+                                          "json")
+    }
+
+
+def get_tracer():
+    global _tracer
+    if _tracer is None:
+        with timed("tracer_seconds"):
+            from azure_monitor import AzureMonitorSpanExporter
+            from opentelemetry import trace
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchExportSpanProcessor
+
+            trace.set_tracer_provider(TracerProvider())
+            instrumentation_key = os.environ["APPINSIGHTS_INSTRUMENTATIONKEY"]
+
+            # SpanExporter receives the spans and send them to the target location
+            exporter = AzureMonitorSpanExporter(
+                connection_string='InstrumentationKey=' +
+                instrumentation_key, )
+
+            span_processor = BatchExportSpanProcessor(exporter)
+            trace.get_tracer_provider().add_span_processor(span_processor)
+            _tracer = trace.get_tracer(__name__)
+            start_metrics_export(instrument_key=instrumentation_key)
+    return _tracer
+
+
+def start_metrics_export(instrument_key):
+    # the per-stage counters and latencies in telemetry.metrics
+    try:
+        from azure_monitor import AzureMonitorMetricsExporter
+        from opentelemetry import metrics
+        from opentelemetry.sdk.metrics import MeterProvider
+    except ImportError as error:
+        logging.warning("metrics export disabled: %s" % str(error))
+        return
+    metrics.set_meter_provider(MeterProvider())
+    exporter = AzureMonitorMetricsExporter(
+        connection_string='InstrumentationKey=' + instrument_key)
+    metrics.get_meter_provider().start_pipeline(
+        telemetry.get_meter(), exporter,
+        int(os.environ.get("METRICS_EXPORT_INTERVAL_SECONDS", "60")))
 
-def main(mytimer: func.TimerRequest) -> None:    
-    
-    utc_timestamp = datetime.utcnow()    
 
-    with tracer.start_as_current_span('BusinessLayer.run'):
+def get_business_layer():
+    global _business_layer
+    if _business_layer is None:
+        with timed("backend_import_seconds"):
+            module = importlib.import_module(backend_modules[get_backend()],
+                                             __name__)
+        _business_layer = module.BusinessLayer
+    return _business_layer
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with timed("engine_seconds"):
+            import urllib
+            from sqlalchemy import create_engine
+            from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
+
+            connection_string = os.environ["SQL_CONNECTION_STRING"]
+
+            params = urllib.parse.quote_plus(
+                connection_string)  # urllib.parse.quote_plus for python 3
+
+            conn_str = 'mssql+pyodbc:///?odbc_connect={}'.format(params)
+            _engine = create_engine(conn_str, echo=True, fast_executemany=True)
+
+            SQLAlchemyInstrumentor().instrument(
+                engine=_engine,
+                service="GenerateTimeSeriesData",
+            )
+    return _engine
+
+
+def log_ip():
+    # opt-in, and looked up once per worker rather than on every tick
+    global _ip_address
+    if os.environ.get("LOG_IP_ADDRESS", "").lower() not in ("1", "true"):
+        return
+    if _ip_address is None:
+        import requests
+        response = requests.get("https://api.ipify.org?format=json",
+                                timeout=5)
+        _ip_address = response.json()['ip']
+    logging.info("IP Address is: %s" % _ip_address)
+
+
+def run_business_layer(utc_timestamp):
+    BusinessLayer = get_business_layer()
+    if get_backend() == "sql":
+        return BusinessLayer.run(get_engine(),
+                                 utc_timestamp,
+                                 enable_anomaly=False,
+                                 bulk_insert=True,
+                                 time_budget_seconds=get_time_budget_seconds())
+    if get_backend() == "fanout":
+        _sink_names = BusinessLayer.get_sink_names()
+        return BusinessLayer.run(
+            utc_timestamp,
+            enable_anomaly=False,
+            sink_names=_sink_names,
+            engine=get_engine() if "sql" in _sink_names else None,
+            time_budget_seconds=get_time_budget_seconds(),
+            max_in_flight=get_max_in_flight(),
+            **get_output_settings())
+    if get_backend() == "adls":
+        return BusinessLayer.run(utc_timestamp,
+                                 enable_anomaly=False,
+                                 pooled_connection=get_pooled_connection(),
+                                 max_in_flight=get_max_in_flight(),
+                                 time_budget_seconds=get_time_budget_seconds(),
+                                 **get_output_settings())
+    return BusinessLayer.run(utc_timestamp,
+                             enable_anomaly=False,
+                             pipelined=get_pipelined(),
+                             queue_depth=get_queue_depth(),
+                             max_in_flight=get_max_in_flight(),
+                             time_budget_seconds=get_time_budget_seconds(),
+                             **get_output_settings())
+
+
+def main(mytimer: func.TimerRequest) -> None:
+
+    utc_timestamp = datetime.utcnow()
+    _first_invocation = "first_invocation_seconds" not in startup_timings
+    _started_at = time.perf_counter()
+
+    with get_tracer().start_as_current_span('BusinessLayer.run'):
         log_ip()
-        # BusinessLayer.run(engine, utc_timestamp, enable_anomaly=False)
-        BusinessLayer.run(utc_timestamp, enable_anomaly=False)
+        run_business_layer(utc_timestamp)
+
+    if _first_invocation:
+        startup_timings["first_invocation_seconds"] = round(
+            time.perf_counter() - _started_at, 4)
+        logging.info("Startup timings: %s" % str(startup_timings))
 
     logging.info('Version: 1.6 - Python timer trigger function ran at %s',
                  utc_timestamp.isoformat())
+
+
+startup_timings["module_import_seconds"] = round(
+    time.perf_counter() - _module_started_at, 4)
@@ -0,0 +1,199 @@
+import importlib
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from .columnar import partitions
+from .registry import get_registry
+from .signals import models, path_dependent_models
+from .telemetry import metrics
+from .uploader import ConcurrentUploader
+from .value_generator import pending_minutes, step, to_epoch_minutes
+
+# one day per shard keeps hourly and daily partitions inside one worker
+default_shard_minutes = 24 * 60
+
+# the business layer of this worker process, with its own storage client
+_worker_layer = None
+
+
+def get_worker_layer(layer_module, layer_kwargs):
+    global _worker_layer
+    if _worker_layer is None:
+        module = importlib.import_module(layer_module)
+        _worker_layer = module.BusinessLayer(**layer_kwargs)
+    return _worker_layer
+
+
+def get_shards(last_record_time, minutes, shard_minutes):
+    # (last timestamp before the shard, minutes in it); boundaries sit on
+    # multiples of shard_minutes since the epoch, so a partition never
+    # straddles two shards
+    shards = []
+    _first_minute = to_epoch_minutes(last_record_time) + 1
+    _done = 0
+    while _done < minutes:
+        _length = min(shard_minutes - (_first_minute + _done) % shard_minutes,
+                      minutes - _done)
+        shards.append((last_record_time + step * _done, _length))
+        _done = _done + _length
+    return shards
+
+
+def check_shard_minutes(shard_minutes, output_mode):
+    if output_mode in partitions:
+        _partition_minutes = int(partitions[output_mode]["length"] / step)
+        if shard_minutes % _partition_minutes != 0:
+            raise ValueError("shard_minutes must be a multiple of %s for %s "
+                             "partitions" % (_partition_minutes, output_mode))
+
+
+def get_path_dependent_columns(equipment_tags):
+    registry = get_registry()
+    _models = np.array(models)[registry.model_ids[registry.get_ids(
+        equipment_tags)]]
+    return np.flatnonzero(np.isin(_models, path_dependent_models))
+
+
+def run_shard(layer_module, layer_kwargs, index, last_record_time, minutes,
+              previous_records, chunk_minutes, max_in_flight):
+    bl = get_worker_layer(layer_module, layer_kwargs)
+    bl.current_datetime = last_record_time + step * (minutes + 1)
+    _counters_before = metrics.snapshot()["counters"]
+    _last_records = previous_records
+    if bl.dal.columnar_buffer is None:
+        with ConcurrentUploader(bl.dal.write_records,
+                                max_in_flight) as uploader:
+            for records_to_write in bl.iter_records_to_write(
+                    last_record_time, previous_records, chunk_minutes):
+                for x in records_to_write:
+                    uploader.submit(x)
+            _last_records = uploader.flush()['records']
+    else:
+        for records_to_write in bl.iter_records_to_write(
+                last_record_time, previous_records, chunk_minutes):
+            for x in records_to_write:
+                bl.dal.write_records(x['new_timestamp'], x['records'])
+            _last_records = records_to_write[-1]['records']
+        bl.dal.flush_records()
+    _counters = metrics.snapshot()["counters"]
+    return index, last_record_time + step * minutes, _last_records, {
+        _name: _value - _counters_before.get(_name, 0)
+        for _name, _value in _counters.items()
+    }
+
+
+class Backfill():
+    def __init__(self,
+                 bl,
+                 layer_kwargs,
+                 workers=None,
+                 shard_minutes=default_shard_minutes,
+                 chunk_minutes=60,
+                 max_in_flight=10):
+        # bl is the coordinator's business layer, every worker builds its
+        # own from layer_kwargs
+        check_shard_minutes(shard_minutes, layer_kwargs.get("output_mode"))
+        self.bl = bl
+        self.layer_module = type(bl).__module__
+        self.layer_kwargs = layer_kwargs
+        self.workers = workers or os.cpu_count()
+        self.shard_minutes = shard_minutes
+        self.chunk_minutes = chunk_minutes
+        self.max_in_flight = max_in_flight
+
+    def iter_shard_starts(self, last_record_time, previous_records, shards):
+        # every model but uniform needs the value before each shard, so
+        # those tags alone are walked through serially; uniform tags only
+        # depend on the minute
+        _columns = get_path_dependent_columns(
+            [_record.equipment_tag for _record in previous_records])
+        _walker = self.bl.get_value_generator(
+            [previous_records[_column] for _column in _columns])
+        _row = np.full(len(previous_records), np.nan)
+        for _index, (_last_timestamp, _minutes) in enumerate(shards):
+            if _index == 0:
+                yield previous_records
+            else:
+                yield self.bl.create_next_records(previous_records,
+                                                  _last_timestamp, _row)
+            if len(_columns) > 0:
+                for _values in _walker.iter_values(_minutes,
+                                                   self.chunk_minutes):
+                    pass
+                _row[_columns] = _values[-1]
+
+    def run(self, end_datetime):
+        _last_record_time, _previous_records = self.bl.dal.get_last_records()
+        self.last_record_time = _last_record_time
+        _minutes = pending_minutes(_last_record_time, end_datetime)
+        shards = get_shards(_last_record_time, _minutes, self.shard_minutes)
+        self.bl.logme("\nBackfilling %s minute(s) in %s shard(s)" %
+                      (str(_minutes), str(len(shards))))
+        _shard_starts = self.iter_shard_starts(_last_record_time,
+                                               _previous_records, shards)
+        _finished = {}
+        _next_index = 0
+        _written_minutes = 0
+        _pending = set()
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        _limit = 2 * self.workers
+        try:
+            for _index, (_last_timestamp, _shard_minutes) in enumerate(shards):
+                while len(_pending) >= _limit:
+                    _done, _pending = wait(_pending,
+                                           return_when=FIRST_COMPLETED)
+                    self.collect(_done, _finished)
+                    _next_index, _written_minutes = self.advance(
+                        _finished, _next_index, _written_minutes)
+                _pending.add(
+                    executor.submit(run_shard, self.layer_module,
+                                    self.layer_kwargs, _index,
+                                    _last_timestamp, _shard_minutes,
+                                    next(_shard_starts), self.chunk_minutes,
+                                    self.max_in_flight))
+            while len(_pending) > 0:
+                _done, _pending = wait(_pending, return_when=FIRST_COMPLETED)
+                self.collect(_done, _finished)
+                _next_index, _written_minutes = self.advance(
+                    _finished, _next_index, _written_minutes)
+        finally:
+            # after a failure the shards already running are let finish,
+            # and the watermark still moves over every unbroken prefix
+            for future in _pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.collect([
+                future for future in _pending
+                if future.done() and not future.cancelled()
+            ], _finished, raise_error=False)
+            self.advance(_finished, _next_index, _written_minutes)
+        return _minutes, _written_minutes
+
+    def collect(self, done, finished, raise_error=True):
+        # every finished shard is recorded before a failed one is raised
+        _error = None
+        for future in done:
+            if future.exception() is not None:
+                _error = _error or future.exception()
+                continue
+            _index, _last_timestamp, _records, _counters = future.result()
+            finished[_index] = (_last_timestamp, _records)
+            for _name, _value in _counters.items():
+                metrics.add(_name, _value)
+        if _error is not None and raise_error:
+            raise _error
+
+    def advance(self, finished, next_index, written_minutes):
+        _advanced = None
+        while next_index in finished:
+            _advanced = finished.pop(next_index)
+            next_index = next_index + 1
+        if _advanced is not None:
+            self.bl.dal.write_last_records(*_advanced)
+            written_minutes = int(
+                (_advanced[0] - self.last_record_time) / step)
+            logging.info("backfill watermark at %s" % str(_advanced[0]))
+        return next_index, written_minutes
@@ -0,0 +1,180 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+from .fanout import BusinessLayer
+from .sinks import LocalSink, MemorySink, default_start_timestamp
+from .signals import models
+from .telemetry import metrics
+
+# one line of json per case, appended so results of several releases can
+# be compared; backlogs count windows, which are minutes by default
+default_tag_counts = [12, 1000, 10000, 100000]
+default_backlog_windows = [1, 60, 24 * 60, 7 * 24 * 60, 365 * 24 * 60]
+
+# larger cases are reported as skipped, 100k tags over a year would be
+# 52 billion records
+default_max_records = 50000000
+
+benchmark_version = 2
+
+
+def write_registry(path, tags, model, interval):
+    # model "mixed" cycles through every signal model
+    _entries = []
+    for _index in range(tags):
+        _entries.append({
+            "tag": "tag_%06d" % _index,
+            "min": 0,
+            "max": 100,
+            "unit": "percent",
+            "group": "group_%03d" % (_index // 1000),
+            "model": models[_index % len(models)] if model == "mixed" else
+            model,
+            "interval": interval
+        })
+    with open(path, "w") as f:
+        json.dump({"tags": _entries}, f)
+
+
+def get_peak_memory():
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return _peak if sys.platform == "darwin" else _peak * 1024
+
+
+def get_environment():
+    return {
+        "benchmark_version": benchmark_version,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def run_case(tags, windows, sink_name, output_mode, record_encoding, model,
+             chunk_windows, interval, window_seconds):
+    # runs in a process of its own, so the peak memory is this case's
+    _directory = tempfile.mkdtemp(prefix="generator-benchmark-")
+    try:
+        _registry_path = os.path.join(_directory, "equipment.json")
+        write_registry(_registry_path, tags, model, interval)
+        os.environ["EQUIPMENT_REGISTRY_PATH"] = _registry_path
+        if sink_name == "local":
+            sink = LocalSink(os.path.join(_directory, "output"),
+                             output_mode=output_mode,
+                             record_encoding=record_encoding)
+        else:
+            sink = MemorySink(output_mode=output_mode,
+                              record_encoding=record_encoding,
+                              keep=False)
+        _baseline_memory = get_peak_memory()
+        _window = timedelta(seconds=window_seconds)
+        bl = BusinessLayer(default_start_timestamp + _window * (windows + 1),
+                           [sink],
+                           False,
+                           window=_window)
+        _started_at = time.perf_counter()
+        report = bl.process(chunk_windows=chunk_windows)
+        _elapsed = time.perf_counter() - _started_at
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
+    _histograms = metrics.snapshot()["histograms"]
+    return {
+        "tags": tags,
+        "backlog_windows": windows,
+        "interval_seconds": interval,
+        "window_seconds": window_seconds,
+        "sink": sink_name,
+        "output_mode": output_mode,
+        "record_encoding": record_encoding,
+        "model": model,
+        "written_windows": report["written_minutes"],
+        "records_written": report["records_written"],
+        "bytes_written": report["bytes_written"],
+        "elapsed_seconds": round(_elapsed, 6),
+        "records_per_second": round(report["records_written"] / _elapsed, 1),
+        "bytes_per_second": round(report["bytes_written"] / _elapsed, 1),
+        # above 1 the generator keeps up with the clock
+        "real_time_factor": round(
+            report["written_minutes"] * window_seconds / _elapsed, 3),
+        "baseline_memory_bytes": _baseline_memory,
+        "peak_memory_bytes": get_peak_memory(),
+        "stages": {
+            _name[:-len("_seconds")]: {
+                "count": _histogram["count"],
+                "total_seconds": _histogram["total"]
+            }
+            for _name, _histogram in sorted(_histograms.items())
+            if _name.endswith("_seconds")
+        }
+    }
+
+
+def run_suite(tag_counts=None,
+              backlog_windows=None,
+              sink_name="memory",
+              output_mode="json",
+              record_encoding="json",
+              model="uniform",
+              chunk_windows=60,
+              max_records=default_max_records,
+              output=None,
+              interval=60,
+              window_seconds=60):
+    results = []
+    _environment = get_environment()
+    _started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    for _tags in tag_counts or default_tag_counts:
+        for _windows in backlog_windows or default_backlog_windows:
+            _records = _tags * _windows * window_seconds / interval
+            if _records > max_records:
+                result = {
+                    "tags": _tags,
+                    "backlog_windows": _windows,
+                    "sink": sink_name,
+                    "skipped": "more than %s records" % str(max_records)
+                }
+            else:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_case, _tags, _windows,
+                                             sink_name, output_mode,
+                                             record_encoding, model,
+                                             chunk_windows, interval,
+                                             window_seconds).result()
+            result["started"] = _started
+            result["environment"] = _environment
+            _line = json.dumps(result, sort_keys=True)
+            print(_line)
+            if output is not None:
+                with open(output, "a") as f:
+                    f.write(_line + "\n")
+            results.append(result)
+    return results
+
+
+def parse_counts(value):
+    return [int(_count) for _count in value.split(",")]
+
+
+if __name__ == "__main__":
+    # benchmark [tags,..] [windows,..] [memory|local] [output file]
+    #           [interval seconds] [window seconds]
+    run_suite(
+        tag_counts=parse_counts(sys.argv[1]) if len(sys.argv) > 1 else None,
+        backlog_windows=parse_counts(sys.argv[2])
+        if len(sys.argv) > 2 else None,
+        sink_name=sys.argv[3] if len(sys.argv) > 3 else "memory",
+        output=sys.argv[4] if len(sys.argv) > 4 else None,
+        interval=float(sys.argv[5]) if len(sys.argv) > 5 else 60,
+        window_seconds=float(sys.argv[6]) if len(sys.argv) > 6 else 60)
@@ -0,0 +1,84 @@
+import json
+import os
+import time
+
+# the consumption plan kills a function after five minutes unless
+# host.json says otherwise
+default_function_timeout = 300
+
+# share of the host timeout spent generating, the rest is left for the
+# final flush, checkpoint and lease release
+budget_fraction = 0.8
+
+host_json_path = os.path.join(os.path.dirname(__file__), "..", "host.json")
+
+
+def parse_timeout(value):
+    # host.json uses hh:mm:ss, "-1" means no limit
+    if value.strip() == "-1":
+        return None
+    _seconds = 0
+    for part in value.split(":"):
+        _seconds = _seconds * 60 + float(part)
+    return _seconds
+
+
+def get_function_timeout(path=host_json_path):
+    try:
+        with open(path) as host_json:
+            obj = json.load(host_json)
+    except (IOError, ValueError):
+        return default_function_timeout
+    if "functionTimeout" not in obj:
+        return default_function_timeout
+    return parse_timeout(obj["functionTimeout"])
+
+
+def get_time_budget_seconds():
+    # GENERATOR_TIME_BUDGET_SECONDS wins over the host timeout
+    if os.environ.get("GENERATOR_TIME_BUDGET_SECONDS"):
+        return float(os.environ["GENERATOR_TIME_BUDGET_SECONDS"])
+    _timeout = get_function_timeout()
+    if _timeout is None:
+        return None
+    return _timeout * budget_fraction
+
+
+class TimeBudget():
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started_at = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def is_exhausted(self):
+        return self.seconds is not None and self.elapsed() >= self.seconds
+
+
+def get_progress_report(backlog_minutes, written_minutes, elapsed_seconds,
+                        budget_seconds):
+    _remaining_minutes = backlog_minutes - written_minutes
+    report = {
+        "backlog_minutes": backlog_minutes,
+        "written_minutes": written_minutes,
+        "remaining_minutes": _remaining_minutes,
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "minutes_per_second": None,
+        "estimated_catch_up_seconds": None,
+        "estimated_catch_up_invocations": None
+    }
+    if written_minutes > 0 and elapsed_seconds > 0:
+        _rate = written_minutes / elapsed_seconds
+        report["minutes_per_second"] = round(_rate, 3)
+        report["estimated_catch_up_seconds"] = round(
+            _remaining_minutes / _rate, 1)
+        if budget_seconds:
+            # every later tick also brings one new minute
+            _per_invocation = _rate * budget_seconds - 1
+            if _remaining_minutes <= 0:
+                report["estimated_catch_up_invocations"] = 0
+            elif _per_invocation > 0:
+                report["estimated_catch_up_invocations"] = int(
+                    -(-_remaining_minutes // _per_invocation))
+    return report
@@ -1,16 +1,21 @@
 import os
+import sys
 import urllib
-import random
 from datetime import datetime, timedelta
 import logging
 import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import types, case, inspect
-from sqlalchemy.sql import expression, select, literal_column
+from sqlalchemy.sql import expression, select, literal_column, bindparam
 from sqlalchemy import Column, Integer, String, DateTime, Float
 from sqlalchemy.orm import sessionmaker
 
+from .registry import check_minute_intervals, join_registry
+from .value_generator import ValueGenerator, get_timestamps, pending_minutes
+from .budget import TimeBudget
+from .telemetry import get_summary, metrics, stage, staged
+
 Base = declarative_base()
 
 datetime_format = "%Y-%m-%dT%H:%M:00Z"
@@ -28,6 +33,18 @@ class SensorReading(Base):
             self.timestamp, self.equipment_tag, self.value)
 
 
+class SensorWatermark(Base):
+    __tablename__ = 'sensor_watermark'
+
+    equipment_tag = Column(String, primary_key=True)
+    timestamp = Column(DateTime)
+    value = Column(Float)
+
+    def __repr__(self):
+        return "<sensor_watermark(equipment_tag='%s', timestamp='%s', value='%s')>" % (
+            self.equipment_tag, self.timestamp, self.value)
+
+
 class BaseLayer():
     def __init__(self, args):
         pass
@@ -37,17 +54,19 @@ class BaseLayer():
 
 
 class DataAccessLayer(BaseLayer):
-    def __init__(self, engine):
+    def __init__(self, engine, batch_size=1000, commit_batches=10):
         Session = sessionmaker(bind=engine)
         self.session = Session()
+        self.batch_size = batch_size
+        self.commit_batches = commit_batches
+        self.watermark_tags = None
 
     def create_table(self, engine):
         Base.metadata.create_all(engine)
 
     def add_sensor_reading(self, sensor_reading):
         self.session.add(sensor_reading)
-        self.logme("added record for timestamp: %s" %
-                   str(sensor_reading.timestamp))
+        metrics.add("records_written")
 
     def add_record(self, timestamp, equipment_tag, value):
         sensor_reading = SensorReading(timestamp=timestamp,
@@ -55,12 +74,112 @@ class DataAccessLayer(BaseLayer):
                                        value=value)
         self.add_sensor_reading(sensor_reading)
 
+    def insert_batch(self, rows):
+        # one executemany through Core, bypassing the ORM unit of work
+        with stage("upload", records=len(rows)):
+            self.session.execute(SensorReading.__table__.insert(), rows)
+        metrics.add("records_written", len(rows))
+        metrics.add("uploads")
+        _last_rows = {}
+        for row in rows:
+            _last_row = _last_rows.get(row["equipment_tag"])
+            if _last_row is None or row["timestamp"] > _last_row["timestamp"]:
+                _last_rows[row["equipment_tag"]] = row
+        with stage("watermark"):
+            self.update_watermarks(_last_rows.values())
+
+    def update_watermarks(self, rows):
+        # called before the commit that persists the rows, so readings and
+        # watermark always land in the same transaction
+        if self.watermark_tags is None:
+            self.watermark_tags = set(
+                _row.equipment_tag for _row in self.session.query(
+                    SensorWatermark.equipment_tag).all())
+        table = SensorWatermark.__table__
+        _updates = []
+        _inserts = []
+        for row in rows:
+            if row["equipment_tag"] in self.watermark_tags:
+                _updates.append({
+                    "_equipment_tag": row["equipment_tag"],
+                    "_timestamp": row["timestamp"],
+                    "_value": row["value"]
+                })
+            else:
+                _inserts.append({
+                    "equipment_tag": row["equipment_tag"],
+                    "timestamp": row["timestamp"],
+                    "value": row["value"]
+                })
+        if len(_updates) > 0:
+            self.session.execute(
+                table.update().where(
+                    table.c.equipment_tag == bindparam("_equipment_tag")).values(
+                        timestamp=bindparam("_timestamp"),
+                        value=bindparam("_value")), _updates)
+        if len(_inserts) > 0:
+            self.session.execute(table.insert(), _inserts)
+            self.watermark_tags.update(_row["equipment_tag"] for _row in _inserts)
+
+    def rebuild_watermarks(self):
+        reading = SensorReading.__table__
+        watermark = SensorWatermark.__table__
+        last_reading = select([
+            reading.c.equipment_tag,
+            sqlalchemy.func.max(reading.c.timestamp).label("timestamp")
+        ]).group_by(reading.c.equipment_tag).alias("last_reading")
+        last_rows = select([
+            reading.c.equipment_tag, reading.c.timestamp, reading.c.value
+        ]).select_from(
+            reading.join(
+                last_reading,
+                sqlalchemy.and_(
+                    reading.c.equipment_tag == last_reading.c.equipment_tag,
+                    reading.c.timestamp == last_reading.c.timestamp)))
+        self.session.execute(watermark.delete())
+        self.session.execute(
+            watermark.insert().from_select(
+                ["equipment_tag", "timestamp", "value"], last_rows))
+        self.commit()
+        self.watermark_tags = None
+        self.logme("watermark rebuilt for %s tag(s)" %
+                   str(self.session.query(SensorWatermark).count()))
+
+    def bulk_insert(self, rows):
+        _count = 0
+        _batches = 0
+        _batch = []
+        for row in rows:
+            _batch.append(row)
+            if len(_batch) >= self.batch_size:
+                self.insert_batch(_batch)
+                _count = _count + len(_batch)
+                _batches = _batches + 1
+                _batch = []
+                if _batches % self.commit_batches == 0:
+                    self.commit()
+                    self.logme("committed %s record(s) up to timestamp: %s" %
+                               (str(_count), str(row["timestamp"])))
+        if len(_batch) > 0:
+            self.insert_batch(_batch)
+            _count = _count + len(_batch)
+        self.commit()
+        self.logme("bulk inserted %s record(s)" % str(_count))
+        return _count
+
     def query_record(self, timestamp):
         sensor_readings = self.session.query(SensorReading).filter(
             SensorReading.timestamp.in_([timestamp])).all()
         self.logme("Query returned %s record(s)" % str(len(sensor_readings)))
         return sensor_readings
 
+    def get_values_at(self, timestamp):
+        # the reading of every tag that has one at timestamp
+        _rows = self.session.query(
+            SensorReading.equipment_tag, SensorReading.value).filter(
+                SensorReading.timestamp == timestamp).all()
+        return {_row.equipment_tag: _row.value for _row in _rows}
+
     def delete_record(self, sensor_readings):
         for sensor_reading in sensor_readings:
             self.session.delete(sensor_reading)
@@ -81,8 +200,32 @@ class DataAccessLayer(BaseLayer):
 
     def rollback(self):
         self.session.rollback()
+        self.watermark_tags = None
 
+    @staged("get_last_records")
     def get_last_records(self):
+        last_record_query = self.session.query(
+            SensorWatermark.timestamp, SensorWatermark.equipment_tag,
+            SensorWatermark.value).order_by(
+                SensorWatermark.equipment_tag.asc())
+        _last_records = last_record_query.all()
+        if len(_last_records) == 0:
+            # nothing seeded yet, see rebuild_watermarks
+            self.logme("sensor_watermark is empty, scanning sensor_reading_2")
+            _last_records = self.scan_last_records()
+        return self.join_registry(_last_records)
+
+    def join_registry(self, last_records):
+        # tags new to the config start from the latest watermark, or two
+        # whole minutes back on an empty database
+        _start_timestamp = max(
+            [_record.timestamp for _record in last_records],
+            default=datetime.utcnow().replace(second=0, microsecond=0) -
+            timedelta(minutes=2))
+        return join_registry(_start_timestamp, last_records,
+                             record_class=SensorWatermark)
+
+    def scan_last_records(self):
         last_record_query = self.session.query(
             sqlalchemy.func.max(SensorReading.timestamp).label("timestamp"),
             SensorReading.equipment_tag).group_by(
@@ -95,112 +238,141 @@ class DataAccessLayer(BaseLayer):
 
 
 class BusinessLayer(BaseLayer):
-    def __init__(self, current_datetime, engine, enable_anomaly):
-        self.dal = DataAccessLayer(engine)
+    def __init__(self,
+                 current_datetime,
+                 engine,
+                 enable_anomaly,
+                 batch_size=1000,
+                 commit_batches=10):
+        self.dal = DataAccessLayer(engine,
+                                   batch_size=batch_size,
+                                   commit_batches=commit_batches)
         self.current_datetime = current_datetime
         self.enable_anomaly = enable_anomaly
 
-    def get_value(self, previous_record):
-        equipment_list = {
-            "turbine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "turbine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "turbine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "booster_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "booster_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "booster_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "engine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "engine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "engine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "main_valve_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "main_valve_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "main_valve_pressure": {
-                "min": 12,
-                "max": 16
-            }
-        }
-        start = equipment_list[previous_record.equipment_tag]["min"]
-        end = equipment_list[previous_record.equipment_tag]["max"]
-        x = round(random.uniform(start, end), 2)
-        if self.enable_anomaly:
-            anomaly = random.uniform(-1, 1)
-            if anomaly > 0:
-                x = round(end * anomaly, 2)
-            elif anomaly < 0:
-                x = round(start * -1 * anomaly, 2)
-        return x
-
-    def create_next_record(self, previous_record):
-        new_timestamp = previous_record.timestamp + timedelta(seconds=60)
-        _time_difference = self.current_datetime - new_timestamp
-        _next_record = None
-        if _time_difference.days > -1 and _time_difference.seconds > 0:
+    def get_value_generator(self, previous_records):
+        check_minute_intervals(
+            [_record.equipment_tag for _record in previous_records])
+        # the group-by fallback has no values, those tags start afresh
+        return ValueGenerator(
+            [_record.equipment_tag for _record in previous_records],
+            self.enable_anomaly,
+            previous_values=[
+                getattr(_record, "value", None) for _record in previous_records
+            ],
+            last_timestamps=[
+                _record.timestamp for _record in previous_records
+            ])
+
+    def get_row_timestamps(self, timestamps, last_timestamp, first, count):
+        # tags that share a watermark share one list of row timestamps
+        _row_timestamps = timestamps.get(last_timestamp)
+        if _row_timestamps is None:
+            _row_timestamps = get_timestamps(last_timestamp, first, count)
+            timestamps[last_timestamp] = _row_timestamps
+        return _row_timestamps
+
+    def create_next_records(self, previous_record, values, timestamps):
+        _next_records = []
+        for new_timestamp, _value in zip(timestamps, values.tolist()):
             _next_record = SensorReading(
                 timestamp=new_timestamp,
                 equipment_tag=previous_record.equipment_tag,
-                value=self.get_value(previous_record))
+                value=_value)
             self.dal.add_sensor_reading(_next_record)
-        return _next_record
-
-    def create_next_records(self, previous_records):
-        _next_records = []
-        for _previous_record in previous_records:
-            _next_record = self.create_next_record(_previous_record)
-            if _next_record:
-                _next_records.append(_next_record)
+            _next_records.append(_next_record)
         return _next_records
 
     def process(self):
         _all_records = []
+        _last_rows = []
         _previous_records = self.dal.get_last_records()
-        _next_records = self.create_next_records(_previous_records)
-        while (len(_next_records) > 0):
+        # tags can lag behind each other, so each one gets its own count
+        _minutes = [
+            pending_minutes(_record.timestamp, self.current_datetime)
+            for _record in _previous_records
+        ]
+        _values = self.get_value_generator(_previous_records).get_values(
+            max(_minutes, default=0))
+        _timestamps = {}
+        for _column, _previous_record in enumerate(_previous_records):
+            _next_records = self.create_next_records(
+                _previous_record, _values[:_minutes[_column], _column],
+                self.get_row_timestamps(_timestamps,
+                                        _previous_record.timestamp, 1,
+                                        len(_values)))
+            if len(_next_records) > 0:
+                _last_rows.append({
+                    "timestamp": _next_records[-1].timestamp,
+                    "equipment_tag": _next_records[-1].equipment_tag,
+                    "value": _next_records[-1].value
+                })
             _all_records = _all_records + _next_records
-            _previous_records = _next_records
-            _next_records = self.create_next_records(_previous_records)
+        with stage("watermark"):
+            self.dal.update_watermarks(_last_rows)
         return _all_records
 
+    def iter_rows(self, previous_records, chunk_minutes, time_budget=None):
+        _minutes = [
+            pending_minutes(_record.timestamp, self.current_datetime)
+            for _record in previous_records
+        ]
+        _value_generator = self.get_value_generator(previous_records)
+        _offset = 0
+        for _values in _value_generator.iter_values(max(_minutes, default=0),
+                                                    chunk_minutes):
+            # stopping between chunks keeps every tag's watermark aligned
+            if time_budget is not None and time_budget.is_exhausted():
+                return
+            _timestamps = {}
+            for _column, _previous_record in enumerate(previous_records):
+                _count = min(max(_minutes[_column] - _offset, 0), len(_values))
+                _row_timestamps = self.get_row_timestamps(
+                    _timestamps, _previous_record.timestamp, _offset + 1,
+                    len(_values))
+                for new_timestamp, _value in zip(
+                        _row_timestamps, _values[:_count, _column].tolist()):
+                    yield {
+                        "timestamp": new_timestamp,
+                        "equipment_tag": _previous_record.equipment_tag,
+                        "value": _value
+                    }
+            _offset = _offset + len(_values)
+
+    def process_bulk(self, chunk_minutes=60, time_budget=None):
+        _previous_records = self.dal.get_last_records()
+        return self.dal.bulk_insert(
+            self.iter_rows(_previous_records, chunk_minutes, time_budget))
+
+    def report_progress(self, counters_before, elapsed_seconds):
+        summary = get_summary(counters_before, elapsed_seconds)
+        if summary["records_per_second"] is not None:
+            metrics.record("records_per_second",
+                           summary["records_per_second"])
+        self.logme("wrote %(records_written)s record(s) in %(uploads)s "
+                   "batch(es), %(records_per_second)s records/s" % summary)
+        return summary
+
     @classmethod
-    def run(cls, engine, current_datetime, enable_anomaly):
+    def run(cls,
+            engine,
+            current_datetime,
+            enable_anomaly,
+            bulk_insert=False,
+            time_budget_seconds=None):
+        time_budget = TimeBudget(time_budget_seconds)
+        _counters_before = metrics.snapshot()["counters"]
         bl = BusinessLayer(current_datetime=current_datetime,
                            engine=engine,
                            enable_anomaly=enable_anomaly)
-        next_records = bl.process()
+        if bulk_insert:
+            bl.process_bulk(time_budget=time_budget)
+        else:
+            next_records = bl.process()
         # bl.logme(next_records)
         bl.dal.commit()
         bl.dal.close()
+        bl.report_progress(_counters_before, time_budget.elapsed())
 
 
 if __name__ == "__main__":
@@ -211,5 +383,13 @@ if __name__ == "__main__":
         connection_string)  # urllib.parse.quote_plus for python 3
 
     conn_str = 'mssql+pyodbc:///?odbc_connect={}'.format(params)
-    engine = create_engine(conn_str, echo=True)
-    BusinessLayer.run(engine, utc_timestamp, False)
\ No newline at end of file
+    # fast_executemany sends each bulk insert batch as one parameter array
+    engine = create_engine(conn_str, echo=True, fast_executemany=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-watermarks":
+        # one-time seeding of sensor_watermark from sensor_reading_2
+        dal = DataAccessLayer(engine)
+        dal.create_table(engine)
+        dal.rebuild_watermarks()
+        dal.close()
+    else:
+        BusinessLayer.run(engine, utc_timestamp, False, bulk_insert=True)
\ No newline at end of file
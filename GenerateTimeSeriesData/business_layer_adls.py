@@ -1,65 +1,104 @@
 import os
+import sys
 import json
-import random
 from datetime import datetime, timedelta
 import logging
-from azure.storage.filedatalake import DataLakeServiceClient
-from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.filedatalake import DataLakeServiceClient, DataLakeLeaseClient, ContentSettings
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
 
-# Base = declarative_base()
-
-datetime_format = "%Y-%m-%dT%H:%M:00Z"
-json.JSONEncoder.default = lambda self, obj: (obj.strftime(
-    datetime_format) if isinstance(obj, datetime) else None)
-
-
-class SensorReading():
-    def __init__(self, timestamp, equipment_tag, value):
-        self.timestamp = timestamp
-        self.equipment_tag = equipment_tag
-        self.value = value
+from .value_generator import pending_minutes, step
+from .serializer import (check_encoding, encodings, get_window_name,
+                         is_record_file, parse_records, serialize_records)
+from .uploader import ConcurrentUploader
+from .checkpoint import Checkpointer
+from .throttle import AdaptiveLimiter, AdaptiveUploader
+from . import metadata_cache
+from .budget import TimeBudget, get_progress_report
+from .backfill import default_shard_minutes
+from .telemetry import metrics, stage
+from .storage_layer import (ComplexEncoder, StorageBusinessLayer,
+                            StorageDataAccessLayer, datetime_format)
+from .columnar import (ColumnarBuffer, content_types, from_bytes,
+                       is_part_file, merge_columns, partition_file_name,
+                       partitions, records_to_columns, table_to_columns,
+                       to_bytes, to_table)
 
+# Base = declarative_base()
 
-class ComplexEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, SensorReading):
-            return obj.__dict__
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
-
-
-class BaseLayer():
-    def __init__(self, args):
-        pass
-
-    def logme(self, message):
-        logging.info(message)
-        print(message)
 
+class DataAccessLayer(StorageDataAccessLayer):
+    storage_name = "Azure Data Lake Store"
 
-class DataAccessLayer(BaseLayer):
-    def __init__(self):
+    def __init__(self,
+                 max_connections=10,
+                 output_mode="json",
+                 columnar_format="parquet",
+                 record_encoding="json"):
         self.file_system_name = "metadv"
+        self.max_connections = max_connections
+        # retries and the number of concurrent uploads adapt to throttling,
+        # the SDK's own retries are switched off for these calls
+        self.uploader = AdaptiveUploader(AdaptiveLimiter(max_connections))
         self.file_system_client = self.get_file_system_client()
         self.last_records_blob_name = "last-records.json"
+        self.lock_blob_name = "generator.lock"
+        # etag of the last-records.json this run resumed from, so the
+        # watermark is never overwritten behind another writer's back
+        self.last_records_etag = None
         self.anomaly_file_name = "anomaly.json"
+        # "json" writes one file per minute, "hourly" and "daily" buffer
+        # minutes into one columnar file per partition
+        self.output_mode = output_mode
+        self.columnar_format = columnar_format
+        self.columnar_buffer = None
+        check_encoding(record_encoding)
+        self.record_encoding = record_encoding
+        # one file per window of this length, see fanout
+        self.window = step
+        if output_mode != "json":
+            self.columnar_buffer = ColumnarBuffer(output_mode, columnar_format)
 
     def get_file_system_client(self):
         connect_str = os.environ["ADLS_CONNECTION_STRING"]
+        # one pooled session shared by every upload thread
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.max_connections,
+            pool_maxsize=self.max_connections)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         service_client = DataLakeServiceClient.from_connection_string(
-            connect_str)
+            connect_str, transport=RequestsTransport(session=session))
         file_system_client = service_client.get_file_system_client(
             file_system=self.file_system_name)
         return file_system_client
 
     def is_anomaly_enabled(self):
-        anomaly_status = False
+        # cached for the worker's lifetime, re-validated with the etag once
+        # the ttl runs out
+        _key = (self.file_system_name, self.anomaly_file_name)
+        anomaly_status, _etag, _fresh = metadata_cache.configs.get(_key)
+        if _fresh:
+            metrics.add("metadata_cache_hits")
+            return anomaly_status
         try:
             file_client = self.file_system_client.get_file_client(
                 self.anomaly_file_name)
-            obj = json.loads(file_client.download_file().readall())
+            if _etag is None:
+                downloader = file_client.download_file()
+            else:
+                downloader = file_client.download_file(
+                    etag=_etag, match_condition=MatchConditions.IfModified)
+            obj = json.loads(downloader.readall())
             anomaly_status =  bool(obj["is_anomaly_enabled"])
+            _etag = downloader.properties.etag
+        except ResourceNotModifiedError:
+            metrics.add("metadata_cache_hits")
         except ResourceNotFoundError:
+            anomaly_status = False
             anomaly_record = {
                 "is_anomaly_enabled": anomaly_status
             }
@@ -68,190 +107,301 @@ class DataAccessLayer(BaseLayer):
             self.logme("\nUploading anomaly record to Azure Data Lake Store as: " +
                     self.anomaly_file_name)
             json_str = json.dumps(anomaly_record, cls=ComplexEncoder)
-            file_client.upload_data(json_str, overwrite=True)
+            _etag = file_client.upload_data(json_str, overwrite=True)["etag"]
+        metadata_cache.configs.put(_key, anomaly_status, _etag)
         return anomaly_status
 
-    def get_last_records(self):
-        last_records = []
-        last_record_timestamp = datetime.utcnow()
-        try:
-            file_client = self.file_system_client.get_file_client(
-                self.last_records_blob_name)
-            obj = json.loads(file_client.download_file().readall())
-            last_record_timestamp = datetime.strptime(
-                obj["last_record_timestamp"], datetime_format)
-            last_records = []
-            for record in obj["records"]:
-                last_records.append(
-                    SensorReading(
-                        datetime.strptime(record["timestamp"],
-                                          datetime_format),
-                        record["equipment_tag"], record["value"]))
-        except ResourceNotFoundError:
-            start_timestamp = datetime.strptime("2020-10-13T02:02:00Z",
-                                                datetime_format)
-            last_record_timestamp = start_timestamp  - timedelta(minutes=1) # datetime.utcnow() - timedelta(minutes=2)
-            equipment_list = {
-                "turbine_temperature", "turbine_humidity", "turbine_pressure",
-                "booster_temperature", "booster_humidity", "booster_pressure",
-                "engine_temperature", "engine_humidity", "engine_pressure",
-                "main_valve_temperature", "main_valve_humidity",
-                "main_valve_pressure"
-            }
-            last_records = []
-            for equipment in equipment_list:
-                last_record = SensorReading(timestamp=last_record_timestamp,
-                                            equipment_tag=equipment,
-                                            value=None)
-                last_records.append(last_record)
-        return last_record_timestamp, last_records
+    def get_directory_client(self, path):
+        # each directory is created once per worker, not once per minute
+        _key = (self.file_system_name, path)
+        if _key in metadata_cache.directories:
+            metrics.add("metadata_cache_hits")
+            return self.file_system_client.get_directory_client(path)
+        directory_client = self.uploader.call(
+            self.file_system_client.create_directory, path, retry_total=0)
+        metadata_cache.directories.add(_key)
+        return directory_client
+
+    def forget_directory(self, path):
+        metadata_cache.directories.discard((self.file_system_name, path))
+
+    def get_root_client(self, name):
+        return self.file_system_client.get_file_client(name)
+
+    def upload_to_client(self, client, data, content_type=None,
+                         content_encoding=None, **kwargs):
+        if content_type is not None:
+            kwargs["content_settings"] = ContentSettings(
+                content_type=content_type, content_encoding=content_encoding)
+        return client.upload_data(data, **kwargs)
+
+    def download_from_client(self, client):
+        return client.download_file()
+
+    def get_lease_client(self, client):
+        return DataLakeLeaseClient(client)
+
+    def get_start_timestamp(self):
+        return datetime.strptime("2020-10-13T02:02:00Z",
+                                 datetime_format) - timedelta(minutes=1)
 
     def write_records(self, new_timestamp, records):
-        json_str = json.dumps(records, cls=ComplexEncoder)
-        _blob_name = new_timestamp.strftime("%Y-%m-%d-%H-%M.json")
-        directory_client = self.file_system_client.create_directory(
-            new_timestamp.strftime("%Y/%m/%d/%H"))
-        file_client = directory_client.get_file_client(_blob_name)
-        self.logme("\nUploading to Azure Data Lake Store as: " + _blob_name)
-        file_client.upload_data(json_str, overwrite=True)
+        if self.columnar_buffer is not None:
+            self.buffer_records(new_timestamp, records)
+            metrics.add("records_written", len(records))
+            return
+        with stage("serialize", records=len(records)):
+            json_str = serialize_records(records, self.record_encoding)
+        _blob_name = get_window_name(
+            new_timestamp,
+            self.window) + encodings[self.record_encoding]["extension"]
+        logging.debug("Uploading to Azure Data Lake Store as: " + _blob_name)
+        with stage("upload", bytes=len(json_str)):
+            _directory = new_timestamp.strftime("%Y/%m/%d/%H")
+            try:
+                self.upload_file(_directory, _blob_name, json_str)
+            except ResourceNotFoundError:
+                # the cached directory was removed behind our back
+                self.forget_directory(_directory)
+                self.upload_file(_directory, _blob_name, json_str)
+        metrics.add("records_written", len(records))
+        metrics.add("bytes_written", len(json_str))
+        metrics.add("uploads")
 
-    def write_last_records(self, last_timstamp, records):
-        last_record = {
-            "last_record_timestamp": last_timstamp.strftime(datetime_format),
-            "records": records
-        }
-        file_client = self.file_system_client.get_file_client(
-            self.last_records_blob_name)
-        self.logme("\nUploading last record to Azure Data Lake Store as: " +
-                   self.last_records_blob_name)
-        json_str = json.dumps(last_record, cls=ComplexEncoder)
-        file_client.upload_data(json_str, overwrite=True)
+    def upload_file(self, directory, file_name, data):
+        file_client = self.get_directory_client(directory).get_file_client(
+            file_name)
+        self.uploader.call(
+            file_client.upload_data,
+            data,
+            retry_total=0,
+            overwrite=True,
+            content_settings=ContentSettings(
+                content_type=encodings[self.record_encoding]["content_type"],
+                content_encoding=encodings[
+                    self.record_encoding]["content_encoding"]))
 
+    def get_partition_directory(self, start, partition):
+        return start.strftime("%Y/%m/%d/%H" if partition ==
+                              "hourly" else "%Y/%m/%d")
 
-class BusinessLayer(BaseLayer):
-    def __init__(self, current_datetime, enable_anomaly):
-        self.dal = DataAccessLayer()
-        self.current_datetime = current_datetime
-        self.enable_anomaly = self.dal.is_anomaly_enabled()
+    def get_partition_client(self, start, partition, file_name=None):
+        return self.get_directory_client(
+            self.get_partition_directory(start, partition)).get_file_client(
+                file_name or partition_file_name(start, partition,
+                                                 self.columnar_format))
 
-    def get_value(self, previous_record):
-        equipment_list = {
-            "turbine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "turbine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "turbine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "booster_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "booster_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "booster_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "engine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "engine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "engine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "main_valve_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "main_valve_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "main_valve_pressure": {
-                "min": 12,
-                "max": 16
-            }
-        }
-        start = equipment_list[previous_record.equipment_tag]["min"]
-        end = equipment_list[previous_record.equipment_tag]["max"]
-        x = round(random.uniform(start, end), 2)
-        if self.enable_anomaly:
-            anomaly = random.uniform(-1, 1)
-            if anomaly > 0:
-                x = round(end * anomaly, 2)
-            elif anomaly < 0:
-                x = round(start * -1 * anomaly, 2)
-        return x
+    def upload_partition(self, start, file_name, table):
+        with stage("serialize", records=table.num_rows):
+            _data = to_bytes(table, self.columnar_format)
+        with stage("upload", bytes=len(_data)):
+            file_client = self.get_partition_client(start, self.output_mode,
+                                                    file_name)
+            self.uploader.call(
+                file_client.upload_data,
+                _data,
+                retry_total=0,
+                overwrite=True,
+                content_settings=ContentSettings(
+                    content_type=content_types[self.columnar_format]))
+        self.logme("\nUploaded %s rows to Azure Data Lake Store as: %s" %
+                   (str(table.num_rows), file_client.path_name))
+        metrics.add("bytes_written", len(_data))
+        metrics.add("uploads")
 
-    def create_next_record(self, previous_record, new_timestamp):
-        _time_difference = self.current_datetime - new_timestamp
-        _next_record = None
-        if _time_difference.days > -1 and _time_difference.seconds > 0:
-            _next_record = SensorReading(
-                timestamp=new_timestamp,
-                equipment_tag=previous_record.equipment_tag,
-                value=self.get_value(previous_record))
-        return _next_record
+    def compact_records(self, start, partition):
+        # roll the minute files and part files of one hour or day into a
+        # columnar file
+        _columns = []
+        _sources = []
+        _hour = start
+        while _hour < start + partitions[partition]["length"]:
+            try:
+                for path in self.file_system_client.get_paths(
+                        path=_hour.strftime("%Y/%m/%d/%H")):
+                    if path.is_directory or not is_record_file(path.name):
+                        continue
+                    file_client = self.file_system_client.get_file_client(
+                        path.name)
+                    _columns.append(records_to_columns(
+                        parse_records(file_client.download_file().readall())))
+                    _sources.append(file_client)
+            except ResourceNotFoundError:
+                pass
+            _hour = _hour + timedelta(hours=1)
+        _directory = self.get_partition_directory(start, partition)
+        try:
+            _parts = sorted(
+                (path.name for path in self.file_system_client.get_paths(
+                    path=_directory, recursive=False)
+                 if not path.is_directory and is_part_file(
+                     path.name, start, partition, self.columnar_format)),
+                reverse=True)
+        except ResourceNotFoundError:
+            _parts = []
+        # later parts come from later runs
+        for _name in _parts:
+            file_client = self.file_system_client.get_file_client(_name)
+            _columns.append(table_to_columns(from_bytes(
+                file_client.download_file().readall(), self.columnar_format)))
+            _sources.append(file_client)
+        if len(_sources) == 0:
+            return 0
+        file_client = self.get_partition_client(start, partition)
+        try:
+            # keep rows already written in columnar mode for this partition
+            _columns.append(table_to_columns(from_bytes(
+                file_client.download_file().readall(), self.columnar_format)))
+        except ResourceNotFoundError:
+            pass
+        self.logme("\nCompacting %s minute or part files to: %s" %
+                   (str(len(_sources)), file_client.path_name))
+        file_client.upload_data(
+            to_bytes(to_table(*merge_columns(_columns)),
+                     self.columnar_format),
+            overwrite=True,
+            content_settings=ContentSettings(
+                content_type=content_types[self.columnar_format]))
+        for file_client in _sources:
+            file_client.delete_file()
+        return len(_sources)
 
-    def create_next_records(self, previous_records, new_timestamp):
-        _next_records = []
-        for _previous_record in previous_records:
-            _next_record = self.create_next_record(_previous_record,
-                                                   new_timestamp)
-            if _next_record:
-                _next_records.append(_next_record)
-        return _next_records
 
-    def write_records(self, x):
-        self.dal.write_records(x['new_timestamp'], x['records'])
+class BusinessLayer(StorageBusinessLayer):
+    def __init__(self,
+                 current_datetime,
+                 enable_anomaly,
+                 max_connections=10,
+                 output_mode="json",
+                 record_encoding="json"):
+        self.dal = DataAccessLayer(max_connections=max_connections,
+                                   output_mode=output_mode,
+                                   record_encoding=record_encoding)
+        self.current_datetime = current_datetime
+        self.enable_anomaly = self.dal.is_anomaly_enabled()
 
-    def process(self, pooled_connection=False):
+    def process(self,
+                pooled_connection=False,
+                chunk_minutes=60,
+                max_in_flight=10,
+                checkpoint_minutes=60,
+                checkpoint_seconds=30,
+                time_budget=None):
+        if time_budget is None:
+            time_budget = TimeBudget(None)
+        _counters_before = metrics.snapshot()["counters"]
         _last_record_time, _previous_records = self.dal.get_last_records()
-        new_timestamp = _last_record_time + timedelta(seconds=60)
-        _next_records = self.create_next_records(_previous_records,
-                                                 new_timestamp)
-        records_to_write = []
-        while (len(_next_records) > 0):
-            record_to_write = {
-                "new_timestamp" : new_timestamp, 
-                "records" : _next_records
-            }
-            records_to_write.append(record_to_write)
-            _previous_records = _next_records
-            _last_record_time = new_timestamp
-            new_timestamp = new_timestamp + timedelta(seconds=60)
-            _next_records = self.create_next_records(_previous_records,
-                                                     new_timestamp)        
-        if pooled_connection:
-            from multiprocessing import Pool
-            with Pool(10) as p:
-                p.map(self.write_records, records_to_write)
+        _backlog_minutes = pending_minutes(_last_record_time,
+                                           self.current_datetime)
+        checkpointer = Checkpointer(self.write_checkpoint,
+                                    _last_record_time,
+                                    every_minutes=checkpoint_minutes,
+                                    every_seconds=checkpoint_seconds)
+        # columnar partitions are built in minute order, one upload each
+        if pooled_connection and self.dal.columnar_buffer is None:
+            _written_minutes = self.process_concurrently(
+                _last_record_time, _previous_records, chunk_minutes,
+                max_in_flight, checkpointer, time_budget)
         else:
-            for x in records_to_write:
-                self.dal.write_records(x['new_timestamp'], x['records'])
+            _written_minutes = 0
+            try:
+                for x in self.iter_minutes_to_write(_last_record_time,
+                                                    _previous_records,
+                                                    chunk_minutes,
+                                                    time_budget):
+                    self.dal.write_records(x['new_timestamp'], x['records'])
+                    checkpointer.confirm(x['new_timestamp'], x['records'])
+                    _last_record_time = x['new_timestamp']
+                    _previous_records = x['records']
+                    _written_minutes = _written_minutes + 1
+            except Exception:
+                # keep what was written before the failure
+                checkpointer.checkpoint()
+                raise
+            self.dal.flush_records()
             self.dal.write_last_records(_last_record_time, _previous_records)
+        report = self.report_progress(
+            _counters_before,
+            get_progress_report(_backlog_minutes, _written_minutes,
+                                time_budget.elapsed(), time_budget.seconds))
+        return report
+
+    def process_concurrently(self, last_record_time, previous_records,
+                             chunk_minutes, max_in_flight, checkpointer,
+                             time_budget):
+        uploader = ConcurrentUploader(self.dal.write_records, max_in_flight)
+        try:
+            with uploader:
+                for x in self.iter_minutes_to_write(last_record_time,
+                                                    previous_records,
+                                                    chunk_minutes,
+                                                    time_budget):
+                    uploader.submit(x)
+                    if uploader.confirmed is not None:
+                        checkpointer.confirm(
+                            uploader.confirmed['new_timestamp'],
+                            uploader.confirmed['records'])
+                uploader.flush()
+        finally:
+            # only minutes whose predecessors are all written move the
+            # watermark, even when a later upload failed
+            confirmed = uploader.confirmed
+            if confirmed is not None:
+                self.dal.write_last_records(confirmed['new_timestamp'],
+                                            confirmed['records'])
+        if uploader.confirmed is None:
+            return 0
+        return int((uploader.confirmed['new_timestamp'] - last_record_time) /
+                   step)
 
     @classmethod
-    def run(cls, current_datetime, enable_anomaly):
+    def run(cls,
+            current_datetime,
+            enable_anomaly,
+            pooled_connection=False,
+            max_in_flight=10,
+            output_mode="json",
+            record_encoding="json",
+            use_lease=True,
+            time_budget_seconds=None):
+        # the budget covers the whole invocation, setup included
+        time_budget = TimeBudget(time_budget_seconds)
         bl = BusinessLayer(current_datetime=current_datetime,
-                           enable_anomaly=enable_anomaly)
-        bl.process()
+                           enable_anomaly=enable_anomaly,
+                           max_connections=max_in_flight,
+                           output_mode=output_mode,
+                           record_encoding=record_encoding)
+        if not use_lease:
+            return bl.process(pooled_connection=pooled_connection,
+                              max_in_flight=max_in_flight,
+                              time_budget=time_budget)
+        lease = bl.dal.get_writer_lease()
+        if not lease.acquire():
+            bl.logme("\nAnother invocation holds %s, exiting" %
+                     bl.dal.lock_blob_name)
+            return None
+        with lease:
+            return bl.process(pooled_connection=pooled_connection,
+                              max_in_flight=max_in_flight,
+                              time_budget=time_budget)
 
 
 if __name__ == "__main__":
     utc_timestamp = datetime.utcnow()
-    BusinessLayer.run(utc_timestamp, False)
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        # compact hourly|daily 2020-10-13 2020-10-14 [parquet|arrow]
+        dal = DataAccessLayer(columnar_format=(sys.argv[5] if len(sys.argv) > 5
+                                               else "parquet"))
+        dal.compact(datetime.strptime(sys.argv[3], "%Y-%m-%d"),
+                    datetime.strptime(sys.argv[4], "%Y-%m-%d"), sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        # backfill 2021-01-01 [workers] [shard_minutes]
+        BusinessLayer.backfill(
+            datetime.strptime(sys.argv[2], "%Y-%m-%d"),
+            False,
+            workers=int(sys.argv[3]) if len(sys.argv) > 3 else None,
+            shard_minutes=(int(sys.argv[4]) if len(sys.argv) > 4 else
+                           default_shard_minutes))
+    else:
+        BusinessLayer.run(utc_timestamp, False)
    
@@ -1,220 +1,349 @@
 import os
-import json
-import random
+import sys
 from datetime import datetime, timedelta
 import logging
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, BlobClient, BlobLeaseClient, ContainerClient, ContentSettings
+from azure.core.exceptions import ResourceNotFoundError
 
-# Base = declarative_base()
-
-datetime_format = "%Y-%m-%dT%H:%M:00Z"
-json.JSONEncoder.default = lambda self, obj: (obj.strftime(
-    datetime_format) if isinstance(obj, datetime) else None)
-
-
-class SensorReading():
-    def __init__(self, timestamp, equipment_tag, value):
-        self.timestamp = timestamp
-        self.equipment_tag = equipment_tag
-        self.value = value
-
-
-class ComplexEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, SensorReading):
-            return obj.__dict__
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
+from .value_generator import pending_minutes, step
+from .checkpoint import Checkpointer
+from .pipeline import UploadPipeline
+from .throttle import AdaptiveLimiter, AdaptiveUploader
+from .budget import TimeBudget, get_progress_report
+from .backfill import default_shard_minutes
+from .telemetry import metrics, stage
+from .serializer import (check_encoding, encodings, get_window_name,
+                         is_record_file, parse_records, serialize_records)
+from .storage_layer import StorageBusinessLayer, StorageDataAccessLayer
+from .columnar import (ColumnarBuffer, content_types, from_bytes,
+                       is_part_file, merge_columns, partition_file_name,
+                       partitions, records_to_columns, table_to_columns,
+                       to_bytes, to_table)
 
+# Base = declarative_base()
 
-class BaseLayer():
-    def __init__(self, args):
-        pass
-
-    def logme(self, message):
-        logging.info(message)
-        print(message)
 
+class DataAccessLayer(StorageDataAccessLayer):
+    storage_name = "Azure Storage"
 
-class DataAccessLayer(BaseLayer):
-    def __init__(self):
+    def __init__(self,
+                 max_connections=10,
+                 output_mode="json",
+                 columnar_format="parquet",
+                 record_encoding="json"):
+        self.max_connections = max_connections
+        # retries and the number of concurrent uploads adapt to throttling,
+        # the SDK's own retries are switched off for these calls
+        self.uploader = AdaptiveUploader(AdaptiveLimiter(max_connections))
         self.blob_service_client = self.get_blob_service_client()
         self.container_name = "metadv"
         self.last_records_blob_name = "last-records.json"
+        self.lock_blob_name = "generator.lock"
+        # etag of the last-records.json this run resumed from, so the
+        # watermark is never overwritten behind another writer's back
+        self.last_records_etag = None
+        # "json" writes one blob per minute, "hourly" and "daily" buffer
+        # minutes into one columnar blob per partition
+        self.output_mode = output_mode
+        self.columnar_format = columnar_format
+        self.columnar_buffer = None
+        check_encoding(record_encoding)
+        self.record_encoding = record_encoding
+        # one file per window of this length, see fanout
+        self.window = step
+        if output_mode != "json":
+            self.columnar_buffer = ColumnarBuffer(output_mode, columnar_format)
 
     def get_blob_service_client(self):
         connect_str = os.environ["ADLS_CONNECTION_STRING"]
+        # one pooled session shared by every upload thread
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.max_connections,
+            pool_maxsize=self.max_connections)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         blob_service_client = BlobServiceClient.from_connection_string(
-            connect_str)
+            connect_str, transport=RequestsTransport(session=session))
         return blob_service_client
 
-    def get_last_records(self):
-        last_records = []
-        last_record_timestamp = datetime.utcnow()
-        try:
-            blob_client = self.blob_service_client.get_blob_client(
-                container=self.container_name,
-                blob=self.last_records_blob_name)
-            obj = json.loads(blob_client.download_blob().readall())
-            last_record_timestamp = datetime.strptime(
-                obj["last_record_timestamp"], datetime_format)
-            last_records = []
-            for record in obj["records"]:
-                last_records.append(
-                    SensorReading(
-                        datetime.strptime(record["timestamp"],
-                                          datetime_format),
-                        record["equipment_tag"], record["value"]))
-        except ResourceNotFoundError:
-            start_timestamp = datetime.strptime("2020-10-01T00:00:00Z",
-                                                datetime_format)
-            last_record_timestamp = datetime.utcnow() - timedelta(minutes=2)
-            equipment_list = {
-                "turbine_temperature", "turbine_humidity", "turbine_pressure",
-                "booster_temperature", "booster_humidity", "booster_pressure",
-                "engine_temperature", "engine_humidity", "engine_pressure",
-                "main_valve_temperature", "main_valve_humidity",
-                "main_valve_pressure"
-            }
-            last_records = []
-            for equipment in equipment_list:
-                last_record = SensorReading(timestamp=last_record_timestamp,
-                                            equipment_tag=equipment,
-                                            value=None)
-                last_records.append(last_record)
-        return last_record_timestamp, last_records
+    def get_root_client(self, name):
+        return self.blob_service_client.get_blob_client(
+            container=self.container_name, blob=name)
+
+    def upload_to_client(self, client, data, content_type=None,
+                         content_encoding=None, **kwargs):
+        if content_type is not None:
+            kwargs["content_settings"] = ContentSettings(
+                content_type=content_type, content_encoding=content_encoding)
+        return client.upload_blob(data, **kwargs)
+
+    def download_from_client(self, client):
+        return client.download_blob()
+
+    def get_lease_client(self, client):
+        return BlobLeaseClient(client)
+
+    def get_start_timestamp(self):
+        # whole minutes, the seed is written back as the watermark
+        return datetime.utcnow().replace(second=0,
+                                         microsecond=0) - timedelta(minutes=2)
 
     def write_records(self, new_timestamp, records):
-        json_str = json.dumps(records, cls=ComplexEncoder)
-        _blob_name = new_timestamp.strftime("%Y/%m/%d/%Y-%m-%d-%H-%M.json")
+        if self.columnar_buffer is not None:
+            self.buffer_records(new_timestamp, records)
+            metrics.add("records_written", len(records))
+            return
+        self.upload_prepared(self.prepare_records(new_timestamp, records))
+
+    def prepare_records(self, new_timestamp, records):
+        # the cpu side of write_records, the pipeline runs it on the
+        # generating thread
+        with stage("serialize", records=len(records)):
+            json_str = serialize_records(records, self.record_encoding)
+        _blob_name = new_timestamp.strftime("%Y/%m/%d/") + get_window_name(
+            new_timestamp,
+            self.window) + encodings[self.record_encoding]["extension"]
+        return _blob_name, json_str, len(records)
+
+    def upload_prepared(self, prepared):
+        _blob_name, json_str, _record_count = prepared
         blob_client = self.blob_service_client.get_blob_client(
             container=self.container_name, blob=_blob_name)
-        self.logme("\nUploading to Azure Storage as blob: " + _blob_name)
-        blob_client.upload_blob(json_str, overwrite=True)
+        logging.debug("Uploading to Azure Storage as blob: " + _blob_name)
+        with stage("upload", bytes=len(json_str)):
+            self.uploader.call(
+                blob_client.upload_blob,
+                json_str,
+                retry_total=0,
+                overwrite=True,
+                content_settings=ContentSettings(
+                    content_type=encodings[self.record_encoding]["content_type"],
+                    content_encoding=encodings[
+                        self.record_encoding]["content_encoding"]))
+        metrics.add("records_written", _record_count)
+        metrics.add("bytes_written", len(json_str))
+        metrics.add("uploads")
         # self.logme(json_str)
 
-    def write_last_records(self, last_timstamp, records):
-        last_record = {
-            "last_record_timestamp": last_timstamp.strftime(datetime_format),
-            "records": records
-        }
-        blob_client = self.blob_service_client.get_blob_client(
-            container=self.container_name, blob=self.last_records_blob_name)
-        self.logme("\nUploading last record to Azure Storage as blob: " +
-                   self.last_records_blob_name)
-        json_str = json.dumps(last_record, cls=ComplexEncoder)
-        blob_client.upload_blob(json_str, overwrite=True)
+    def get_partition_client(self, start, partition, file_name=None):
+        _blob_name = start.strftime("%Y/%m/%d/") + (
+            file_name or partition_file_name(start, partition,
+                                             self.columnar_format))
+        return self.blob_service_client.get_blob_client(
+            container=self.container_name, blob=_blob_name)
 
+    def upload_partition(self, start, file_name, table):
+        blob_client = self.get_partition_client(start, self.output_mode,
+                                                file_name)
+        with stage("serialize", records=table.num_rows):
+            _data = to_bytes(table, self.columnar_format)
+        with stage("upload", bytes=len(_data)):
+            self.uploader.call(
+                blob_client.upload_blob,
+                _data,
+                retry_total=0,
+                overwrite=True,
+                content_settings=ContentSettings(
+                    content_type=content_types[self.columnar_format]))
+        self.logme("\nUploaded %s rows to Azure Storage as blob: %s" %
+                   (str(table.num_rows), blob_client.blob_name))
+        metrics.add("bytes_written", len(_data))
+        metrics.add("uploads")
 
-class BusinessLayer(BaseLayer):
-    def __init__(self, current_datetime, enable_anomaly):
-        self.dal = DataAccessLayer()
+    def compact_records(self, start, partition):
+        # roll the minute blobs and part blobs of one hour or day into a
+        # columnar blob
+        container_client = self.blob_service_client.get_container_client(
+            self.container_name)
+        _columns = []
+        _sources = []
+        _hour = start
+        while _hour < start + partitions[partition]["length"]:
+            for blob in container_client.list_blobs(
+                    name_starts_with=_hour.strftime("%Y/%m/%d/%Y-%m-%d-%H-")):
+                if not is_record_file(blob.name):
+                    continue
+                blob_client = container_client.get_blob_client(blob.name)
+                _columns.append(records_to_columns(
+                    parse_records(blob_client.download_blob().readall())))
+                _sources.append(blob_client)
+            _hour = _hour + timedelta(hours=1)
+        _parts = sorted(
+            (blob.name for blob in container_client.list_blobs(
+                name_starts_with=start.strftime("%Y/%m/%d/"))
+             if is_part_file(blob.name, start, partition,
+                             self.columnar_format)),
+            reverse=True)
+        # later parts come from later runs
+        for _name in _parts:
+            blob_client = container_client.get_blob_client(_name)
+            _columns.append(table_to_columns(from_bytes(
+                blob_client.download_blob().readall(), self.columnar_format)))
+            _sources.append(blob_client)
+        if len(_sources) == 0:
+            return 0
+        blob_client = self.get_partition_client(start, partition)
+        try:
+            # keep rows already written in columnar mode for this partition
+            _columns.append(table_to_columns(from_bytes(
+                blob_client.download_blob().readall(), self.columnar_format)))
+        except ResourceNotFoundError:
+            pass
+        self.logme("\nCompacting %s minute or part blobs to: %s" %
+                   (str(len(_sources)), blob_client.blob_name))
+        blob_client.upload_blob(
+            to_bytes(to_table(*merge_columns(_columns)),
+                     self.columnar_format),
+            overwrite=True,
+            content_settings=ContentSettings(
+                content_type=content_types[self.columnar_format]))
+        for blob_client in _sources:
+            blob_client.delete_blob()
+        return len(_sources)
+
+
+class BusinessLayer(StorageBusinessLayer):
+    def __init__(self,
+                 current_datetime,
+                 enable_anomaly,
+                 max_connections=10,
+                 output_mode="json",
+                 record_encoding="json"):
+        self.dal = DataAccessLayer(max_connections=max_connections,
+                                   output_mode=output_mode,
+                                   record_encoding=record_encoding)
         self.current_datetime = current_datetime
         self.enable_anomaly = enable_anomaly
 
-    def get_value(self, previous_record):
-        equipment_list = {
-            "turbine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "turbine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "turbine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "booster_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "booster_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "booster_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "engine_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "engine_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "engine_pressure": {
-                "min": 12,
-                "max": 16
-            },
-            "main_valve_temperature": {
-                "min": 30,
-                "max": 50
-            },
-            "main_valve_humidity": {
-                "min": 40,
-                "max": 70
-            },
-            "main_valve_pressure": {
-                "min": 12,
-                "max": 16
-            }
-        }
-        start = equipment_list[previous_record.equipment_tag]["min"]
-        end = equipment_list[previous_record.equipment_tag]["max"]
-        x = round(random.uniform(start, end), 2)
-        if self.enable_anomaly:
-            anomaly = random.uniform(-1, 1)
-            if anomaly > 0:
-                x = round(end * anomaly, 2)
-            elif anomaly < 0:
-                x = round(start * -1 * anomaly, 2)
-        return x
-
-    def create_next_record(self, previous_record, new_timestamp):
-        _time_difference = self.current_datetime - new_timestamp
-        _next_record = None
-        if _time_difference.days > -1 and _time_difference.seconds > 0:
-            _next_record = SensorReading(
-                timestamp=new_timestamp,
-                equipment_tag=previous_record.equipment_tag,
-                value=self.get_value(previous_record))
-        return _next_record
-
-    def create_next_records(self, previous_records, new_timestamp):
-        _next_records = []
-        for _previous_record in previous_records:
-            _next_record = self.create_next_record(_previous_record,
-                                                   new_timestamp)
-            if _next_record:
-                _next_records.append(_next_record)
-        return _next_records
-
-    def process(self):
+    def process(self,
+                chunk_minutes=60,
+                checkpoint_minutes=60,
+                checkpoint_seconds=30,
+                time_budget=None,
+                pipelined=False,
+                queue_depth=20,
+                max_in_flight=10):
+        if time_budget is None:
+            time_budget = TimeBudget(None)
+        _counters_before = metrics.snapshot()["counters"]
         _last_record_time, _previous_records = self.dal.get_last_records()
-        new_timestamp = _last_record_time + timedelta(seconds=60)
-        _next_records = self.create_next_records(_previous_records,
-                                                 new_timestamp)
-        while (len(_next_records) > 0):
-            self.dal.write_records(new_timestamp, _next_records)
-            _previous_records = _next_records
-            _last_record_time = new_timestamp
-            new_timestamp = new_timestamp + timedelta(seconds=60)
-            _next_records = self.create_next_records(_previous_records,
-                                                     new_timestamp)
-        self.dal.write_last_records(_last_record_time, _previous_records)
+        checkpointer = Checkpointer(self.write_checkpoint,
+                                    _last_record_time,
+                                    every_minutes=checkpoint_minutes,
+                                    every_seconds=checkpoint_seconds)
+        _minutes = pending_minutes(_last_record_time, self.current_datetime)
+        # columnar partitions are built in minute order, one upload each
+        if pipelined and self.dal.columnar_buffer is None:
+            _written_minutes = self.process_pipelined(
+                _last_record_time, _previous_records, chunk_minutes,
+                queue_depth, max_in_flight, checkpointer, time_budget)
+        else:
+            _written_minutes = 0
+            try:
+                for x in self.iter_minutes_to_write(_last_record_time,
+                                                    _previous_records,
+                                                    chunk_minutes,
+                                                    time_budget):
+                    self.dal.write_records(x['new_timestamp'], x['records'])
+                    checkpointer.confirm(x['new_timestamp'], x['records'])
+                    _last_record_time = x['new_timestamp']
+                    _previous_records = x['records']
+                    _written_minutes = _written_minutes + 1
+            except Exception:
+                # keep what was written before the failure
+                checkpointer.checkpoint()
+                raise
+            self.dal.flush_records()
+            self.dal.write_last_records(_last_record_time, _previous_records)
+        report = self.report_progress(
+            _counters_before,
+            get_progress_report(_minutes, _written_minutes,
+                                time_budget.elapsed(), time_budget.seconds))
+        return report
+
+    def process_pipelined(self, last_record_time, previous_records,
+                          chunk_minutes, queue_depth, max_in_flight,
+                          checkpointer, time_budget):
+        # this thread generates and serializes, max_in_flight threads upload
+        pipeline = UploadPipeline(self.dal.upload_prepared, queue_depth,
+                                  max_in_flight)
+        try:
+            with pipeline:
+                for x in self.iter_minutes_to_write(last_record_time,
+                                                    previous_records,
+                                                    chunk_minutes,
+                                                    time_budget):
+                    pipeline.put(
+                        self.dal.prepare_records(x['new_timestamp'],
+                                                 x['records']), x)
+                    if pipeline.confirmed is not None:
+                        checkpointer.confirm(
+                            pipeline.confirmed['new_timestamp'],
+                            pipeline.confirmed['records'])
+        finally:
+            # only minutes whose predecessors are all uploaded move the
+            # watermark, even when a later upload failed
+            confirmed = pipeline.confirmed
+            if confirmed is not None:
+                self.dal.write_last_records(confirmed['new_timestamp'],
+                                            confirmed['records'])
+        if confirmed is None:
+            return 0
+        return int((confirmed['new_timestamp'] - last_record_time) / step)
 
     @classmethod
-    def run(cls, current_datetime, enable_anomaly):
+    def run(cls,
+            current_datetime,
+            enable_anomaly,
+            output_mode="json",
+            record_encoding="json",
+            use_lease=True,
+            time_budget_seconds=None,
+            pipelined=False,
+            queue_depth=20,
+            max_in_flight=10):
+        # the budget covers the whole invocation, setup included
+        time_budget = TimeBudget(time_budget_seconds)
         bl = BusinessLayer(current_datetime=current_datetime,
-                           enable_anomaly=enable_anomaly)
-        bl.process()
+                           enable_anomaly=enable_anomaly,
+                           max_connections=max_in_flight,
+                           output_mode=output_mode,
+                           record_encoding=record_encoding)
+        if not use_lease:
+            return bl.process(time_budget=time_budget,
+                              pipelined=pipelined,
+                              queue_depth=queue_depth,
+                              max_in_flight=max_in_flight)
+        lease = bl.dal.get_writer_lease()
+        if not lease.acquire():
+            bl.logme("\nAnother invocation holds %s, exiting" %
+                     bl.dal.lock_blob_name)
+            return None
+        with lease:
+            return bl.process(time_budget=time_budget,
+                              pipelined=pipelined,
+                              queue_depth=queue_depth,
+                              max_in_flight=max_in_flight)
 
 
 if __name__ == "__main__":
     utc_timestamp = datetime.utcnow()
-    BusinessLayer.run(utc_timestamp, False)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        # compact hourly|daily 2020-10-13 2020-10-14 [parquet|arrow]
+        dal = DataAccessLayer(columnar_format=(sys.argv[5] if len(sys.argv) > 5
+                                               else "parquet"))
+        dal.compact(datetime.strptime(sys.argv[3], "%Y-%m-%d"),
+                    datetime.strptime(sys.argv[4], "%Y-%m-%d"), sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        # backfill 2021-01-01 [workers] [shard_minutes]
+        BusinessLayer.backfill(
+            datetime.strptime(sys.argv[2], "%Y-%m-%d"),
+            False,
+            workers=int(sys.argv[3]) if len(sys.argv) > 3 else None,
+            shard_minutes=(int(sys.argv[4]) if len(sys.argv) > 4 else
+                           default_shard_minutes))
+    else:
+        BusinessLayer.run(utc_timestamp, False)
\ No newline at end of file
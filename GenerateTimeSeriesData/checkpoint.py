@@ -0,0 +1,41 @@
+import time
+
+from .value_generator import step
+
+
+class Checkpointer():
+    def __init__(self,
+                 write_checkpoint,
+                 last_timestamp,
+                 every_minutes=60,
+                 every_seconds=30):
+        # write_checkpoint(last_timestamp, records) persists the watermark,
+        # it is only ever handed minutes that are already durable
+        self.write_checkpoint = write_checkpoint
+        self.every_minutes = every_minutes
+        self.every_seconds = every_seconds
+        self.checkpointed_timestamp = last_timestamp
+        self.checkpointed_at = time.monotonic()
+        self.confirmed = None
+
+    def is_due(self, last_timestamp):
+        if self.every_minutes is not None and \
+                last_timestamp - self.checkpointed_timestamp >= \
+                step * self.every_minutes:
+            return True
+        return self.every_seconds is not None and \
+            time.monotonic() - self.checkpointed_at >= self.every_seconds
+
+    def confirm(self, last_timestamp, records):
+        self.confirmed = (last_timestamp, records)
+        if last_timestamp > self.checkpointed_timestamp and \
+                self.is_due(last_timestamp):
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self.confirmed is None or \
+                self.confirmed[0] <= self.checkpointed_timestamp:
+            return
+        self.write_checkpoint(*self.confirmed)
+        self.checkpointed_timestamp = self.confirmed[0]
+        self.checkpointed_at = time.monotonic()
@@ -0,0 +1,264 @@
+import calendar
+from datetime import timedelta
+
+import numpy as np
+
+from .readings import get_batches
+from .serializer import parse_timestamp
+
+# pyarrow is only imported once a columnar mode is used, it is a large
+# share of import time otherwise
+pa = None
+
+# a run writes the partition file only when it starts on the partition's
+# first minute, otherwise a part file with just its own minutes, so a tick
+# never downloads or rewrites what earlier ticks wrote; compact merges them
+partitions = {
+    "hourly": {
+        "name_format": "%Y-%m-%d-%H",
+        "length": timedelta(hours=1)
+    },
+    "daily": {
+        "name_format": "%Y-%m-%d",
+        "length": timedelta(days=1)
+    }
+}
+
+file_extensions = {"parquet": ".parquet", "arrow": ".arrow"}
+
+content_types = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file"
+}
+
+
+def load_pyarrow():
+    global pa
+    if pa is None:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+        pa = pyarrow
+    return pa
+
+
+def check_columnar(partition, columnar_format):
+    if partition not in partitions:
+        raise ValueError("unknown partition: %s" % partition)
+    if columnar_format not in file_extensions:
+        raise ValueError("unknown columnar format: %s" % columnar_format)
+    try:
+        load_pyarrow()
+    except ImportError:
+        raise ImportError("pyarrow is required for %s %s output" %
+                          (partition, columnar_format))
+
+
+def to_epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def partition_start(timestamp, partition):
+    if partition == "hourly":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_file_name(start, partition, columnar_format):
+    return start.strftime(partitions[partition]["name_format"]) + \
+        file_extensions[columnar_format]
+
+
+def part_file_name(start, first, partition, columnar_format):
+    # a run that starts inside a partition writes its minutes from first
+    # on to a part file, compaction merges the parts into the partition
+    return start.strftime(partitions[partition]["name_format"]) + \
+        first.strftime(".part-%H%M%S") + file_extensions[columnar_format]
+
+
+def is_part_file(name, start, partition, columnar_format):
+    _name = name.rsplit("/", 1)[-1]
+    return _name.startswith(
+        start.strftime(partitions[partition]["name_format"]) +
+        ".part-") and _name.endswith(file_extensions[columnar_format])
+
+
+def get_schema():
+    return pa.schema([("timestamp", pa.timestamp("s", tz="UTC")),
+                      ("equipment_tag", pa.string()),
+                      ("value", pa.float64())])
+
+
+def to_table(epochs, equipment_tags, values):
+    return pa.table(
+        [
+            pa.array(epochs, type=pa.int64()).cast(
+                pa.timestamp("s", tz="UTC")),
+            pa.array(equipment_tags, type=pa.string()),
+            pa.array(values, type=pa.float64())
+        ],
+        schema=get_schema())
+
+
+def merge_columns(sources):
+    # (epochs, equipment_tags, values) of several files of one partition;
+    # a minute belongs to the first source that has it, later sources
+    # only add the minutes it lacks
+    _epochs = []
+    _equipment_tags = []
+    _values = []
+    _taken = set()
+    for _source_epochs, _source_tags, _source_values in sources:
+        _source_taken = set(_source_epochs) - _taken
+        for _epoch, _equipment_tag, _value in zip(_source_epochs,
+                                                  _source_tags,
+                                                  _source_values):
+            if _epoch in _source_taken:
+                _epochs.append(_epoch)
+                _equipment_tags.append(_equipment_tag)
+                _values.append(_value)
+        _taken.update(_source_taken)
+    _order = sorted(range(len(_epochs)), key=_epochs.__getitem__)
+    return ([_epochs[_index] for _index in _order],
+            [_equipment_tags[_index] for _index in _order],
+            [_values[_index] for _index in _order])
+
+
+def chunks_to_table(epochs, equipment_tags, values):
+    # to_table over lists of chunks, each a list or a numpy array
+    if len(epochs) == 0:
+        return to_table([], [], [])
+    return pa.table(
+        [
+            pa.concat_arrays([
+                pa.array(_chunk, type=pa.int64()) for _chunk in epochs
+            ]).cast(pa.timestamp("s", tz="UTC")),
+            pa.concat_arrays([
+                pa.array(_chunk, type=pa.string())
+                for _chunk in equipment_tags
+            ]),
+            pa.concat_arrays(
+                [pa.array(_chunk, type=pa.float64()) for _chunk in values])
+        ],
+        schema=get_schema())
+
+
+def to_bytes(table, columnar_format):
+    sink = pa.BufferOutputStream()
+    if columnar_format == "parquet":
+        pa.parquet.write_table(table, sink)
+    else:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_bytes(data, columnar_format):
+    if columnar_format == "parquet":
+        return pa.parquet.read_table(pa.BufferReader(data))
+    return pa.ipc.open_file(pa.BufferReader(data)).read_all()
+
+
+def table_to_columns(table):
+    # parquet keeps timestamps in milliseconds, so normalise the unit first
+    epochs = table.column("timestamp").cast(pa.timestamp(
+        "s", tz="UTC")).cast(pa.int64()).to_pylist()
+    return (epochs, table.column("equipment_tag").to_pylist(),
+            table.column("value").to_pylist())
+
+
+def records_to_columns(records):
+    # minute files hold the json produced by write_records
+    epochs = []
+    equipment_tags = []
+    values = []
+    for record in records:
+        epochs.append(to_epoch(parse_timestamp(record["timestamp"])))
+        equipment_tags.append(record["equipment_tag"])
+        values.append(record["value"])
+    return epochs, equipment_tags, values
+
+
+class ColumnarBuffer():
+    def __init__(self, partition, columnar_format):
+        check_columnar(partition, columnar_format)
+        self.partition = partition
+        self.columnar_format = columnar_format
+        self.start = None
+        self.first = None
+        self.last = None
+        self.epochs = []
+        self.equipment_tags = []
+        self.values = []
+
+    def is_empty(self):
+        return self.start is None
+
+    def append(self, epochs, equipment_tags, values):
+        # columns are kept as chunks and only joined for the table
+        if len(epochs) > 0:
+            self.epochs.append(epochs)
+            self.equipment_tags.append(equipment_tags)
+            self.values.append(values)
+
+    def add(self, new_timestamp, records):
+        # returns the partition that new_timestamp closed, if any
+        _finished = None
+        _start = partition_start(new_timestamp, self.partition)
+        if self.start is not None and _start != self.start:
+            _finished = self.take()
+        if self.start is None:
+            self.start = _start
+            self.first = new_timestamp
+        self.last = new_timestamp
+        _batches = get_batches(records)
+        if _batches is not None:
+            for _batch in _batches:
+                self.append(
+                    np.full(len(_batch), to_epoch(_batch.timestamp),
+                            dtype=np.int64), _batch.get_tags(),
+                    _batch.values)
+            return _finished
+        # samples of one window may lie at different seconds
+        _epochs = []
+        _equipment_tags = []
+        _values = []
+        _timestamp = None
+        for record in records:
+            if record.timestamp is not _timestamp:
+                _timestamp = record.timestamp
+                _epoch = to_epoch(_timestamp)
+            _epochs.append(_epoch)
+            _equipment_tags.append(record.equipment_tag)
+            _values.append(record.value)
+        self.append(_epochs, _equipment_tags, _values)
+        return _finished
+
+    def is_complete(self, window):
+        # the partition's last window is buffered
+        return self.last is not None and partition_start(
+            self.last + window, self.partition) != self.start
+
+    def file_name(self):
+        # nothing is read back, a partition this buffer did not start is
+        # written as a part file
+        if self.first == self.start:
+            return partition_file_name(self.start, self.partition,
+                                       self.columnar_format)
+        return part_file_name(self.start, self.first, self.partition,
+                              self.columnar_format)
+
+    def current(self):
+        # (partition start, file name, table)
+        return self.start, self.file_name(), chunks_to_table(
+            self.epochs, self.equipment_tags, self.values)
+
+    def take(self):
+        _finished = self.current()
+        self.start = None
+        self.first = None
+        self.last = None
+        self.epochs = []
+        self.equipment_tags = []
+        self.values = []
+        return _finished
@@ -0,0 +1,76 @@
+import hashlib
+import os
+
+import numpy as np
+
+# every draw is a hash of (seed, tag, epoch minute, stream) instead of the
+# next number of a shared generator, so any value can be recomputed on its
+# own and chunking or the worker count cannot change the output
+streams = {
+    "value": 0,
+    "anomaly": 1,
+    "step_event": 2,
+    "step_sign": 3,
+    "spike_event": 4,
+    "spike_sign": 5,
+    "noise_radius": 6,
+    "noise_angle": 7,
+    "initial": 8
+}
+
+default_seed = 0
+
+_golden_gamma = np.uint64(0x9E3779B97F4A7C15)
+_stream_gamma = np.uint64(0xD1B54A32D192ED03)
+_mix_multipliers = (np.uint64(0xBF58476D1CE4E5B9),
+                    np.uint64(0x94D049BB133111EB))
+_shifts = (np.uint64(30), np.uint64(27), np.uint64(31))
+_to_unit = 2.0**-53
+
+
+def get_seed():
+    return int(os.environ.get("GENERATOR_SEED", default_seed))
+
+
+def get_tag_key(tag):
+    # hashed from the name, so reordering the registry keeps every series
+    return int.from_bytes(
+        hashlib.blake2b(tag.encode("utf-8"), digest_size=8).digest(),
+        "little")
+
+
+def mix(keys):
+    # splitmix64 finaliser, uint64 arithmetic wraps as intended
+    keys = (keys ^ (keys >> _shifts[0])) * _mix_multipliers[0]
+    keys = (keys ^ (keys >> _shifts[1])) * _mix_multipliers[1]
+    return keys ^ (keys >> _shifts[2])
+
+
+class CounterRandom():
+    def __init__(self, seed, tag_keys):
+        self.seed = seed
+        self.tag_keys = np.asarray(tag_keys, dtype=np.uint64)
+        _seed_key = mix(np.array([seed & 0xFFFFFFFFFFFFFFFF],
+                                 dtype=np.uint64))
+        self.keys = mix(self.tag_keys ^ _seed_key)
+
+    def take(self, columns):
+        return CounterRandom(self.seed, self.tag_keys[columns])
+
+    def random(self, epoch_minutes, stream):
+        # epoch_minutes is (minutes x tags), one uniform in [0, 1) each
+        _counters = np.asarray(epoch_minutes).astype(np.uint64)
+        _keys = self.keys + np.array([streams[stream]],
+                                     dtype=np.uint64) * _stream_gamma
+        _bits = mix(_keys + _counters * _golden_gamma)
+        return (_bits >> np.uint64(11)).astype(np.float64) * _to_unit
+
+    def uniform(self, low, high, epoch_minutes, stream):
+        return low + (high - low) * self.random(epoch_minutes, stream)
+
+    def normal(self, epoch_minutes):
+        # Box-Muller over two streams of the same counters
+        _radius = np.sqrt(-2.0 * np.log1p(
+            -self.random(epoch_minutes, "noise_radius")))
+        return _radius * np.cos(
+            2.0 * np.pi * self.random(epoch_minutes, "noise_angle"))
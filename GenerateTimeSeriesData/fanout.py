@@ -0,0 +1,244 @@
+import logging
+import os
+import queue
+import sys
+import threading
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .budget import TimeBudget, get_progress_report
+from .generation import WindowGenerator
+from .registry import get_registry
+from .serializer import format_timestamp
+from .sinks import create_sink
+from .storage_layer import BaseLayer
+from .telemetry import bind_context, get_summary, metrics, stage
+from .value_generator import pending_minutes, step
+
+_stop = object()
+
+
+class SinkWriter():
+    def __init__(self, sink, last_timestamp, queue_depth=2):
+        # one thread per sink writes its batches in order and moves its
+        # watermark after each one; put() blocks once queue_depth batches
+        # wait, so generation runs at the pace of the slowest sink
+        self.sink = sink
+        self.last_timestamp = last_timestamp
+        self.written_minutes = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.thread = threading.Thread(target=bind_context(self.drain),
+                                       daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            batch = self.queue.get()
+            if batch is _stop:
+                return
+            if self.error is not None:
+                continue
+            # windows this sink already has are skipped
+            batch = [
+                x for x in batch if x['new_timestamp'] > self.last_timestamp
+            ]
+            if len(batch) == 0:
+                continue
+            try:
+                with stage("sink", sink=self.sink.name,
+                           minutes=len(batch)):
+                    self.sink.write_batch(batch)
+                    self.sink.write_watermark(batch[-1]['new_timestamp'],
+                                              batch[-1]['last_records'])
+            except Exception as error:
+                # a failed sink stops here, the others carry on
+                logging.exception("sink %s failed" % self.sink.name)
+                metrics.add("sink_failures")
+                self.error = error
+                continue
+            self.last_timestamp = batch[-1]['new_timestamp']
+            self.written_minutes = self.written_minutes + len(batch)
+
+    def put(self, batch):
+        if self.error is not None:
+            return
+        if self.queue.full():
+            metrics.add("backpressure_waits")
+        self.queue.put(batch)
+
+    def close(self):
+        self.queue.put(_stop)
+        self.thread.join()
+
+
+class BusinessLayer(BaseLayer):
+    def __init__(self, current_datetime, sinks, enable_anomaly, window=step):
+        # one generation core for every sink; every sink gets one file per
+        # window, holding the samples of each tag at its own interval
+        self.sinks = sinks
+        self.current_datetime = current_datetime
+        self.enable_anomaly = enable_anomaly
+        self.window = window
+        for sink in sinks:
+            sink.set_window(window)
+
+    def check_window(self, registry):
+        # a window holds whole samples of every tag, or falls between them
+        _window_ms = self.window // timedelta(milliseconds=1)
+        if _window_ms <= 0 or self.window % timedelta(milliseconds=1):
+            raise ValueError("window must be a whole number of milliseconds")
+        for _interval_ms in np.unique(registry.interval_ms).tolist():
+            if _window_ms % _interval_ms != 0 and \
+                    _interval_ms % _window_ms != 0:
+                raise ValueError(
+                    "window of %s ms does not line up with an interval of "
+                    "%s ms" % (str(_window_ms), str(_interval_ms)))
+            if (_interval_ms % 1000 != 0 or _window_ms % 1000 != 0) and \
+                    not all(_sink.supports_sub_second()
+                            for _sink in self.sinks):
+                raise ValueError("columnar output keeps whole seconds only")
+
+    def iter_records_to_write(self, last_record_time, previous_records,
+                              windows, chunk_windows):
+        # batches of chunk_windows windows, each with the samples of every
+        # tag that fall into it
+        return WindowGenerator(previous_records, self.enable_anomaly,
+                               self.window).iter_windows(
+                                   last_record_time, windows, chunk_windows)
+
+    @staticmethod
+    def get_sink_names():
+        return [
+            _name.strip()
+            for _name in os.environ.get("GENERATOR_SINKS", "adls").split(",")
+            if _name.strip()
+        ]
+
+    def read_watermarks(self):
+        # generation starts at the sink that is furthest behind
+        _watermarks = [_sink.read_watermark() for _sink in self.sinks]
+        for _sink, (_last_timestamp, _records) in zip(self.sinks,
+                                                      _watermarks):
+            self.logme("\nSink %s at %s" %
+                       (_sink.name, format_timestamp(_last_timestamp)))
+        return _watermarks, min(_watermarks, key=lambda x: x[0])
+
+    def process(self, chunk_windows=60, queue_depth=2, time_budget=None):
+        if time_budget is None:
+            time_budget = TimeBudget(None)
+        self.check_window(get_registry())
+        _counters_before = metrics.snapshot()["counters"]
+        _watermarks, (_last_record_time,
+                      _previous_records) = self.read_watermarks()
+        _windows = pending_minutes(_last_record_time, self.current_datetime,
+                                   self.window)
+        writers = [
+            SinkWriter(_sink, _last_timestamp, queue_depth)
+            for _sink, (_last_timestamp, _records) in zip(
+                self.sinks, _watermarks)
+        ]
+        try:
+            for records_to_write in self.iter_records_to_write(
+                    _last_record_time, _previous_records, _windows,
+                    chunk_windows):
+                # the rest of the backlog is left to later ticks
+                if time_budget.is_exhausted():
+                    break
+                for writer in writers:
+                    writer.put(records_to_write)
+                if all(writer.error is not None for writer in writers):
+                    break
+        finally:
+            for writer in writers:
+                writer.close()
+        report = self.report_progress(_counters_before, writers,
+                                      _last_record_time, _windows,
+                                      time_budget)
+        _errors = [writer.error for writer in writers
+                   if writer.error is not None]
+        if len(_errors) > 0:
+            raise _errors[0]
+        return report
+
+    def report_progress(self, counters_before, writers, last_record_time,
+                        windows, time_budget):
+        # a window counts as written once every sink has it; the report
+        # counts windows, which are minutes by default
+        _written_windows = int(
+            (min(writer.last_timestamp for writer in writers) -
+             last_record_time) / self.window)
+        report = get_progress_report(windows, _written_windows,
+                                     time_budget.elapsed(),
+                                     time_budget.seconds)
+        report.update(get_summary(counters_before, report["elapsed_seconds"]))
+        report["sinks"] = {
+            writer.sink.name: {
+                "watermark": format_timestamp(writer.last_timestamp),
+                "written_minutes": writer.written_minutes,
+                "failed": writer.error is not None
+            }
+            for writer in writers
+        }
+        metrics.record("backlog_minutes", report["backlog_minutes"])
+        self.logme(
+            "\nBacklog %(backlog_minutes)s minute(s), wrote "
+            "%(written_minutes)s, %(remaining_minutes)s left, "
+            "%(records_per_second)s records/s, "
+            "%(bytes_per_second)s bytes/s, sinks %(sinks)s" % report)
+        return report
+
+    @classmethod
+    def run(cls,
+            current_datetime,
+            enable_anomaly,
+            sink_names=None,
+            engine=None,
+            output_mode="json",
+            record_encoding="json",
+            use_lease=True,
+            time_budget_seconds=None,
+            max_in_flight=10,
+            window_seconds=None):
+        # the budget covers the whole invocation, setup included
+        time_budget = TimeBudget(time_budget_seconds)
+        sinks = [
+            create_sink(_name,
+                        engine=engine,
+                        max_in_flight=max_in_flight,
+                        output_mode=output_mode,
+                        record_encoding=record_encoding)
+            for _name in (sink_names or cls.get_sink_names())
+        ]
+        bl = cls(current_datetime,
+                 sinks,
+                 enable_anomaly,
+                 window=timedelta(seconds=window_seconds or float(
+                     os.environ.get("GENERATOR_WINDOW_SECONDS", 60))))
+        try:
+            with ExitStack() as stack:
+                # every sink with a lock blob is held for the whole run
+                for sink in sinks:
+                    lease = sink.get_writer_lease() if use_lease else None
+                    if lease is None:
+                        continue
+                    if not lease.acquire():
+                        bl.logme("\nAnother invocation holds the %s lease, "
+                                 "exiting" % sink.name)
+                        return None
+                    stack.enter_context(lease)
+                return bl.process(time_budget=time_budget)
+        finally:
+            for sink in sinks:
+                sink.close()
+
+
+if __name__ == "__main__":
+    # fanout adls,stg,sql
+    utc_timestamp = datetime.utcnow()
+    BusinessLayer.run(utc_timestamp,
+                      False,
+                      sink_names=(sys.argv[1].split(",")
+                                  if len(sys.argv) > 1 else None))
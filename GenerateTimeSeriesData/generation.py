@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+import numpy as np
+
+from .readings import ReadingBatch, ReadingWindow, SensorReading
+from .value_generator import (SampleGenerator, from_epoch_ms, get_timestamps,
+                              step, to_epoch_ms)
+
+# the generation core every layer writes from: the samples of every tag,
+# cut into windows of one file each
+
+
+class WindowGenerator():
+    def __init__(self, previous_records, enable_anomaly, window=step):
+        # every window holds the samples of each tag at its own interval
+        self.previous_records = list(previous_records)
+        self.window = window
+        self.sample_generator = SampleGenerator(
+            [_record.equipment_tag for _record in previous_records],
+            enable_anomaly,
+            previous_values=[_record.value for _record in previous_records],
+            last_timestamps=[
+                _record.timestamp for _record in previous_records
+            ])
+
+    def create_window_records(self, times, columns, values, timestamps,
+                              starts):
+        # one ReadingBatch per sample instant in the window, over slices of
+        # the chunk's arrays; starts are where the instants begin
+        _equipment_tags = self.sample_generator.equipment_tags
+        _batches = []
+        for _start, _stop in zip(starts, starts[1:]):
+            if _start == _stop:
+                continue
+            _time = int(times[_start])
+            _timestamp = timestamps.get(_time)
+            if _timestamp is None:
+                _timestamp = from_epoch_ms(_time)
+                timestamps[_time] = _timestamp
+            _batches.append(
+                ReadingBatch(_timestamp, _equipment_tags,
+                             columns[_start:_stop], values[_start:_stop]))
+        if len(_batches) == 1:
+            return _batches[0]
+        return ReadingWindow(_batches)
+
+    def update_last_records(self, last_records, times, columns, values,
+                            timestamps, records):
+        # the latest sample of every tag, for the watermark; when the last
+        # window has every tag at one instant that batch is it
+        _equipment_tags = self.sample_generator.equipment_tags
+        if isinstance(records, ReadingBatch) and \
+                len(records) == len(_equipment_tags):
+            return records
+        last_records = list(last_records)
+        _columns, _index = np.unique(columns[::-1], return_index=True)
+        _positions = len(columns) - 1 - _index
+        for _column, _time, _value in zip(_columns.tolist(),
+                                          times[_positions].tolist(),
+                                          values[_positions].tolist()):
+            last_records[_column] = SensorReading(timestamps[_time],
+                                                  _equipment_tags[_column],
+                                                  _value)
+        return last_records
+
+    def iter_windows(self, last_record_time, windows, chunk_windows):
+        # batches of chunk_windows windows; the last window of each batch
+        # also carries the last_records its watermark is written from
+        _last_records = self.previous_records
+        _window_ms = self.window // timedelta(milliseconds=1)
+        _end_ms = to_epoch_ms(last_record_time)
+        _offset = 0
+        while windows > 0:
+            _count = min(windows, chunk_windows)
+            _ends = _end_ms + _window_ms * np.arange(1, _count + 1)
+            _times, _columns, _values = self.sample_generator.get_samples(
+                int(_ends[-1]))
+            _bounds = np.searchsorted(_times, _ends, side="right")
+            # the instants of the whole chunk, split at the window bounds
+            _breaks = np.flatnonzero(np.diff(_times)) + 1
+            _firsts = np.searchsorted(_breaks, np.concatenate(
+                ([0], _bounds[:-1])), side="right").tolist()
+            _lasts = np.searchsorted(_breaks, _bounds).tolist()
+            _breaks = _breaks.tolist()
+            _bounds = _bounds.tolist()
+            _timestamps = {}
+            records_to_write = []
+            _start = 0
+            for new_timestamp, _bound, _first, _last in zip(
+                    get_timestamps(last_record_time, _offset + 1, _count,
+                                   self.window), _bounds, _firsts, _lasts):
+                records_to_write.append({
+                    "new_timestamp":
+                    new_timestamp,
+                    "records":
+                    self.create_window_records(
+                        _times, _columns, _values, _timestamps,
+                        [_start] + _breaks[_first:_last] + [_bound])
+                })
+                _start = _bound
+            _last_records = self.update_last_records(
+                _last_records, _times, _columns, _values, _timestamps,
+                records_to_write[-1]["records"])
+            records_to_write[-1]["last_records"] = _last_records
+            _end_ms = int(_ends[-1])
+            _offset = _offset + _count
+            windows = windows - _count
+            yield records_to_write
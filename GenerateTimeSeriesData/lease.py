@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+from azure.core.exceptions import (AzureError, HttpResponseError,
+                                   ResourceNotFoundError)
+
+
+class WriterLease():
+    def __init__(self, lease_client, create_lock_file, lease_duration=60):
+        # lease_client is a BlobLeaseClient or DataLakeLeaseClient on the
+        # lock file, or any stand-in with acquire/renew/release
+        self.lease_client = lease_client
+        self.create_lock_file = create_lock_file
+        self.lease_duration = lease_duration
+        self.stopped = threading.Event()
+        self.renewer = None
+        self.lost = False
+
+    def acquire(self):
+        try:
+            try:
+                self.lease_client.acquire(lease_duration=self.lease_duration)
+            except ResourceNotFoundError:
+                self.create_lock_file()
+                self.lease_client.acquire(lease_duration=self.lease_duration)
+        except HttpResponseError as error:
+            # 409 LeaseAlreadyPresent: another invocation is generating
+            if error.status_code == 409:
+                return False
+            raise
+        self.renewer = threading.Thread(target=self.keep_renewed,
+                                        daemon=True)
+        self.renewer.start()
+        return True
+
+    def keep_renewed(self):
+        _renewed_at = time.monotonic()
+        _wait = self.lease_duration / 2
+        while not self.stopped.wait(_wait):
+            _attempted_at = time.monotonic()
+            try:
+                self.lease_client.renew()
+            except HttpResponseError as error:
+                # the conditional watermark write still refuses to clobber
+                # whoever took over
+                logging.warning("generator lease lost: %s" % str(error))
+                self.lost = True
+                return
+            except AzureError as error:
+                # a network error may pass, renewing is retried until the
+                # lease would have run out
+                _wait = self.lease_duration / 10
+                if _attempted_at + _wait - _renewed_at >= \
+                        self.lease_duration:
+                    logging.warning("generator lease lost: %s" % str(error))
+                    self.lost = True
+                    return
+                logging.warning("renewing the generator lease failed, "
+                                "retrying: %s" % str(error))
+                continue
+            _renewed_at = _attempted_at
+            _wait = self.lease_duration / 2
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+            self.renewer = None
+            if not self.lost:
+                self.lease_client.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
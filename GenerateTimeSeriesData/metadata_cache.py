@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+# both caches live at module level, so they last as long as the worker
+# process rather than one timer tick
+
+# anomaly.json is re-validated against its etag after this many seconds
+default_ttl_seconds = 300
+
+
+def get_ttl_seconds():
+    return float(
+        os.environ.get("METADATA_CACHE_SECONDS", default_ttl_seconds))
+
+
+class DirectoryCache():
+    def __init__(self, max_entries=10000):
+        # directories this worker has already created, per file system
+        self.max_entries = max_entries
+        self.directories = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.directories
+
+    def add(self, key):
+        with self.lock:
+            if len(self.directories) >= self.max_entries:
+                self.directories.clear()
+            self.directories.add(key)
+
+    def discard(self, key):
+        with self.lock:
+            self.directories.discard(key)
+
+
+class ConfigCache():
+    def __init__(self, ttl_seconds=None):
+        # name -> (value, etag, fetched_at)
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # the cached (value, etag), and whether it is still inside its ttl
+        with self.lock:
+            _entry = self.entries.get(key)
+        if _entry is None:
+            return None, None, False
+        _ttl = self.ttl_seconds if self.ttl_seconds is not None else \
+            get_ttl_seconds()
+        return _entry[0], _entry[1], time.monotonic() - _entry[2] < _ttl
+
+    def put(self, key, value, etag):
+        with self.lock:
+            self.entries[key] = (value, etag, time.monotonic())
+
+
+directories = DirectoryCache()
+configs = ConfigCache()
@@ -0,0 +1,84 @@
+import queue
+import threading
+
+from .telemetry import bind_context, metrics
+
+_stop = object()
+
+
+class UploadPipeline():
+    def __init__(self, upload, queue_depth=20, max_in_flight=10):
+        # upload(payload) runs on one of max_in_flight threads; put() blocks
+        # once queue_depth payloads wait for a thread, which is what pauses
+        # generation when storage slows down
+        self.upload = bind_context(upload)
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        # uploads finish out of order, the watermark only takes the
+        # unbroken prefix of minutes
+        self.finished = {}
+        self.next_index = 0
+        self.confirmed = None
+        self.error = None
+        self.uploaders = [
+            threading.Thread(target=self.drain, daemon=True)
+            for _ in range(max_in_flight)
+        ]
+        for uploader in self.uploaders:
+            uploader.start()
+
+    def drain(self):
+        while True:
+            _item = self.queue.get()
+            if _item is _stop:
+                return
+            _index, payload, marker = _item
+            try:
+                if self.error is None:
+                    self.upload(payload)
+                    self.confirm(_index, marker)
+            except Exception as error:
+                with self.lock:
+                    if self.error is None:
+                        self.error = error
+
+    def confirm(self, index, marker):
+        with self.lock:
+            self.finished[index] = marker
+            while self.next_index in self.finished:
+                self.confirmed = self.finished.pop(self.next_index)
+                self.next_index = self.next_index + 1
+
+    def put(self, payload, marker):
+        # marker comes back through confirmed once this payload and every
+        # one before it are uploaded
+        if self.error is not None:
+            raise self.error
+        if self.queue.full():
+            metrics.add("backpressure_waits")
+        self.queue.put((self.submitted, payload, marker))
+        self.submitted = self.submitted + 1
+
+    def close(self):
+        for _ in self.uploaders:
+            self.queue.put(_stop)
+        for uploader in self.uploaders:
+            uploader.join()
+        if self.error is not None:
+            raise self.error
+        return self.confirmed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # the producer failed, let the queued uploads finish and keep its
+        # exception
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,81 @@
+import numpy as np
+
+# a backlog is millions of readings, so they are kept as arrays per instant
+# and only turned into SensorReading objects where an api needs one each
+
+
+class SensorReading():
+    __slots__ = ("timestamp", "equipment_tag", "value")
+
+    def __init__(self, timestamp, equipment_tag, value):
+        self.timestamp = timestamp
+        self.equipment_tag = equipment_tag
+        self.value = value
+
+
+class ReadingBatch():
+    # the readings of one instant: a shared timestamp, tag_ids indexing
+    # equipment_tags and a float64 array of values
+    __slots__ = ("timestamp", "equipment_tags", "tag_ids", "values")
+
+    def __init__(self, timestamp, equipment_tags, tag_ids, values):
+        self.timestamp = timestamp
+        self.equipment_tags = equipment_tags
+        self.tag_ids = tag_ids
+        self.values = values
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+    def __iter__(self):
+        for _tag_id, _value in zip(self.tag_ids.tolist(),
+                                   self.values.tolist()):
+            yield SensorReading(self.timestamp, self.equipment_tags[_tag_id],
+                                _value)
+
+    def __getitem__(self, index):
+        return SensorReading(self.timestamp,
+                             self.equipment_tags[int(self.tag_ids[index])],
+                             float(self.values[index]))
+
+    def get_tags(self):
+        _equipment_tags = self.equipment_tags
+        return [_equipment_tags[_tag_id] for _tag_id in self.tag_ids.tolist()]
+
+
+class ReadingWindow():
+    # the batches of one window in time order, for windows that span
+    # several sample instants
+    __slots__ = ("batches",)
+
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __len__(self):
+        return sum(len(_batch) for _batch in self.batches)
+
+    def __iter__(self):
+        for _batch in self.batches:
+            yield from _batch
+
+
+def get_batches(records):
+    # the ReadingBatch parts of records, None for a plain list of readings
+    if isinstance(records, ReadingBatch):
+        return [records]
+    if isinstance(records, ReadingWindow):
+        return records.batches
+    return None
+
+
+def create_batch(previous_records, timestamp, values):
+    # the next reading of every tag in previous_records; values is copied,
+    # callers reuse their row for the next batch
+    if isinstance(previous_records, ReadingBatch):
+        return ReadingBatch(timestamp, previous_records.equipment_tags,
+                            previous_records.tag_ids,
+                            np.array(values, dtype=np.float64))
+    _equipment_tags = [_record.equipment_tag for _record in previous_records]
+    return ReadingBatch(timestamp, _equipment_tags,
+                        np.arange(len(_equipment_tags)),
+                        np.array(values, dtype=np.float64))
@@ -0,0 +1,232 @@
+import csv
+import json
+import logging
+import os
+
+import numpy as np
+
+from .counter_random import get_tag_key
+from .readings import SensorReading
+from .signals import (default_interval, get_parameter_default, models,
+                      parameter_names, to_interval_ms)
+
+# EQUIPMENT_REGISTRY_PATH points at a .json, .yaml/.yml or .csv file with
+# the same fields as equipment.json
+default_registry_path = os.path.join(os.path.dirname(__file__),
+                                     "equipment.json")
+
+csv_fields = ["tag", "min", "max", "unit", "group", "model", "interval"
+              ] + parameter_names
+
+_registries = {}
+
+
+class EquipmentRegistry():
+    def __init__(self,
+                 tags,
+                 min_values,
+                 max_values,
+                 units=None,
+                 groups=None,
+                 model_ids=None,
+                 parameters=None,
+                 intervals=None):
+        # one slot per tag id, the id being the tag's position in the config
+        self.tags = list(tags)
+        self.tag_ids = {}
+        for _tag_id, _tag in enumerate(self.tags):
+            if _tag in self.tag_ids:
+                raise ValueError("duplicate equipment tag: %s" % _tag)
+            self.tag_ids[_tag] = _tag_id
+        self.tag_keys = np.array([get_tag_key(_tag) for _tag in self.tags],
+                                 dtype=np.uint64)
+        self.min_values = np.asarray(min_values, dtype=np.float64)
+        self.max_values = np.asarray(max_values, dtype=np.float64)
+        if len(self.min_values) != len(self.tags) or \
+                len(self.max_values) != len(self.tags):
+            raise ValueError("every equipment tag needs a min and a max")
+        _inverted = np.flatnonzero(self.min_values > self.max_values)
+        if len(_inverted) > 0:
+            raise ValueError("min is above max for equipment tag: %s" %
+                             self.tags[_inverted[0]])
+        self.units = list(units) if units is not None else [""] * len(
+            self.tags)
+        _groups = list(groups) if groups is not None else [""] * len(
+            self.tags)
+        self.group_names = sorted(set(_groups))
+        _group_ids = {_name: _id for _id, _name in enumerate(self.group_names)}
+        self.group_ids = np.array([_group_ids[_group] for _group in _groups],
+                                  dtype=np.int32)
+        # model_ids index signals.models, parameters holds one float array
+        # per name in signals.parameter_names
+        self.model_ids = np.zeros(len(self.tags), dtype=np.int8) \
+            if model_ids is None else np.asarray(model_ids, dtype=np.int8)
+        self.parameters = {
+            _name: np.asarray(parameters[_name], dtype=np.float64)
+            if parameters is not None else np.zeros(len(self.tags))
+            for _name in parameter_names
+        }
+        # sampling interval per tag in milliseconds, a minute by default
+        self.interval_ms = np.array([
+            to_interval_ms(_interval) for _interval in (
+                intervals if intervals is not None else [default_interval] *
+                len(self.tags))
+        ], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return tag in self.tag_ids
+
+    def get_ids(self, tags):
+        return np.array([self.tag_ids[_tag] for _tag in tags],
+                        dtype=np.int64)
+
+    def get_unit(self, tag):
+        return self.units[self.tag_ids[tag]]
+
+    def get_group(self, tag):
+        return self.group_names[self.group_ids[self.tag_ids[tag]]]
+
+    def get_group_tags(self, group):
+        _group_id = self.group_names.index(group)
+        return [
+            self.tags[_tag_id]
+            for _tag_id in np.flatnonzero(self.group_ids == _group_id)
+        ]
+
+    def get_new_tags(self, tags):
+        # config order, so tags that join later always line up the same way
+        _known = set(tags)
+        return [_tag for _tag in self.tags if _tag not in _known]
+
+    def get_removed_tags(self, tags):
+        return [_tag for _tag in tags if _tag not in self.tag_ids]
+
+
+def entries_to_registry(entries, groups=None):
+    # fields missing from an entry fall back to its group's, then to the
+    # model defaults in signals
+    groups = groups or {}
+    _tags = []
+    _min_values = []
+    _max_values = []
+    _units = []
+    _groups = []
+    _model_ids = []
+    _intervals = []
+    _parameters = {_name: [] for _name in parameter_names}
+    for entry in entries:
+        _group = entry.get("group") or ""
+        _defaults = groups.get(_group, {})
+        _min = entry.get("min")
+        _max = entry.get("max")
+        _tags.append(entry["tag"])
+        _min_values.append(
+            float(_min if _min not in (None, "") else _defaults["min"]))
+        _max_values.append(
+            float(_max if _max not in (None, "") else _defaults["max"]))
+        _units.append(entry.get("unit") or _defaults.get("unit", ""))
+        _groups.append(_group)
+        _model = entry.get("model") or _defaults.get("model", "uniform")
+        if _model not in models:
+            raise ValueError("unknown signal model %s for equipment tag: %s" %
+                             (_model, entry["tag"]))
+        _model_ids.append(models.index(_model))
+        _interval = entry.get("interval")
+        if _interval in (None, ""):
+            _interval = _defaults.get("interval", default_interval)
+        _intervals.append(float(_interval))
+        for _name in parameter_names:
+            _value = entry.get(_name)
+            if _value in (None, ""):
+                _value = _defaults.get(_name)
+            if _value in (None, ""):
+                _value = get_parameter_default(_model, _name)
+            _parameters[_name].append(float(_value))
+    return EquipmentRegistry(_tags, _min_values, _max_values, _units, _groups,
+                             _model_ids, _parameters, _intervals)
+
+
+def load_yaml(stream):
+    # PyYAML is optional, only yaml configs need it
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError("PyYAML is required for a yaml equipment registry")
+    return yaml.safe_load(stream)
+
+
+def load_registry(path):
+    _extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="") as stream:
+        if _extension == ".csv":
+            return entries_to_registry(csv.DictReader(stream))
+        if _extension in (".yaml", ".yml"):
+            obj = load_yaml(stream)
+        elif _extension == ".json":
+            obj = json.load(stream)
+        else:
+            raise ValueError("unknown equipment registry format: %s" % path)
+    return entries_to_registry(obj["tags"], obj.get("groups"))
+
+
+def get_registry_path():
+    return os.environ.get("EQUIPMENT_REGISTRY_PATH", default_registry_path)
+
+
+def get_registry(path=None):
+    # loaded once per worker, and again only when the file changes
+    path = path or get_registry_path()
+    _modified = os.path.getmtime(path)
+    _cached = _registries.get(path)
+    if _cached is None or _cached[0] != _modified:
+        registry = load_registry(path)
+        logging.info("loaded %s equipment tag(s) from %s" %
+                     (str(len(registry)), path))
+        _cached = (_modified, registry)
+        _registries[path] = _cached
+    return _cached[1]
+
+
+def join_registry(last_timestamp, last_records, record_class=SensorReading):
+    # tags new to the config start from the watermark, tags no longer in
+    # it are dropped; every layer's watermark goes through here
+    registry = get_registry()
+    _removed = registry.get_removed_tags(
+        [_record.equipment_tag for _record in last_records])
+    if len(_removed) > 0:
+        logging.info("dropping %s tag(s) no longer in the registry" %
+                     str(len(_removed)))
+        last_records = [
+            _record for _record in last_records
+            if _record.equipment_tag in registry
+        ]
+    _new_tags = registry.get_new_tags(
+        [_record.equipment_tag for _record in last_records])
+    if len(_new_tags) == 0:
+        return list(last_records)
+    logging.info("adding %s tag(s) from the registry" % str(len(_new_tags)))
+    return list(last_records) + [
+        record_class(timestamp=last_timestamp, equipment_tag=_tag, value=None)
+        for _tag in _new_tags
+    ]
+
+
+def check_minute_intervals(equipment_tags, registry=None):
+    # the adls, stg and sql layers write one reading per tag and minute,
+    # tags sampled at any other interval are only written by fanout
+    if registry is None:
+        registry = get_registry()
+    _minute_ms = to_interval_ms(default_interval)
+    _other_tags = [
+        _tag for _tag, _interval_ms in zip(
+            equipment_tags, registry.interval_ms[registry.get_ids(
+                equipment_tags)].tolist()) if _interval_ms != _minute_ms
+    ]
+    if len(_other_tags) > 0:
+        raise ValueError(
+            "%s tag(s) sample at an interval other than %s s, e.g. %s; "
+            "only GENERATOR_BACKEND=fanout writes those" %
+            (str(len(_other_tags)), str(default_interval), _other_tags[0]))
@@ -0,0 +1,198 @@
+import functools
+import gzip
+import json
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+from .readings import get_batches
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# minute files are a json array or one record per line, optionally
+# compressed; last-records.json only takes the compression
+encodings = {
+    "json": {
+        "extension": ".json",
+        "content_type": "application/json",
+        "content_encoding": None
+    },
+    "ndjson": {
+        "extension": ".ndjson",
+        "content_type": "application/x-ndjson",
+        "content_encoding": None
+    },
+    "ndjson-gzip": {
+        "extension": ".ndjson.gz",
+        "content_type": "application/x-ndjson",
+        "content_encoding": "gzip"
+    },
+    "ndjson-zstd": {
+        "extension": ".ndjson.zst",
+        "content_type": "application/x-ndjson",
+        "content_encoding": "zstd"
+    }
+}
+
+_gzip_magic = b"\x1f\x8b"
+_zstd_magic = b"\x28\xb5\x2f\xfd"
+
+# json-encoded tag names, shared by every batch of the worker
+_encoded_strings = {}
+
+
+def encode_string(value):
+    _encoded = _encoded_strings.get(value)
+    if _encoded is None:
+        _encoded = encode_basestring_ascii(value)
+        _encoded_strings[value] = _encoded
+    return _encoded
+
+
+def encode_value(value):
+    # same spelling as json.dumps for the values a reading can hold
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "Infinity"
+    if value == float("-inf"):
+        return "-Infinity"
+    return float.__repr__(value)
+
+
+# every record of a window shares its timestamp and a watermark repeats
+# one timestamp per tag, so both directions are cached
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(timestamp):
+    # whole minutes keep their "%H:%M:00Z" spelling, sub-second samples
+    # get milliseconds
+    if timestamp.microsecond:
+        return timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (
+            timestamp.microsecond // 1000)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(value):
+    if "." in value:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def get_window_name(timestamp, window):
+    # one file per window, minute windows keep the %Y-%m-%d-%H-%M names
+    if window.total_seconds() % 60 == 0:
+        return timestamp.strftime("%Y-%m-%d-%H-%M")
+    if window.microseconds == 0:
+        return timestamp.strftime("%Y-%m-%d-%H-%M-%S")
+    return timestamp.strftime("%Y-%m-%d-%H-%M-%S-") + "%03d" % (
+        timestamp.microsecond // 1000)
+
+
+def check_encoding(encoding):
+    if encoding not in encodings:
+        raise ValueError("unknown record encoding: %s" % encoding)
+    if encodings[encoding]["content_encoding"] == "zstd" and zstandard is None:
+        raise ImportError("zstandard is required for %s output" % encoding)
+
+
+def is_record_file(name):
+    for encoding in encodings.values():
+        if name.endswith(encoding["extension"]):
+            return True
+    return False
+
+
+def compress(data, content_encoding):
+    if content_encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if content_encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data):
+    # sniffed rather than trusted to the name, a transport may already
+    # have undone the content-encoding
+    if data[:2] == _gzip_magic:
+        return gzip.decompress(data)
+    if data[:4] == _zstd_magic:
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd files")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def parse_records(data):
+    data = decompress(data).lstrip()
+    if data[:1] == b"[":
+        return json.loads(data)
+    return [json.loads(_line) for _line in data.splitlines() if _line.strip()]
+
+
+def parse_last_records(data):
+    return json.loads(decompress(data))
+
+
+def encode_batch_parts(batches):
+    # straight from the arrays, no SensorReading per record
+    _parts = []
+    for _batch in batches:
+        _prefix = '{"timestamp": ' + encode_basestring_ascii(
+            format_timestamp(_batch.timestamp)) + ', "equipment_tag": '
+        _equipment_tags = _batch.equipment_tags
+        for _tag_id, _value in zip(_batch.tag_ids.tolist(),
+                                   _batch.values.tolist()):
+            _parts.append(_prefix + encode_string(_equipment_tags[_tag_id]) +
+                          ', "value": ' + encode_value(_value) + '}')
+    return _parts
+
+
+def encode_record_parts(records):
+    # records of one minute share their timestamp, so it is formatted
+    # once instead of once per record
+    _batches = get_batches(records)
+    if _batches is not None:
+        return encode_batch_parts(_batches)
+    _parts = []
+    _timestamp = None
+    _prefix = None
+    for record in records:
+        if _prefix is None or record.timestamp != _timestamp:
+            _timestamp = record.timestamp
+            _prefix = '{"timestamp": ' + encode_basestring_ascii(
+                format_timestamp(_timestamp)) + \
+                ', "equipment_tag": '
+        _parts.append(_prefix + encode_string(record.equipment_tag) +
+                      ', "value": ' + encode_value(record.value) + '}')
+    return _parts
+
+
+def encode_records(records):
+    return "[" + ", ".join(encode_record_parts(records)) + "]"
+
+
+def serialize_records(records, encoding="json"):
+    # plain json is byte for byte what json.dumps(records,
+    # cls=ComplexEncoder) produced
+    if encoding == "json":
+        return encode_records(records).encode("ascii")
+    _parts = encode_record_parts(records)
+    _data = ("\n".join(_parts) + "\n" if len(_parts) > 0 else "").encode(
+        "ascii")
+    return compress(_data, encodings[encoding]["content_encoding"])
+
+
+def serialize_last_records(last_timestamp, records, encoding="json"):
+    _data = ('{"last_record_timestamp": ' +
+             encode_basestring_ascii(format_timestamp(last_timestamp)) +
+             ', "records": ' + encode_records(records) + '}').encode("ascii")
+    return compress(_data, encodings[encoding]["content_encoding"])
@@ -0,0 +1,167 @@
+import numpy as np
+
+# every model but uniform carries its state in the last value written, so
+# a run resumed from last-records.json continues the same signal. sizes
+# are fractions of the tag's max - min range, rates are per sample, i.e.
+# per minute at the default interval
+models = ["uniform", "random_walk", "drift", "ar1", "daily"]
+
+path_dependent_models = ("random_walk", "drift", "ar1", "daily")
+
+model_defaults = {
+    "uniform": {},
+    "random_walk": {
+        "volatility": 0.01,
+        "drift": 0.0
+    },
+    "drift": {
+        "volatility": 0.002,
+        "drift": 0.001
+    },
+    "ar1": {
+        "phi": 0.95,
+        "noise": 0.02
+    },
+    "daily": {
+        "amplitude": 0.25,
+        "phase": 0.0,
+        "phi": 0.9,
+        "noise": 0.01
+    }
+}
+
+# only used with enable_anomaly; a spike is an outlier that may leave the
+# range (ar1 and daily only) and decays at phi from there, a step shifts
+# the signal and stays until the model pulls it back
+anomaly_defaults = {
+    "spike_probability": 0.001,
+    "spike_size": 0.5,
+    "step_probability": 0.0005,
+    "step_size": 0.25
+}
+
+parameter_names = sorted(
+    set(_name for _defaults in model_defaults.values()
+        for _name in _defaults) | set(anomaly_defaults))
+
+minutes_per_day = 24 * 60
+milliseconds_per_day = minutes_per_day * 60 * 1000
+
+# seconds between two samples of a tag; any whole number of milliseconds
+# that divides a day, so samples sit on the same instants every day
+default_interval = 60
+
+
+def to_interval_ms(interval):
+    _interval_ms = int(round(float(interval) * 1000))
+    if _interval_ms <= 0 or abs(_interval_ms - float(interval) * 1000) > 1e-6 \
+            or milliseconds_per_day % _interval_ms != 0:
+        raise ValueError("interval must be a whole number of milliseconds "
+                         "dividing a day: %s" % str(interval))
+    return _interval_ms
+
+
+def get_parameter_default(model, name):
+    if name in anomaly_defaults:
+        return anomaly_defaults[name]
+    return model_defaults[model].get(name, 0.0)
+
+
+def fold(values, low, high):
+    # reflects values back into [low, high], the walk bounces off a bound
+    _range = high - low
+    _period = np.where(_range > 0, 2 * _range, 1.0)
+    _offset = np.mod(values - low, _period)
+    return np.where(_range > 0,
+                    low + np.where(_offset > _range, _period - _offset,
+                                   _offset), low)
+
+
+def get_events(draw, epoch_minutes, event, probability, size, span):
+    _hits = draw.random(epoch_minutes, event + "_event") < probability
+    _signs = np.where(
+        draw.random(epoch_minutes, event + "_sign") < 0.5, -1.0, 1.0)
+    return np.where(_hits, _signs * size * span, 0.0)
+
+
+def get_daily_cycle(epoch_minutes, mean, amplitude, phase, steps_per_day):
+    return mean + amplitude * np.sin(
+        2 * np.pi * (np.mod(epoch_minutes, steps_per_day) / steps_per_day -
+                     phase))
+
+
+def generate(model,
+             draw,
+             previous,
+             epoch_minutes,
+             low,
+             high,
+             parameters,
+             enable_anomaly,
+             steps_per_day=minutes_per_day):
+    # draw is a counter_random.CounterRandom over these tags, previous the
+    # last value per tag (nan when there is none) and epoch_minutes the
+    # (samples x tags) time of every value to generate, counted in samples
+    # since the epoch: minutes at the default interval
+    _span = high - low
+    _mean = (low + high) / 2
+
+    def shifts_at(_epoch_minutes):
+        if not enable_anomaly:
+            return 0.0
+        return get_events(draw, _epoch_minutes, "step",
+                          parameters["step_probability"],
+                          parameters["step_size"], _span)
+
+    def spikes_at(_epoch_minutes):
+        if not enable_anomaly:
+            return np.zeros(_epoch_minutes.shape)
+        return get_events(draw, _epoch_minutes, "spike",
+                          parameters["spike_probability"],
+                          parameters["spike_size"], _span)
+
+    if epoch_minutes.shape[0] == 0:
+        return np.empty(epoch_minutes.shape)
+    if model in ("random_walk", "drift"):
+        # each sample starts from the rounded value before it, exactly
+        # what a resumed run reads back
+        previous = np.where(
+            np.isnan(previous),
+            np.round(
+                draw.uniform(low, high, epoch_minutes[0] - 1, "initial"), 2),
+            previous)
+        _increments = parameters["drift"] * _span + \
+            parameters["volatility"] * _span * draw.normal(epoch_minutes) + \
+            shifts_at(epoch_minutes)
+        values = np.empty(epoch_minutes.shape)
+        for _row in range(epoch_minutes.shape[0]):
+            previous = np.round(fold(previous + _increments[_row], low, high),
+                                2)
+            values[_row] = previous
+    elif model in ("ar1", "daily"):
+        # the AR(1) recursion around the mean or the daily cycle, resumed
+        # from the rounded value before each sample like the walks
+        _epoch_minutes = np.concatenate([epoch_minutes[:1] - 1,
+                                         epoch_minutes])
+        if model == "daily":
+            _centre = get_daily_cycle(_epoch_minutes, _mean,
+                                      parameters["amplitude"] * _span,
+                                      parameters["phase"], steps_per_day)
+        else:
+            _centre = np.broadcast_to(_mean, _epoch_minutes.shape)
+        previous = np.where(np.isnan(previous), _centre[0], previous)
+        _innovations = parameters["noise"] * _span * \
+            draw.normal(epoch_minutes) + shifts_at(epoch_minutes)
+        # a spike may leave the range, the samples after it decay back
+        _spikes = spikes_at(epoch_minutes)
+        _phi = parameters["phi"]
+        values = np.empty(epoch_minutes.shape)
+        for _row in range(epoch_minutes.shape[0]):
+            previous = np.round(
+                np.clip(
+                    _centre[_row + 1] + _phi * (previous - _centre[_row]) +
+                    _innovations[_row], low, high) + _spikes[_row], 2)
+            values[_row] = previous
+    else:
+        raise ValueError("unknown signal model: %s" % model)
+    return values
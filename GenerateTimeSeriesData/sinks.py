@@ -0,0 +1,325 @@
+import importlib
+import os
+from datetime import datetime
+
+from .columnar import ColumnarBuffer, to_bytes
+from .readings import SensorReading, get_batches
+from .registry import join_registry
+from .serializer import (check_encoding, encodings, get_window_name,
+                         parse_last_records, parse_timestamp,
+                         serialize_last_records, serialize_records)
+from .telemetry import metrics, stage
+from .uploader import ConcurrentUploader
+from .value_generator import step
+
+# GENERATOR_SINKS names the sinks one fan-out run writes to; local and
+# memory need no Azure connection
+sink_modules = {
+    "adls": ".business_layer_adls",
+    "stg": ".business_layer_stg",
+    "sql": ".business_layer"
+}
+
+# where a sink without a watermark starts, as the data lake does
+default_start_timestamp = datetime(2020, 10, 13, 2, 1)
+
+
+class Sink():
+    # a batch is a list of {"new_timestamp", "records"} windows in order,
+    # new_timestamp being the end of the window and records a ReadingBatch,
+    # ReadingWindow or list of readings; every sink keeps its own
+    # watermark, so one that falls behind is caught up on the next run
+    # without rewriting the others
+    name = None
+    window = step
+
+    def set_window(self, window):
+        self.window = window
+
+    def supports_sub_second(self):
+        return True
+
+    def read_watermark(self):
+        # (last timestamp, records of that minute)
+        raise NotImplementedError
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def write_watermark(self, last_timestamp, records):
+        raise NotImplementedError
+
+    def get_writer_lease(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class StorageSink(Sink):
+    # the ADLS and blob DataAccessLayers, one file or partition per minute
+    def __init__(self, name, dal, max_in_flight=10):
+        self.name = name
+        self.dal = dal
+        self.max_in_flight = max_in_flight
+
+    def set_window(self, window):
+        self.window = window
+        self.dal.window = window
+
+    def supports_sub_second(self):
+        return self.dal.columnar_buffer is None
+
+    def read_watermark(self):
+        return self.dal.get_last_records()
+
+    def write_batch(self, batch):
+        # a window shorter than a tag's interval may hold no samples
+        batch = [x for x in batch if len(x['records']) > 0]
+        if self.dal.columnar_buffer is not None:
+            # partitions are built in minute order
+            for x in batch:
+                self.dal.write_records(x['new_timestamp'], x['records'])
+            return
+        with ConcurrentUploader(self.dal.write_records,
+                                self.max_in_flight) as uploader:
+            for x in batch:
+                uploader.submit(x)
+            uploader.flush()
+
+    def write_watermark(self, last_timestamp, records):
+        self.dal.flush_records()
+        self.dal.write_last_records(last_timestamp, records)
+
+    def get_writer_lease(self):
+        return self.dal.get_writer_lease()
+
+
+class SqlSink(Sink):
+    # sensor_reading_2, with the per tag watermark in sensor_watermark
+    name = "sql"
+
+    def __init__(self, dal):
+        self.dal = dal
+        self.tag_watermarks = {}
+
+    def read_watermark(self):
+        _last_records = self.dal.get_last_records()
+        self.tag_watermarks = {
+            _record.equipment_tag: _record.timestamp
+            for _record in _last_records
+        }
+        # tags can stand at different minutes, the sink as a whole is only
+        # as far as its slowest tag
+        _last_timestamp = min(self.tag_watermarks.values())
+        # a tag ahead of it resumes from its reading at that minute, the
+        # samples it already has are regenerated alike and skipped
+        _values = {}
+        if any(_timestamp > _last_timestamp
+               for _timestamp in self.tag_watermarks.values()):
+            _values = self.dal.get_values_at(_last_timestamp)
+        return _last_timestamp, [
+            SensorReading(timestamp=_last_timestamp,
+                          equipment_tag=_record.equipment_tag,
+                          value=_values.get(_record.equipment_tag)
+                          if _record.timestamp > _last_timestamp else
+                          getattr(_record, "value", None))
+            for _record in _last_records
+        ]
+
+    def write_batch(self, batch):
+        rows = []
+        for x in batch:
+            for _timestamp, _equipment_tags, _values in self.iter_columns(
+                    x['records']):
+                for _equipment_tag, _value in zip(_equipment_tags, _values):
+                    # samples this tag already has are skipped
+                    _watermark = self.tag_watermarks.get(_equipment_tag)
+                    if _watermark is not None and _timestamp <= _watermark:
+                        continue
+                    rows.append({
+                        "timestamp": _timestamp,
+                        "equipment_tag": _equipment_tag,
+                        "value": _value
+                    })
+        # insert_batch moves sensor_watermark in the same transaction
+        self.dal.bulk_insert(rows)
+
+    @staticmethod
+    def iter_columns(records):
+        # (timestamp, tags, values) runs, one per batch
+        _batches = get_batches(records)
+        if _batches is None:
+            for _record in records:
+                yield _record.timestamp, [_record.equipment_tag
+                                          ], [_record.value]
+            return
+        for _batch in _batches:
+            yield _batch.timestamp, _batch.get_tags(), _batch.values.tolist()
+
+    def write_watermark(self, last_timestamp, records):
+        for _record in records:
+            self.tag_watermarks[_record.equipment_tag] = _record.timestamp
+
+    def close(self):
+        self.dal.close()
+
+
+class LocalSink(Sink):
+    # a directory laid out like the data lake: %Y/%m/%d/%H minute files or
+    # columnar partitions and their part files, and last-records.json at
+    # the root
+    name = "local"
+
+    def __init__(self,
+                 root,
+                 output_mode="json",
+                 columnar_format="parquet",
+                 record_encoding="json",
+                 start_timestamp=None):
+        check_encoding(record_encoding)
+        self.root = root
+        self.output_mode = output_mode
+        self.columnar_format = columnar_format
+        self.record_encoding = record_encoding
+        self.start_timestamp = start_timestamp or default_start_timestamp
+        self.last_records_name = "last-records.json"
+        self.columnar_buffer = None
+        if output_mode != "json":
+            self.columnar_buffer = ColumnarBuffer(output_mode, columnar_format)
+
+    def supports_sub_second(self):
+        return self.columnar_buffer is None
+
+    def read_file(self, directory, name):
+        try:
+            with open(os.path.join(self.root, directory, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_file(self, directory, name, data):
+        _directory = os.path.join(self.root, directory)
+        os.makedirs(_directory, exist_ok=True)
+        # readers never see half a file
+        _path = os.path.join(_directory, name)
+        with open(_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(_path + ".tmp", _path)
+
+    def read_watermark(self):
+        data = self.read_file("", self.last_records_name)
+        if data is None:
+            return self.start_timestamp, join_registry(
+                self.start_timestamp, [])
+        obj = parse_last_records(data)
+        _last_timestamp = parse_timestamp(obj["last_record_timestamp"])
+        return _last_timestamp, join_registry(_last_timestamp, [
+            SensorReading(parse_timestamp(record["timestamp"]),
+                          record["equipment_tag"], record["value"])
+            for record in obj["records"]
+        ])
+
+    def write_batch(self, batch):
+        for x in batch:
+            if len(x['records']) == 0:
+                continue
+            if self.columnar_buffer is not None:
+                self.buffer_records(x['new_timestamp'], x['records'])
+            else:
+                self.write_records(x['new_timestamp'], x['records'])
+            metrics.add("records_written", len(x['records']))
+
+    def write_records(self, new_timestamp, records):
+        with stage("serialize", records=len(records)):
+            data = serialize_records(records, self.record_encoding)
+        with stage("upload", bytes=len(data)):
+            self.write_file(
+                new_timestamp.strftime("%Y/%m/%d/%H"),
+                get_window_name(new_timestamp, self.window) +
+                encodings[self.record_encoding]["extension"], data)
+        metrics.add("bytes_written", len(data))
+        metrics.add("uploads")
+
+    def get_partition_directory(self, start):
+        return start.strftime("%Y/%m/%d/%H" if self.output_mode ==
+                              "hourly" else "%Y/%m/%d")
+
+    def buffer_records(self, new_timestamp, records):
+        _finished = self.columnar_buffer.add(new_timestamp, records)
+        if _finished is not None:
+            self.write_partition(*_finished)
+
+    def write_partition(self, start, file_name, table):
+        with stage("serialize", records=table.num_rows):
+            data = to_bytes(table, self.columnar_format)
+        with stage("upload", bytes=len(data)):
+            self.write_file(self.get_partition_directory(start), file_name,
+                            data)
+        metrics.add("bytes_written", len(data))
+        metrics.add("uploads")
+
+    def write_watermark(self, last_timestamp, records):
+        # the open partition's minutes so far are written once, later
+        # minutes of it go to a part file of their own
+        if self.columnar_buffer is not None and \
+                not self.columnar_buffer.is_empty():
+            self.write_partition(*self.columnar_buffer.take())
+        self.write_file(
+            "", self.last_records_name,
+            serialize_last_records(last_timestamp, records,
+                                   self.record_encoding))
+
+
+class MemorySink(LocalSink):
+    # LocalSink without the disk; with keep=False only the sizes are kept,
+    # which is what a year long benchmark can afford
+    name = "memory"
+
+    def __init__(self,
+                 output_mode="json",
+                 columnar_format="parquet",
+                 record_encoding="json",
+                 start_timestamp=None,
+                 keep=True):
+        super().__init__(None,
+                         output_mode=output_mode,
+                         columnar_format=columnar_format,
+                         record_encoding=record_encoding,
+                         start_timestamp=start_timestamp)
+        self.keep = keep
+        self.files = {}
+
+    def get_key(self, directory, name):
+        return directory + "/" + name if directory else name
+
+    def read_file(self, directory, name):
+        _size_or_data = self.files.get(self.get_key(directory, name))
+        if isinstance(_size_or_data, bytes):
+            return _size_or_data
+        return None
+
+    def write_file(self, directory, name, data):
+        self.files[self.get_key(directory, name)] = data if self.keep or \
+            name == self.last_records_name else len(data)
+
+
+def create_sink(name, engine=None, max_in_flight=10, output_mode="json",
+                record_encoding="json"):
+    if name == "local":
+        return LocalSink(os.environ.get("LOCAL_SINK_PATH", "output"),
+                         output_mode=output_mode,
+                         record_encoding=record_encoding)
+    if name == "memory":
+        return MemorySink(output_mode=output_mode,
+                          record_encoding=record_encoding)
+    # only the modules of the sinks asked for are imported
+    module = importlib.import_module(sink_modules[name], __package__)
+    if name == "sql":
+        return SqlSink(module.DataAccessLayer(engine))
+    return StorageSink(
+        name,
+        module.DataAccessLayer(max_connections=max_in_flight,
+                               output_mode=output_mode,
+                               record_encoding=record_encoding),
+        max_in_flight)
@@ -0,0 +1,287 @@
+import json
+import logging
+from datetime import datetime
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (ResourceExistsError,
+                                   ResourceModifiedError,
+                                   ResourceNotFoundError)
+
+from .backfill import Backfill, default_shard_minutes
+from .budget import TimeBudget, get_progress_report
+from .columnar import (check_columnar, is_part_file, partition_start,
+                       partitions)
+from .generation import WindowGenerator
+from .lease import WriterLease
+from .readings import SensorReading, create_batch
+from .registry import check_minute_intervals, join_registry
+from .serializer import (decompress, encodings, parse_last_records,
+                         parse_timestamp, serialize_last_records)
+from .telemetry import get_summary, metrics, staged
+from .value_generator import ValueGenerator, pending_minutes, step
+
+# what the ADLS and blob layers share; each keeps its own storage calls
+
+datetime_format = "%Y-%m-%dT%H:%M:00Z"
+
+
+class ComplexEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, SensorReading):
+            return {
+                "timestamp": obj.timestamp,
+                "equipment_tag": obj.equipment_tag,
+                "value": obj.value
+            }
+        if isinstance(obj, datetime):
+            return obj.strftime(datetime_format)
+        # Let the base class default method raise the TypeError
+        return json.JSONEncoder.default(self, obj)
+
+
+class BaseLayer():
+    def __init__(self, args):
+        pass
+
+    def logme(self, message):
+        logging.info(message)
+
+
+class StorageDataAccessLayer(BaseLayer):
+    # subclasses provide write_records, upload_partition and
+    # compact_records, and the client hooks below, over their own clients
+    storage_name = None
+
+    def get_root_client(self, name):
+        # the file or blob client of name at the container root
+        raise NotImplementedError
+
+    def upload_to_client(self, client, data, content_type=None,
+                         content_encoding=None, **kwargs):
+        raise NotImplementedError
+
+    def download_from_client(self, client):
+        raise NotImplementedError
+
+    def get_lease_client(self, client):
+        raise NotImplementedError
+
+    def get_start_timestamp(self):
+        # where a store without a watermark starts
+        raise NotImplementedError
+
+    @staged("get_last_records")
+    def get_last_records(self):
+        try:
+            downloader = self.download_from_client(
+                self.get_root_client(self.last_records_blob_name))
+            obj = parse_last_records(downloader.readall())
+            self.last_records_etag = downloader.properties.etag
+            last_record_timestamp = parse_timestamp(
+                obj["last_record_timestamp"])
+            last_records = [
+                SensorReading(parse_timestamp(record["timestamp"]),
+                              record["equipment_tag"], record["value"])
+                for record in obj["records"]
+            ]
+        except ResourceNotFoundError:
+            last_record_timestamp = self.get_start_timestamp()
+            last_records = []
+        last_records = join_registry(last_record_timestamp, last_records)
+        return last_record_timestamp, last_records
+
+    @staged("watermark")
+    def write_last_records(self, last_timstamp, records):
+        client = self.get_root_client(self.last_records_blob_name)
+        self.logme("\nUploading last record to %s as: %s" %
+                   (self.storage_name, self.last_records_blob_name))
+        json_str = serialize_last_records(last_timstamp, records,
+                                          self.record_encoding)
+        if self.last_records_etag is None:
+            conditions = {"overwrite": False}
+        else:
+            conditions = {
+                "overwrite": True,
+                "etag": self.last_records_etag,
+                "match_condition": MatchConditions.IfNotModified
+            }
+        try:
+            response = self.uploader.call(
+                self.upload_to_client,
+                client,
+                json_str,
+                content_type="application/json",
+                content_encoding=encodings[
+                    self.record_encoding]["content_encoding"],
+                retry_total=0,
+                **conditions)
+        except (ResourceModifiedError, ResourceExistsError):
+            # a retry after a lost response finds what its first attempt
+            # wrote, that is not another writer
+            _etag = self.get_last_records_etag(json_str)
+            if _etag is None:
+                self.logme("\n%s was changed by another writer, not "
+                           "overwriting" % self.last_records_blob_name)
+                raise
+            self.last_records_etag = _etag
+            return
+        self.last_records_etag = response["etag"]
+
+    def get_last_records_etag(self, data):
+        # the etag of the watermark if it holds data, otherwise None
+        try:
+            downloader = self.download_from_client(
+                self.get_root_client(self.last_records_blob_name))
+        except ResourceNotFoundError:
+            return None
+        if decompress(downloader.readall()) != decompress(data):
+            return None
+        return downloader.properties.etag
+
+    def create_lock_file(self):
+        try:
+            self.upload_to_client(self.get_root_client(self.lock_blob_name),
+                                  b"",
+                                  overwrite=False)
+        except ResourceExistsError:
+            pass
+
+    def get_writer_lease(self, lease_duration=60):
+        lease_client = self.get_lease_client(
+            self.get_root_client(self.lock_blob_name))
+        return WriterLease(lease_client,
+                           self.create_lock_file,
+                           lease_duration=lease_duration)
+
+    def buffer_records(self, new_timestamp, records):
+        _finished = self.columnar_buffer.add(new_timestamp, records)
+        if _finished is not None:
+            self.upload_finished(*_finished)
+
+    def flush_records(self):
+        # the open partition's minutes so far are uploaded once; later
+        # minutes of it go to a part file of their own, see compact
+        if self.columnar_buffer is not None and \
+                not self.columnar_buffer.is_empty():
+            if self.columnar_buffer.is_complete(self.window):
+                self.upload_finished(*self.columnar_buffer.take())
+            else:
+                self.upload_partition(*self.columnar_buffer.take())
+
+    def upload_finished(self, start, file_name, table):
+        self.upload_partition(start, file_name, table)
+        # a finished partition that was written in parts is compacted
+        # right away, steady ticks would otherwise leave a part file for
+        # every run behind
+        if is_part_file(file_name, start, self.output_mode,
+                        self.columnar_format):
+            self.compact_records(start, self.output_mode)
+
+    def compact(self, start, end, partition):
+        check_columnar(partition, self.columnar_format)
+        # never touch the partition the generator is still appending to
+        _last_record_timestamp, _ = self.get_last_records()
+        _compacted = 0
+        _start = partition_start(start, partition)
+        while _start < end and _start + partitions[partition]["length"] <= \
+                _last_record_timestamp + step:
+            _compacted = _compacted + self.compact_records(_start, partition)
+            _start = _start + partitions[partition]["length"]
+        return _compacted
+
+
+class StorageBusinessLayer(BaseLayer):
+    def get_value_generator(self, previous_records):
+        check_minute_intervals(
+            [_record.equipment_tag for _record in previous_records])
+        return ValueGenerator(
+            [_record.equipment_tag for _record in previous_records],
+            self.enable_anomaly,
+            previous_values=[_record.value for _record in previous_records],
+            last_timestamps=[
+                _record.timestamp for _record in previous_records
+            ])
+
+    def create_next_records(self, previous_records, new_timestamp, values):
+        return create_batch(previous_records, new_timestamp, values)
+
+    def iter_records_to_write(self, last_record_time, previous_records,
+                              chunk_minutes):
+        # the minutes after last_record_time, chunk_minutes at a time, from
+        # the generation core fanout writes from as well
+        check_minute_intervals(
+            [_record.equipment_tag for _record in previous_records])
+        _minutes = pending_minutes(last_record_time, self.current_datetime)
+        return WindowGenerator(previous_records,
+                               self.enable_anomaly).iter_windows(
+                                   last_record_time, _minutes, chunk_minutes)
+
+    def iter_minutes_to_write(self, last_record_time, previous_records,
+                              chunk_minutes, time_budget):
+        for records_to_write in self.iter_records_to_write(
+                last_record_time, previous_records, chunk_minutes):
+            for x in records_to_write:
+                # the rest of the backlog is left to later ticks
+                if time_budget.is_exhausted():
+                    return
+                yield x
+
+    def write_checkpoint(self, last_record_time, records):
+        # columnar minutes are only durable once their partition is uploaded
+        self.dal.flush_records()
+        self.dal.write_last_records(last_record_time, records)
+        self.logme("\nCheckpoint at %s, %s" %
+                   (last_record_time.strftime(datetime_format),
+                    str(metrics.snapshot()["counters"])))
+
+    def report_progress(self, counters_before, report):
+        report.update(get_summary(counters_before, report["elapsed_seconds"]))
+        metrics.record("backlog_minutes", report["backlog_minutes"])
+        if report["records_per_second"] is not None:
+            metrics.record("records_per_second", report["records_per_second"])
+            metrics.record("bytes_per_second", report["bytes_per_second"])
+        self.logme(
+            "\nBacklog %(backlog_minutes)s minute(s), wrote "
+            "%(written_minutes)s, %(remaining_minutes)s left, estimated "
+            "catch-up in %(estimated_catch_up_seconds)s s, "
+            "%(records_per_second)s records/s, "
+            "%(bytes_per_second)s bytes/s" % report)
+        return report
+
+    @classmethod
+    def backfill(cls,
+                 end_datetime,
+                 enable_anomaly,
+                 workers=None,
+                 shard_minutes=default_shard_minutes,
+                 max_in_flight=10,
+                 output_mode="json",
+                 record_encoding="json"):
+        # batch mode: shards of the backlog up to end_datetime run on a
+        # process pool, see backfill.Backfill
+        layer_kwargs = {
+            "current_datetime": end_datetime,
+            "enable_anomaly": enable_anomaly,
+            "max_connections": max_in_flight,
+            "output_mode": output_mode,
+            "record_encoding": record_encoding
+        }
+        bl = cls(**layer_kwargs)
+        lease = bl.dal.get_writer_lease()
+        if not lease.acquire():
+            bl.logme("\nAnother invocation holds %s, exiting" %
+                     bl.dal.lock_blob_name)
+            return None
+        with lease:
+            time_budget = TimeBudget(None)
+            _counters_before = metrics.snapshot()["counters"]
+            _minutes, _written_minutes = Backfill(
+                bl,
+                layer_kwargs,
+                workers=workers,
+                shard_minutes=shard_minutes,
+                max_in_flight=max_in_flight).run(end_datetime)
+            return bl.report_progress(
+                _counters_before,
+                get_progress_report(_minutes, _written_minutes,
+                                    time_budget.elapsed(), None))
@@ -0,0 +1,186 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+otel = None
+_meter = None
+_instruments = {}
+
+
+def load_opentelemetry():
+    # imported on first use so cold starts do not pay for it
+    global otel
+    if otel is None:
+        try:
+            from opentelemetry import context, metrics, trace
+            otel = {"context": context, "metrics": metrics, "trace": trace}
+        except ImportError:
+            otel = {}
+    return otel
+
+
+def get_tracer():
+    if "trace" not in load_opentelemetry():
+        return None
+    return otel["trace"].get_tracer(__name__)
+
+
+def get_meter():
+    global _meter
+    if _meter is None and "metrics" in load_opentelemetry():
+        _meter = otel["metrics"].get_meter(__name__)
+    return _meter
+
+
+def get_instrument(name, kind, value_type):
+    # the metrics api moved between releases, anything it cannot create
+    # is still kept in the in-process registry below
+    if name in _instruments:
+        return _instruments[name]
+    _instrument = None
+    meter = get_meter()
+    if meter is not None:
+        try:
+            if kind == "counter":
+                _instrument = meter.create_counter(name, name, "1",
+                                                   value_type)
+            elif hasattr(meter, "create_valuerecorder"):
+                _instrument = meter.create_valuerecorder(
+                    name, name, "1", value_type)
+            else:
+                _instrument = meter.create_histogram(name)
+        except Exception as error:
+            logging.debug("metric %s not exported: %s" % (name, str(error)))
+    _instruments[name] = _instrument
+    return _instrument
+
+
+class Histogram():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.count = self.count + 1
+        self.total = self.total + value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else None,
+            "min": self.min,
+            "max": self.max
+        }
+
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        _instrument = get_instrument(name, "counter", int)
+        if _instrument is not None:
+            _instrument.add(value, {})
+
+    def record(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].record(value)
+        _instrument = get_instrument(name, "histogram", float)
+        if _instrument is not None:
+            _instrument.record(value, {})
+
+    def get_counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {
+                    _name: _histogram.snapshot()
+                    for _name, _histogram in self.histograms.items()
+                }
+            }
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def stage(name, **attributes):
+    # one child span plus a latency sample per pipeline stage
+    _started_at = time.perf_counter()
+    tracer = get_tracer()
+    try:
+        if tracer is None:
+            yield None
+        else:
+            with tracer.start_as_current_span(name) as span:
+                for _key, _value in attributes.items():
+                    span.set_attribute(_key, _value)
+                yield span
+    finally:
+        metrics.record(name + "_seconds", time.perf_counter() - _started_at)
+
+
+def staged(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def bind_context(function):
+    # worker threads do not inherit the caller's span
+    if "context" not in load_opentelemetry():
+        return function
+    _context = otel["context"].get_current()
+
+    def run_in_context(*args, **kwargs):
+        _token = otel["context"].attach(_context)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            otel["context"].detach(_token)
+
+    return run_in_context
+
+
+def get_summary(counters_before, elapsed_seconds):
+    # rates over one run, from the counter deltas since counters_before
+    _counters = metrics.snapshot()["counters"]
+    _records = _counters.get("records_written", 0) - counters_before.get(
+        "records_written", 0)
+    _bytes = _counters.get("bytes_written", 0) - counters_before.get(
+        "bytes_written", 0)
+    _uploads = _counters.get("uploads", 0) - counters_before.get("uploads", 0)
+    summary = {
+        "records_written": _records,
+        "bytes_written": _bytes,
+        "uploads": _uploads,
+        "records_per_second": None,
+        "bytes_per_second": None
+    }
+    if elapsed_seconds > 0:
+        summary["records_per_second"] = round(_records / elapsed_seconds, 1)
+        summary["bytes_per_second"] = round(_bytes / elapsed_seconds, 1)
+    return summary
@@ -0,0 +1,124 @@
+import logging
+import random
+import threading
+import time
+
+from azure.core.exceptions import (HttpResponseError, ServiceRequestError,
+                                   ServiceResponseError)
+
+from .telemetry import metrics
+
+throttle_status_codes = (429, 503)
+retry_status_codes = (408, 500, 502, 504)
+
+
+def is_throttled(error):
+    return isinstance(error, HttpResponseError) and (
+        error.status_code in throttle_status_codes or
+        getattr(error, "error_code", None) == "ServerBusy")
+
+
+def is_retryable(error):
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    return is_throttled(error) or (isinstance(error, HttpResponseError) and
+                                   error.status_code in retry_status_codes)
+
+
+class AdaptiveLimiter():
+    def __init__(self, maximum, minimum=1, decrease=0.5):
+        # AIMD: the limit grows by one after a full window of successes and
+        # is cut by decrease on throttling, once per window
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.cut_at = 0
+        self.completed = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active = self.active + 1
+
+    def release(self):
+        with self.condition:
+            self.active = self.active - 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.completed = self.completed + 1
+            self.successes = self.successes + 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit = self.limit + 1
+                self.successes = 0
+                metrics.record("upload_concurrency", self.limit)
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.successes = 0
+            # uploads already in flight when the limit was cut report the
+            # same congestion, they do not cut it again
+            if self.completed < self.cut_at:
+                return
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+            self.cut_at = self.completed + self.active
+            metrics.record("upload_concurrency", self.limit)
+
+
+class RetryPolicy():
+    def __init__(self,
+                 max_attempts=8,
+                 base_delay=0.5,
+                 max_delay=30.0,
+                 sleep=time.sleep,
+                 jitter=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.jitter = jitter
+
+    def get_delay(self, attempt):
+        # full jitter, so throttled writers do not retry in lockstep
+        return self.jitter() * min(self.max_delay,
+                                   self.base_delay * 2**attempt)
+
+
+class AdaptiveUploader():
+    def __init__(self, limiter, policy=None):
+        self.limiter = limiter
+        self.policy = policy or RetryPolicy()
+
+    def call(self, function, *args, **kwargs):
+        _attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                self.limiter.release()
+                if not is_retryable(error) or \
+                        _attempt + 1 >= self.policy.max_attempts:
+                    metrics.add("upload_failures")
+                    raise
+                if is_throttled(error):
+                    metrics.add("throttled")
+                    self.limiter.on_throttle()
+                metrics.add("retries")
+                _delay = self.policy.get_delay(_attempt)
+                logging.debug("retrying upload in %.2f s after %s" %
+                              (_delay, str(error)))
+                self.policy.sleep(_delay)
+                _attempt = _attempt + 1
+                continue
+            self.limiter.on_success()
+            self.limiter.release()
+            return result
+
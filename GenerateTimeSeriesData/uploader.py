@@ -0,0 +1,58 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .telemetry import bind_context
+
+
+class ConcurrentUploader():
+    def __init__(self, write_records, max_in_flight=10):
+        self.write_records = write_records
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # futures in submission order, so that completion can only be
+        # confirmed for an unbroken prefix of minutes
+        self.pending = deque()
+        self.confirmed = None
+
+    def _write(self, record_to_write):
+        try:
+            self.write_records(record_to_write['new_timestamp'],
+                               record_to_write['records'])
+        finally:
+            self.in_flight.release()
+
+    def submit(self, record_to_write):
+        # finished uploads stuck behind a slow one still hold their records,
+        # so the backlog of unconfirmed minutes is bounded as well
+        while len(self.pending) >= 4 * self.max_in_flight:
+            wait([self.pending[0][0]])
+            self.collect()
+        self.in_flight.acquire()
+        future = self.executor.submit(bind_context(self._write),
+                                      record_to_write)
+        self.pending.append((future, record_to_write))
+        self.collect()
+
+    def collect(self):
+        while len(self.pending) > 0 and self.pending[0][0].done():
+            future, record_to_write = self.pending.popleft()
+            future.result()
+            self.confirmed = record_to_write
+        return self.confirmed
+
+    def flush(self):
+        while len(self.pending) > 0:
+            wait([self.pending[0][0]])
+            self.collect()
+        return self.confirmed
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
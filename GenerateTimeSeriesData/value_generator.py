@@ -0,0 +1,211 @@
+import calendar
+from datetime import datetime, timedelta
+import math
+import numpy as np
+
+from .counter_random import CounterRandom, get_seed
+from .registry import get_registry
+from .signals import (default_interval, generate, milliseconds_per_day,
+                      models, to_interval_ms)
+from .telemetry import stage
+
+step = timedelta(seconds=60)
+
+_epoch = datetime(1970, 1, 1)
+
+
+def pending_minutes(last_timestamp, current_datetime, window=step):
+    # number of minutes (or windows) after last_timestamp that are
+    # strictly before current_datetime, i.e. the minutes the per-record
+    # loop used to emit
+    _seconds = (current_datetime - last_timestamp).total_seconds()
+    if _seconds <= 0:
+        return 0
+    return int(math.ceil(_seconds / window.total_seconds())) - 1
+
+
+def to_epoch_minutes(timestamp):
+    return calendar.timegm(timestamp.timetuple()) // 60
+
+
+def to_epoch_ms(timestamp):
+    return calendar.timegm(timestamp.timetuple()) * 1000 + \
+        timestamp.microsecond // 1000
+
+
+def from_epoch_ms(epoch_ms):
+    return _epoch + timedelta(milliseconds=int(epoch_ms))
+
+
+def get_timestamps(last_timestamp, first, count, window=step):
+    # the timestamps of rows first .. first + count - 1 after
+    # last_timestamp; rows are integer offsets in the loops, a timestamp is
+    # only built once per row and shared by every tag
+    return [
+        last_timestamp + window * _row for _row in range(first, first + count)
+    ]
+
+
+class ValueGenerator():
+    def __init__(self,
+                 equipment_tags,
+                 enable_anomaly,
+                 seed=None,
+                 registry=None,
+                 previous_values=None,
+                 last_timestamps=None,
+                 interval=default_interval):
+        # previous_values and last_timestamps line up with equipment_tags,
+        # the stateful signal models continue from them. every tag samples
+        # at interval seconds, rows are counted in samples since the epoch
+        # rather than minutes when it is not the default
+        self.equipment_tags = list(equipment_tags)
+        if registry is None:
+            registry = get_registry()
+        self.tag_ids = registry.get_ids(self.equipment_tags)
+        self.min_values = registry.min_values[self.tag_ids]
+        self.max_values = registry.max_values[self.tag_ids]
+        self.enable_anomaly = enable_anomaly
+        if seed is None:
+            seed = get_seed()
+        self.draw = CounterRandom(seed, registry.tag_keys[self.tag_ids])
+        _count = len(self.equipment_tags)
+        self.previous_values = np.full(_count, np.nan)
+        if previous_values is not None:
+            self.previous_values[:] = [
+                np.nan if _value is None else _value
+                for _value in previous_values
+            ]
+        self.interval_ms = to_interval_ms(interval)
+        self.steps_per_day = milliseconds_per_day // self.interval_ms
+        self.last_minutes = np.zeros(_count, dtype=np.int64)
+        if last_timestamps is not None:
+            # tags mostly share their last timestamp
+            _epochs = {
+                _timestamp: to_epoch_ms(_timestamp)
+                for _timestamp in set(last_timestamps)
+            }
+            self.last_minutes[:] = [
+                _epochs[_timestamp] // self.interval_ms
+                for _timestamp in last_timestamps
+            ]
+        # tags of one model are generated together
+        _model_ids = registry.model_ids[self.tag_ids]
+        self.model_columns = {}
+        for _model_id in np.unique(_model_ids):
+            _columns = np.flatnonzero(_model_ids == _model_id)
+            self.model_columns[models[_model_id]] = (_columns, {
+                _name: _parameter[self.tag_ids[_columns]]
+                for _name, _parameter in registry.parameters.items()
+            }, self.draw.take(_columns))
+
+    def get_uniform_values(self, draw, epoch_minutes, low, high):
+        values = draw.uniform(low, high, epoch_minutes, "value")
+        if self.enable_anomaly:
+            anomaly = draw.uniform(-1, 1, epoch_minutes, "anomaly")
+            values = np.where(anomaly > 0, high * anomaly, values)
+            values = np.where(anomaly < 0, low * -anomaly, values)
+        return values
+
+    def get_values(self, minutes):
+        # one row per minute, one column per equipment tag
+        shape = (minutes, len(self.equipment_tags))
+        with stage("generate", minutes=minutes, tags=shape[1]):
+            # every value is keyed by its tag and minute, see counter_random
+            _epoch_minutes = self.last_minutes + np.arange(
+                1, minutes + 1)[:, np.newaxis]
+            if list(self.model_columns) == ["uniform"]:
+                values = self.get_uniform_values(self.draw, _epoch_minutes,
+                                                 self.min_values,
+                                                 self.max_values)
+            else:
+                values = np.empty(shape)
+                for _model, (_columns, _parameters,
+                             _draw) in self.model_columns.items():
+                    _low = self.min_values[_columns]
+                    _high = self.max_values[_columns]
+                    if _model == "uniform":
+                        values[:, _columns] = self.get_uniform_values(
+                            _draw, _epoch_minutes[:, _columns], _low, _high)
+                    else:
+                        values[:, _columns] = generate(
+                            _model, _draw,
+                            self.previous_values[_columns],
+                            _epoch_minutes[:, _columns], _low, _high,
+                            _parameters, self.enable_anomaly,
+                            self.steps_per_day)
+            values = np.round(values, 2)
+            if minutes > 0:
+                self.previous_values = values[-1].copy()
+                self.last_minutes = self.last_minutes + minutes
+            return values
+
+    def iter_values(self, minutes, chunk_minutes):
+        # yields the same rows as get_values but never holds more than
+        # chunk_minutes of them at a time
+        while minutes > 0:
+            _chunk = min(minutes, chunk_minutes)
+            yield self.get_values(_chunk)
+            minutes = minutes - _chunk
+
+
+class SampleGenerator():
+    def __init__(self,
+                 equipment_tags,
+                 enable_anomaly,
+                 seed=None,
+                 registry=None,
+                 previous_values=None,
+                 last_timestamps=None):
+        # one ValueGenerator per sampling interval in the registry
+        self.equipment_tags = list(equipment_tags)
+        if registry is None:
+            registry = get_registry()
+        _intervals = registry.interval_ms[registry.get_ids(
+            self.equipment_tags)]
+        self.groups = []
+        for _interval_ms in np.unique(_intervals):
+            _columns = np.flatnonzero(_intervals == _interval_ms)
+            value_generator = ValueGenerator(
+                [self.equipment_tags[_column] for _column in _columns],
+                enable_anomaly,
+                seed=seed,
+                registry=registry,
+                previous_values=None if previous_values is None else
+                [previous_values[_column] for _column in _columns],
+                last_timestamps=None if last_timestamps is None else
+                [last_timestamps[_column] for _column in _columns],
+                interval=_interval_ms / 1000)
+            # tags of one interval move in step, they all resume from the
+            # same sample
+            value_generator.last_minutes[:] = value_generator.last_minutes.max(
+            ) if len(_columns) > 0 else 0
+            self.groups.append((int(_interval_ms), _columns, value_generator))
+
+    def get_samples(self, end_ms):
+        # every sample after the last one up to and including end_ms, as
+        # (epoch ms, column, value) arrays in time then column order
+        _times = []
+        _columns = []
+        _values = []
+        for _interval_ms, columns, value_generator in self.groups:
+            _last_step = int(value_generator.last_minutes[0])
+            _steps = end_ms // _interval_ms - _last_step
+            if _steps <= 0:
+                continue
+            values = value_generator.get_values(_steps)
+            _times.append(
+                np.repeat((_last_step + np.arange(1, _steps + 1)) *
+                          _interval_ms, len(columns)))
+            _columns.append(np.tile(columns, _steps))
+            _values.append(values.ravel())
+        if len(_times) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0))
+        _times = np.concatenate(_times)
+        _columns = np.concatenate(_columns)
+        _values = np.concatenate(_values)
+        if len(self.groups) > 1:
+            _order = np.lexsort((_columns, _times))
+            return _times[_order], _columns[_order], _values[_order]
+        return _times, _columns, _values
@@ -0,0 +1,23 @@
+import json
+
+import pytest
+
+from GenerateTimeSeriesData.signals import models
+
+
+@pytest.fixture
+def registry_path(tmp_path, monkeypatch):
+    # one tag per signal model, named after it
+    path = tmp_path / "equipment.json"
+    path.write_text(
+        json.dumps({
+            "tags": [{
+                "tag": _model,
+                "min": 0,
+                "max": 10,
+                "model": _model
+            } for _model in models]
+        }))
+    monkeypatch.setenv("EQUIPMENT_REGISTRY_PATH", str(path))
+    monkeypatch.delenv("GENERATOR_SEED", raising=False)
+    return path
@@ -0,0 +1,164 @@
+import threading
+
+from azure.core.exceptions import (HttpResponseError, ResourceExistsError,
+                                   ResourceModifiedError,
+                                   ResourceNotFoundError,
+                                   ServiceResponseError)
+
+# local stand-ins for the storage service, in place of an Azurite instance
+
+
+def get_http_error(status_code, error_code=None, error_class=HttpResponseError):
+    error = error_class(message=error_code or str(status_code))
+    error.status_code = status_code
+    error.error_code = error_code
+    return error
+
+
+class ThrottlingStandIn():
+    def __init__(self, function, capacity):
+        # wraps an upload and answers 503 ServerBusy like a storage account
+        # would when more than capacity calls overlap
+        self.function = function
+        self.capacity = capacity
+        self.active = 0
+        self.calls = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.calls = self.calls + 1
+            _busy = self.active >= self.capacity
+            if _busy:
+                self.throttled = self.throttled + 1
+            else:
+                self.active = self.active + 1
+        if _busy:
+            raise get_http_error(503, "ServerBusy")
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active = self.active - 1
+
+
+class Properties():
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class Downloader():
+    def __init__(self, data, etag):
+        self.data = data
+        self.properties = Properties(etag)
+
+    def readall(self):
+        return self.data
+
+
+class ContainerStandIn():
+    def __init__(self):
+        # name -> (data, etag), answers like a blob container
+        self.blobs = {}
+        self.etags = 0
+        # names whose next upload is stored but its response lost
+        self.lose_response = set()
+        self.lock = threading.Lock()
+
+    def put(self, name, data):
+        with self.lock:
+            self.etags = self.etags + 1
+            _etag = '"%d"' % self.etags
+            self.blobs[name] = (data, _etag)
+        return _etag
+
+    def get_blob_client(self, container, blob):
+        return BlobStandIn(self, blob)
+
+    def get_container_client(self, container):
+        return ContainerClientStandIn(self)
+
+
+class ContainerClientStandIn():
+    def __init__(self, container):
+        self.container = container
+
+    def list_blobs(self, name_starts_with=""):
+        return [
+            BlobStandIn(self.container, _name)
+            for _name in sorted(self.container.blobs)
+            if _name.startswith(name_starts_with)
+        ]
+
+    def get_blob_client(self, blob):
+        return BlobStandIn(self.container, blob)
+
+
+class BlobStandIn():
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.blob_name = name
+
+    def upload_blob(self, data, overwrite=False, etag=None,
+                    match_condition=None, **kwargs):
+        _stored = self.container.blobs.get(self.name)
+        if _stored is not None and not overwrite:
+            raise get_http_error(409, "BlobAlreadyExists",
+                                 ResourceExistsError)
+        if etag is not None and (_stored is None or _stored[1] != etag):
+            raise get_http_error(412, "ConditionNotMet",
+                                 ResourceModifiedError)
+        _etag = self.container.put(self.name, data)
+        if self.name in self.container.lose_response:
+            self.container.lose_response.discard(self.name)
+            raise ServiceResponseError("connection reset")
+        return {"etag": _etag}
+
+    def download_blob(self):
+        _stored = self.container.blobs.get(self.name)
+        if _stored is None:
+            raise get_http_error(404, "BlobNotFound", ResourceNotFoundError)
+        return Downloader(*_stored)
+
+    def delete_blob(self):
+        if self.container.blobs.pop(self.name, None) is None:
+            raise get_http_error(404, "BlobNotFound", ResourceNotFoundError)
+
+
+class LeaseStandIn():
+    def __init__(self, container, name, renew_errors=()):
+        # one lease on the blob name, shared by every writer using it
+        self.container = container
+        self.name = name
+        self.renew_errors = list(renew_errors)
+        self.holder = None
+        self.renewed = threading.Event()
+        self.renews = 0
+
+    def get_client(self, holder):
+        return LeaseClientStandIn(self, holder)
+
+
+class LeaseClientStandIn():
+    def __init__(self, lease, holder):
+        self.lease = lease
+        self.holder = holder
+
+    def acquire(self, lease_duration):
+        if self.lease.name not in self.lease.container.blobs:
+            raise get_http_error(404, "BlobNotFound", ResourceNotFoundError)
+        if self.lease.holder not in (None, self.holder):
+            raise get_http_error(409, "LeaseAlreadyPresent",
+                                 ResourceExistsError)
+        self.lease.holder = self.holder
+
+    def renew(self):
+        self.lease.renews = self.lease.renews + 1
+        if len(self.lease.renew_errors) > 0:
+            raise self.lease.renew_errors.pop(0)
+        self.lease.renewed.set()
+
+    def release(self):
+        self.lease.holder = None
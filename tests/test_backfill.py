@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import numpy as np
+
+from GenerateTimeSeriesData.backfill import Backfill, get_shards
+from GenerateTimeSeriesData.readings import SensorReading
+from GenerateTimeSeriesData.signals import models
+from GenerateTimeSeriesData.storage_layer import StorageBusinessLayer
+
+
+class BusinessLayer(StorageBusinessLayer):
+    def __init__(self):
+        self.enable_anomaly = False
+
+
+def test_sharded_values_equal_serial(registry_path):
+    bl = BusinessLayer()
+    _last_record_time = datetime(2020, 10, 13, 0, 0)
+    _previous_records = [
+        SensorReading(_last_record_time, _tag, 5.0) for _tag in models
+    ]
+    _shards = get_shards(_last_record_time, 300, 60)
+    # all starts are taken before any shard runs, as a busy executor may
+    _starts = list(
+        Backfill(bl, {}, shard_minutes=60,
+                 chunk_minutes=7).iter_shard_starts(_last_record_time,
+                                                    _previous_records,
+                                                    _shards))
+    _sharded = np.vstack([
+        bl.get_value_generator(list(_start)).get_values(_minutes)
+        for _start, (_, _minutes) in zip(_starts, _shards)
+    ])
+    _serial = bl.get_value_generator(_previous_records).get_values(300)
+    assert len(_shards) > 1
+    np.testing.assert_array_equal(_sharded, _serial)
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
+from GenerateTimeSeriesData.business_layer import (Base, DataAccessLayer,
+                                                   SensorReading,
+                                                   SensorWatermark)
+from GenerateTimeSeriesData.signals import models
+
+start = datetime(2020, 10, 13, 2, 1)
+
+
+@pytest.fixture
+def engine(registry_path):
+    # one in-memory database shared by every session of the test
+    engine = create_engine("sqlite://",
+                           connect_args={"check_same_thread": False},
+                           poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def get_rows(minutes, tags=models):
+    return [{
+        "timestamp": start + timedelta(minutes=_minute),
+        "equipment_tag": _tag,
+        "value": _minute + _column / 10
+    } for _minute in range(minutes) for _column, _tag in enumerate(tags)]
+
+
+def get_readings(dal):
+    return dal.session.query(SensorReading).count()
+
+
+def get_watermarks(dal):
+    return {
+        _row.equipment_tag: (_row.timestamp, _row.value)
+        for _row in dal.session.query(SensorWatermark).all()
+    }
+
+
+def get_last_rows(rows):
+    _last_rows = {}
+    for row in rows:
+        _last_rows[row["equipment_tag"]] = (row["timestamp"], row["value"])
+    return _last_rows
+
+
+class CountingDataAccessLayer(DataAccessLayer):
+    def __init__(self, engine, batch_size, commit_batches):
+        super().__init__(engine,
+                         batch_size=batch_size,
+                         commit_batches=commit_batches)
+        self.commits = []
+
+    def commit(self):
+        self.commits.append(get_readings(self))
+        super().commit()
+
+
+def test_bulk_insert_commits_every_commit_batches(engine):
+    dal = CountingDataAccessLayer(engine, batch_size=10, commit_batches=3)
+    _rows = get_rows(15)
+    assert dal.bulk_insert(iter(_rows)) == 75
+    # 8 batches, a commit after the 3rd, the 6th and the last
+    assert dal.commits == [30, 60, 75]
+    assert get_readings(dal) == 75
+    assert get_watermarks(dal) == get_last_rows(_rows)
+    dal.close()
+
+
+def test_watermark_moves_with_the_readings(engine):
+    dal = DataAccessLayer(engine, batch_size=10, commit_batches=2)
+    _rows = get_rows(10)
+    # the 4th batch fails, the 3rd is not committed yet
+    _rows[35] = dict(_rows[30])
+    with pytest.raises(IntegrityError):
+        dal.bulk_insert(_rows)
+    dal.rollback()
+    assert get_readings(dal) == 20
+    assert get_watermarks(dal) == get_last_rows(_rows[:20])
+    # the next run resumes where the committed rows end
+    _last_records = {
+        _record.equipment_tag: _record.timestamp
+        for _record in dal.get_last_records()
+    }
+    assert _last_records == {_tag: start + timedelta(minutes=3)
+                             for _tag in models}
+    assert dal.bulk_insert(_rows[20:35] + _rows[36:]) == 29
+    assert get_readings(dal) == 49
+    assert get_watermarks(dal) == get_last_rows(_rows)
+    dal.close()
+
+
+def test_rebuild_watermarks_from_the_readings(engine):
+    dal = DataAccessLayer(engine)
+    _rows = get_rows(4) + get_rows(6, models[:2])[len(models[:2]) * 4:]
+    dal.session.execute(SensorReading.__table__.insert(), _rows)
+    dal.commit()
+    # nothing seeded yet, the readings are scanned for each tag's latest
+    assert {
+        _record.equipment_tag: _record.timestamp
+        for _record in dal.get_last_records()
+    } == {_tag: _timestamp
+          for _tag, (_timestamp, _value) in get_last_rows(_rows).items()}
+    dal.rebuild_watermarks()
+    assert get_watermarks(dal) == get_last_rows(_rows)
+    # the rebuilt table is what later inserts update
+    dal.bulk_insert(get_rows(7)[len(models) * 6:])
+    assert get_watermarks(dal)[models[4]] == (start + timedelta(minutes=6),
+                                              6.4)
+    dal.close()
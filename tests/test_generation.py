@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from GenerateTimeSeriesData.generation import WindowGenerator
+from GenerateTimeSeriesData.readings import ReadingBatch, SensorReading
+from GenerateTimeSeriesData.signals import models
+from GenerateTimeSeriesData.value_generator import ValueGenerator
+
+last_timestamp = datetime(2020, 10, 13, 2, 1)
+
+
+def get_previous_records():
+    return [SensorReading(last_timestamp, _tag, 5.0) for _tag in models]
+
+
+@pytest.mark.parametrize("chunk_windows", [1, 7, 60])
+def test_minute_windows_hold_the_minute_values(registry_path,
+                                               chunk_windows):
+    # the storage layers write one minute per window from this core
+    _values = ValueGenerator(models, False,
+                             previous_values=[5.0] * len(models),
+                             last_timestamps=[last_timestamp] *
+                             len(models)).get_values(100)
+    _windows = [
+        x for records_to_write in WindowGenerator(
+            get_previous_records(), False).iter_windows(
+                last_timestamp, 100, chunk_windows)
+        for x in records_to_write
+    ]
+    assert [x["new_timestamp"] for x in _windows] == [
+        last_timestamp + timedelta(minutes=_minute)
+        for _minute in range(1, 101)
+    ]
+    for x, _row in zip(_windows, _values):
+        assert isinstance(x["records"], ReadingBatch)
+        assert x["records"].timestamp == x["new_timestamp"]
+        assert x["records"].get_tags() == models
+        np.testing.assert_array_equal(x["records"].values, _row)
+    assert _windows[-1]["last_records"] is _windows[-1]["records"]
@@ -0,0 +1,82 @@
+import pytest
+from azure.core.exceptions import ServiceRequestError
+
+from GenerateTimeSeriesData import business_layer_stg
+from GenerateTimeSeriesData.lease import WriterLease
+from stand_ins import ContainerStandIn, LeaseStandIn, get_http_error
+
+
+@pytest.fixture
+def container(monkeypatch):
+    container = ContainerStandIn()
+    monkeypatch.setattr(business_layer_stg.DataAccessLayer,
+                        "get_blob_service_client", lambda self: container)
+    return container
+
+
+def get_lease(lease, holder, lease_duration=1):
+    return WriterLease(lease.get_client(holder),
+                       lambda: lease.container.put(lease.name, b""),
+                       lease_duration=lease_duration)
+
+
+def test_second_writer_is_turned_away(container, monkeypatch):
+    lease = LeaseStandIn(container, "generator.lock")
+    _holders = iter(["first", "second", "third"])
+    monkeypatch.setattr(business_layer_stg.DataAccessLayer,
+                        "get_lease_client",
+                        lambda self, client: lease.get_client(next(_holders)))
+    # the lock file is created by the first writer
+    first = business_layer_stg.DataAccessLayer().get_writer_lease()
+    assert first.acquire()
+    assert "generator.lock" in container.blobs
+    second = business_layer_stg.DataAccessLayer().get_writer_lease()
+    assert not second.acquire()
+    first.release()
+    # once released the lease is free again
+    third = business_layer_stg.DataAccessLayer().get_writer_lease()
+    assert third.acquire()
+    third.release()
+    assert lease.holder is None
+
+
+def test_network_errors_on_renewal_are_retried(container):
+    container.put("generator.lock", b"")
+    lease = LeaseStandIn(
+        container, "generator.lock",
+        [ServiceRequestError("connection reset")] * 2)
+    writer_lease = get_lease(lease, "first", lease_duration=1)
+    assert writer_lease.acquire()
+    assert lease.renewed.wait(5)
+    writer_lease.release()
+    assert lease.renews == 3
+    assert not writer_lease.lost
+    assert lease.holder is None
+
+
+def test_lease_is_lost_when_renewal_keeps_failing(container):
+    container.put("generator.lock", b"")
+    lease = LeaseStandIn(container, "generator.lock",
+                         [ServiceRequestError("connection reset")] * 100)
+    writer_lease = get_lease(lease, "first", lease_duration=0.5)
+    assert writer_lease.acquire()
+    writer_lease.renewer.join(5)
+    assert writer_lease.lost
+    # renewing was retried until the lease would have run out
+    assert lease.renews > 1
+    writer_lease.release()
+    # a lost lease is not released, it may be someone else's by now
+    assert lease.holder == "first"
+
+
+def test_lease_is_lost_at_once_when_taken_over(container):
+    container.put("generator.lock", b"")
+    lease = LeaseStandIn(
+        container, "generator.lock",
+        [get_http_error(409, "LeaseIdMismatchWithLeaseOperation")])
+    writer_lease = get_lease(lease, "first", lease_duration=0.5)
+    assert writer_lease.acquire()
+    writer_lease.renewer.join(5)
+    assert writer_lease.lost
+    assert lease.renews == 1
+    writer_lease.release()
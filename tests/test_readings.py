@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import numpy as np
+
+from GenerateTimeSeriesData.columnar import ColumnarBuffer, to_bytes
+from GenerateTimeSeriesData.readings import (ReadingBatch, ReadingWindow,
+                                             SensorReading, create_batch)
+from GenerateTimeSeriesData.value_generator import step
+
+timestamp = datetime(2020, 10, 13, 2, 1)
+tags = ["a", "b", "c"]
+
+
+def get_batch(timestamp=timestamp, values=(1.5, 2.5, 3.5)):
+    return ReadingBatch(timestamp, tags, np.array([1, 2, 0]),
+                        np.array(values))
+
+
+def get_fields(records):
+    return [(_record.timestamp, _record.equipment_tag, _record.value)
+            for _record in records]
+
+
+def test_batch_reads_as_sensor_readings():
+    _batch = get_batch()
+    assert len(_batch) == 3
+    assert get_fields(_batch) == [(timestamp, "b", 1.5), (timestamp, "c", 2.5),
+                                  (timestamp, "a", 3.5)]
+    assert get_fields([_batch[2]]) == [(timestamp, "a", 3.5)]
+    assert _batch.get_tags() == ["b", "c", "a"]
+    _window = ReadingWindow([_batch, get_batch(timestamp + step)])
+    assert len(_window) == 6
+    assert get_fields(_window)[3:] == get_fields(get_batch(timestamp + step))
+
+
+def test_create_batch_copies_values():
+    _row = np.array([1.0, 2.0, 3.0])
+    _batch = create_batch([SensorReading(timestamp, _tag, None)
+                           for _tag in tags], timestamp + step, _row)
+    _next = create_batch(_batch, timestamp + step * 2, _row)
+    _row[:] = 0
+    assert get_fields(_batch) == [(timestamp + step, "a", 1.0),
+                                  (timestamp + step, "b", 2.0),
+                                  (timestamp + step, "c", 3.0)]
+    assert _next.equipment_tags is _batch.equipment_tags
+    assert _next.values.tolist() == [1.0, 2.0, 3.0]
+
+
+def test_columnar_batch_matches_records():
+    # the columnar buffer reads batches from their arrays, the partition is
+    # the same as from the SensorReadings they stand for
+    _tables = []
+    for _as_list in (False, True):
+        buffer = ColumnarBuffer("hourly", "parquet")
+        for _minute in range(3):
+            _batch = get_batch(timestamp + step * _minute,
+                               [_minute, _minute + 0.25, float("nan")])
+            buffer.add(_batch.timestamp,
+                       list(_batch) if _as_list else _batch)
+        _tables.append(buffer.take()[2])
+    assert to_bytes(_tables[0], "parquet") == to_bytes(_tables[1], "parquet")
@@ -0,0 +1,56 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from GenerateTimeSeriesData.readings import SensorReading
+from GenerateTimeSeriesData.registry import (check_minute_intervals,
+                                             get_registry, join_registry)
+from GenerateTimeSeriesData.signals import models
+
+last_timestamp = datetime(2020, 10, 13, 2, 1)
+
+
+def test_registry_is_indexed_by_tag_id(registry_path):
+    registry = get_registry()
+    assert registry.tags == models
+    assert registry.get_ids(["ar1", "uniform"]).tolist() == [3, 0]
+    assert "daily" in registry and "pump" not in registry
+    assert get_registry() is registry
+
+
+def test_join_registry_adds_new_and_drops_removed_tags(registry_path):
+    _last_records = [
+        SensorReading(last_timestamp, "ar1", 4.2),
+        SensorReading(last_timestamp, "retired", 1.0)
+    ]
+    _joined = join_registry(last_timestamp, _last_records)
+    # known tags keep their state, new ones follow in config order
+    assert [(_record.equipment_tag, _record.value) for _record in _joined] == [
+        ("ar1", 4.2), ("uniform", None), ("random_walk", None),
+        ("drift", None), ("daily", None)
+    ]
+    assert all(_record.timestamp == last_timestamp for _record in _joined)
+    assert [_record.equipment_tag for _record in join_registry(
+        last_timestamp, [])] == models
+
+
+def test_only_fanout_writes_other_intervals(registry_path):
+    check_minute_intervals(models)
+    registry_path.write_text(
+        json.dumps({
+            "tags": [{
+                "tag": "uniform",
+                "min": 0,
+                "max": 10
+            }, {
+                "tag": "fast",
+                "min": 0,
+                "max": 10,
+                "interval": 10
+            }]
+        }))
+    check_minute_intervals(["uniform"], get_registry(str(registry_path)))
+    with pytest.raises(ValueError, match="only GENERATOR_BACKEND=fanout"):
+        check_minute_intervals(["uniform", "fast"],
+                               get_registry(str(registry_path)))
@@ -0,0 +1,106 @@
+import json
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from GenerateTimeSeriesData import serializer
+from GenerateTimeSeriesData.readings import (ReadingBatch, ReadingWindow,
+                                             SensorReading)
+from GenerateTimeSeriesData.serializer import (decompress, encodings,
+                                               format_timestamp,
+                                               parse_last_records,
+                                               parse_records,
+                                               parse_timestamp,
+                                               serialize_last_records,
+                                               serialize_records)
+from GenerateTimeSeriesData.storage_layer import ComplexEncoder
+
+timestamp = datetime(2020, 10, 13, 2, 1)
+
+# zstandard is optional, as in the serializer
+available_encodings = [
+    pytest.param(_encoding,
+                 marks=pytest.mark.skipif(
+                     encodings[_encoding]["content_encoding"] == "zstd" and
+                     serializer.zstandard is None,
+                     reason="zstandard is not installed"))
+    for _encoding in sorted(encodings)
+]
+
+
+def get_batch(timestamp=timestamp):
+    return ReadingBatch(timestamp, ["turbine_pressure", "pump_ü", "x"],
+                        np.array([2, 0, 1]),
+                        np.array([12.34, -0.5, float("nan")]))
+
+
+def get_records():
+    return [
+        SensorReading(timestamp, "turbine_pressure", 12.34),
+        SensorReading(timestamp, "pump_ü", None),
+        SensorReading(timestamp, "x", 7),
+        SensorReading(timestamp, "y", float("nan")),
+        SensorReading(timestamp, "z", 1e-07)
+    ]
+
+
+def test_minute_file_golden():
+    assert serialize_records(get_batch()) == (
+        b'[{"timestamp": "2020-10-13T02:01:00Z", "equipment_tag": "x", '
+        b'"value": 12.34}, {"timestamp": "2020-10-13T02:01:00Z", '
+        b'"equipment_tag": "turbine_pressure", "value": -0.5}, '
+        b'{"timestamp": "2020-10-13T02:01:00Z", "equipment_tag": '
+        b'"pump_\\u00fc", "value": NaN}]')
+
+
+def test_json_matches_complex_encoder():
+    # the files written before the serializer came from json.dumps
+    _records = get_records()
+    assert serialize_records(_records) == json.dumps(
+        _records, cls=ComplexEncoder).encode("ascii")
+    assert serialize_last_records(timestamp, _records) == json.dumps(
+        {
+            "last_record_timestamp": timestamp,
+            "records": _records
+        },
+        cls=ComplexEncoder).encode("ascii")
+    assert serialize_records([]) == b"[]"
+
+
+@pytest.mark.parametrize("encoding", available_encodings)
+def test_batch_matches_records(encoding):
+    # a ReadingBatch is written like the SensorReadings it stands for
+    _batch = get_batch()
+    assert decompress(serialize_records(_batch, encoding)) == decompress(
+        serialize_records(list(_batch), encoding))
+    _window = ReadingWindow(
+        [_batch, get_batch(datetime(2020, 10, 13, 2, 1, 30))])
+    assert decompress(serialize_records(_window, encoding)) == decompress(
+        serialize_records(list(_window), encoding))
+
+
+@pytest.mark.parametrize("encoding", available_encodings)
+def test_records_round_trip(encoding):
+    _records = parse_records(serialize_records(get_records(), encoding))
+    assert [_record["equipment_tag"] for _record in _records
+            ] == [_record.equipment_tag for _record in get_records()]
+    assert [parse_timestamp(_record["timestamp"])
+            for _record in _records] == [timestamp] * 5
+    _last_records = parse_last_records(
+        serialize_last_records(timestamp, get_records(), encoding))
+    assert parse_timestamp(_last_records["last_record_timestamp"]) == \
+        timestamp
+    assert _last_records["records"][2]["value"] == 7
+
+
+def test_timestamps_keep_whole_minutes():
+    assert format_timestamp(timestamp) == "2020-10-13T02:01:00Z"
+    assert format_timestamp(datetime(2020, 10, 13, 2, 1, 5, 250000)) == \
+        "2020-10-13T02:01:05.250Z"
+    for _timestamp in [
+            timestamp,
+            datetime(2020, 10, 13, 2, 1, 5),
+            datetime(2020, 10, 13, 2, 1, 5, 250000)
+    ]:
+        assert parse_timestamp(format_timestamp(_timestamp)) == _timestamp
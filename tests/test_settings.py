@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+import GenerateTimeSeriesData
+
+utc_timestamp = datetime(2020, 10, 13, 2, 1)
+
+
+class BusinessLayer():
+    runs = []
+
+    @classmethod
+    def run(cls, *args, **kwargs):
+        cls.runs.append(kwargs)
+
+    @staticmethod
+    def get_sink_names():
+        return ["adls"]
+
+
+@pytest.fixture
+def run_kwargs(monkeypatch):
+    # what the timer trigger hands to the backend's run
+    BusinessLayer.runs = []
+    monkeypatch.setattr(GenerateTimeSeriesData, "get_business_layer",
+                        lambda: BusinessLayer)
+    monkeypatch.setenv("GENERATOR_TIME_BUDGET_SECONDS", "30")
+    for _name in ("GENERATOR_POOLED_CONNECTION", "GENERATOR_MAX_IN_FLIGHT",
+                  "GENERATOR_PIPELINED", "GENERATOR_QUEUE_DEPTH",
+                  "GENERATOR_OUTPUT_MODE", "GENERATOR_RECORD_ENCODING"):
+        monkeypatch.delenv(_name, raising=False)
+
+    def run_kwargs(backend):
+        monkeypatch.setenv("GENERATOR_BACKEND", backend)
+        GenerateTimeSeriesData.run_business_layer(utc_timestamp)
+        return BusinessLayer.runs[-1]
+
+    return run_kwargs
+
+
+def test_adls_defaults(run_kwargs):
+    assert run_kwargs("adls") == {
+        "enable_anomaly": False,
+        "pooled_connection": False,
+        "max_in_flight": 10,
+        "time_budget_seconds": 30.0,
+        "output_mode": "json",
+        "record_encoding": "json"
+    }
+
+
+def test_adls_settings(run_kwargs, monkeypatch):
+    monkeypatch.setenv("GENERATOR_POOLED_CONNECTION", "True")
+    monkeypatch.setenv("GENERATOR_MAX_IN_FLIGHT", "32")
+    _kwargs = run_kwargs("adls")
+    assert _kwargs["pooled_connection"] is True
+    assert _kwargs["max_in_flight"] == 32
+    assert run_kwargs("fanout")["max_in_flight"] == 32
+
+
+def test_stg_settings(run_kwargs, monkeypatch):
+    assert run_kwargs("stg") == {
+        "enable_anomaly": False,
+        "pipelined": False,
+        "queue_depth": 20,
+        "max_in_flight": 10,
+        "time_budget_seconds": 30.0,
+        "output_mode": "json",
+        "record_encoding": "json"
+    }
+    monkeypatch.setenv("GENERATOR_PIPELINED", "1")
+    monkeypatch.setenv("GENERATOR_QUEUE_DEPTH", "50")
+    monkeypatch.setenv("GENERATOR_OUTPUT_MODE", "hourly")
+    monkeypatch.setenv("GENERATOR_RECORD_ENCODING", "ndjson")
+    _kwargs = run_kwargs("stg")
+    assert (_kwargs["pipelined"], _kwargs["queue_depth"]) == (True, 50)
+    for _backend in ("stg", "adls", "fanout"):
+        _kwargs = run_kwargs(_backend)
+        assert (_kwargs["output_mode"],
+                _kwargs["record_encoding"]) == ("hourly", "ndjson")
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+from GenerateTimeSeriesData import business_layer_stg
+from GenerateTimeSeriesData.columnar import from_bytes
+from GenerateTimeSeriesData.readings import ReadingBatch
+from GenerateTimeSeriesData.serializer import (format_timestamp,
+                                               parse_last_records)
+from GenerateTimeSeriesData.throttle import RetryPolicy
+from stand_ins import ContainerStandIn
+
+
+@pytest.fixture
+def container(monkeypatch, registry_path):
+    container = ContainerStandIn()
+    monkeypatch.setattr(business_layer_stg.DataAccessLayer,
+                        "get_blob_service_client", lambda self: container)
+    return container
+
+
+def get_dal(output_mode="json"):
+    dal = business_layer_stg.DataAccessLayer(output_mode=output_mode)
+    dal.uploader.policy = RetryPolicy(sleep=lambda _delay: None)
+    return dal
+
+
+def get_watermark(container):
+    _data, _ = container.blobs["last-records.json"]
+    return parse_last_records(_data)["last_record_timestamp"]
+
+
+def test_watermark_is_created_then_updated(container):
+    dal = get_dal()
+    _timestamp, _records = dal.get_last_records()
+    dal.write_last_records(_timestamp, _records)
+    assert dal.last_records_etag == container.blobs["last-records.json"][1]
+    # a later run resumes from the watermark and its etag
+    dal = get_dal()
+    _resumed, _records = dal.get_last_records()
+    assert _resumed == _timestamp
+    dal.write_last_records(_timestamp + business_layer_stg.step, _records)
+    assert dal.last_records_etag == container.blobs["last-records.json"][1]
+
+
+def test_another_writer_is_not_overwritten(container):
+    dal = get_dal()
+    _timestamp, _records = dal.get_last_records()
+    dal.write_last_records(_timestamp, _records)
+    _other = b'{"last_record_timestamp": "2020-10-13T03:00:00Z", ' \
+        b'"records": []}'
+    container.put("last-records.json", _other)
+    # 412, the watermark changed since this run read it
+    with pytest.raises(ResourceModifiedError):
+        dal.write_last_records(_timestamp + business_layer_stg.step,
+                               _records)
+    assert container.blobs["last-records.json"][0] == _other
+    # 409, the watermark appeared since this run found none
+    dal.last_records_etag = None
+    with pytest.raises(ResourceExistsError):
+        dal.write_last_records(_timestamp + business_layer_stg.step,
+                               _records)
+    assert container.blobs["last-records.json"][0] == _other
+
+
+@pytest.mark.parametrize("created", [False, True])
+def test_retry_adopts_its_own_earlier_write(container, created):
+    dal = get_dal()
+    _timestamp, _records = dal.get_last_records()
+    if created:
+        dal.write_last_records(_timestamp, _records)
+    # the first attempt is stored but its response is lost, the retry
+    # finds the watermark changed by that attempt
+    container.lose_response.add("last-records.json")
+    _next = _timestamp + business_layer_stg.step
+    dal.write_last_records(_next, _records)
+    assert dal.last_records_etag == container.blobs["last-records.json"][1]
+    assert get_watermark(container) == format_timestamp(_next)
+    # the adopted etag is what the next write is conditional on
+    dal.write_last_records(_next + business_layer_stg.step, _records)
+    assert dal.last_records_etag == container.blobs["last-records.json"][1]
+
+
+def write_minutes(dal, first, minutes):
+    for _minute in range(minutes):
+        dal.write_records(
+            first + timedelta(minutes=_minute),
+            ReadingBatch(first + timedelta(minutes=_minute), ["a", "b"],
+                         np.arange(2), np.array([1.0, 2.0])))
+
+
+def get_rows(container):
+    return {
+        _name: from_bytes(_data, "parquet").num_rows
+        for _name, (_data, _) in container.blobs.items()
+        if _name.endswith(".parquet")
+    }
+
+
+def test_checkpoints_upload_each_minute_once(container):
+    dal = get_dal("hourly")
+    write_minutes(dal, datetime(2020, 10, 13, 2, 1), 30)
+    dal.flush_records()
+    write_minutes(dal, datetime(2020, 10, 13, 2, 31), 10)
+    dal.flush_records()
+    # the open hour is not uploaded again, its later minutes go to a part
+    assert get_rows(container) == {
+        "2020/10/13/2020-10-13-02.part-020100.parquet": 60,
+        "2020/10/13/2020-10-13-02.part-023100.parquet": 20
+    }
+    dal.flush_records()
+    assert len(get_rows(container)) == 2
+
+
+def test_finished_partitions_are_compacted(container):
+    # one minute per tick, each run ends with a checkpoint
+    for _minute in range(57, 62):
+        dal = get_dal("hourly")
+        write_minutes(dal, datetime(2020, 10, 13, 2, 0) +
+                      timedelta(minutes=_minute), 1)
+        dal.flush_records()
+    # the hour closed by its last minute was merged from its parts, the
+    # one still open keeps them
+    assert get_rows(container) == {
+        "2020/10/13/2020-10-13-02.parquet": 6,
+        "2020/10/13/2020-10-13-03.parquet": 2,
+        "2020/10/13/2020-10-13-03.part-030100.parquet": 2
+    }
+    dal = get_dal("hourly")
+    write_minutes(dal, datetime(2020, 10, 13, 3, 2), 59)
+    # a partition closed by the next one's first minute is compacted too
+    assert get_rows(container)["2020/10/13/2020-10-13-03.parquet"] == 120
+    assert len(get_rows(container)) == 2
@@ -0,0 +1,173 @@
+import threading
+import time
+
+import pytest
+from azure.core.exceptions import ResourceExistsError, ServiceRequestError
+
+from GenerateTimeSeriesData.telemetry import metrics
+from GenerateTimeSeriesData.throttle import (AdaptiveLimiter,
+                                             AdaptiveUploader, RetryPolicy)
+from stand_ins import ThrottlingStandIn, get_http_error
+
+
+def get_counters():
+    _counters = metrics.snapshot()["counters"]
+    return {
+        _name: _counters.get(_name, 0)
+        for _name in ("throttled", "retries", "upload_failures")
+    }
+
+
+def get_increase(counters_before):
+    return {
+        _name: _value - counters_before[_name]
+        for _name, _value in get_counters().items()
+    }
+
+
+class Failing():
+    def __init__(self, errors):
+        # raises errors in turn, then succeeds
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls = self.calls + 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return "done"
+
+
+def get_uploader(limiter=None, max_attempts=8, sleeps=None):
+    return AdaptiveUploader(
+        limiter or AdaptiveLimiter(4),
+        RetryPolicy(max_attempts=max_attempts,
+                    sleep=(sleeps.append if sleeps is not None else
+                           lambda _delay: None)))
+
+
+def test_limit_drops_to_capacity_under_throttling():
+    limiter = AdaptiveLimiter(16)
+    uploader = AdaptiveUploader(
+        limiter, RetryPolicy(max_attempts=100, base_delay=0.002,
+                             max_delay=0.02))
+    stand_in = ThrottlingStandIn(lambda: time.sleep(0.002), capacity=4)
+    _limits = []
+    _counters_before = get_counters()
+
+    def upload():
+        for _ in range(50):
+            uploader.call(stand_in)
+            _limits.append(limiter.limit)
+
+    threads = [threading.Thread(target=upload) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(_limits) == 800
+    # while all 16 writers are busy the limit hovers around the capacity
+    _busy = _limits[:600]
+    assert min(_busy) < 4
+    assert sum(_busy) / len(_busy) < 8
+    assert stand_in.throttled > 0
+    assert get_increase(_counters_before) == {
+        "throttled": stand_in.throttled,
+        "retries": stand_in.throttled,
+        "upload_failures": 0
+    }
+
+
+def test_limit_climbs_back_after_a_window_of_successes():
+    limiter = AdaptiveLimiter(8)
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    for _ in range(3):
+        limiter.on_success()
+    assert limiter.limit == 4
+    limiter.on_success()
+    assert limiter.limit == 5
+    for _ in range(5 + 6 + 7):
+        limiter.on_success()
+    assert limiter.limit == 8
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.limit == 8
+
+
+def test_uploads_in_flight_cut_the_limit_once():
+    limiter = AdaptiveLimiter(8)
+    for _ in range(3):
+        limiter.acquire()
+    limiter.on_throttle()
+    # the two others were already in flight when the limit was cut
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    for _ in range(3):
+        limiter.release()
+        limiter.on_success()
+    limiter.on_throttle()
+    assert limiter.limit == 2
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.limit == 1
+
+
+def test_throttled_and_failed_calls_are_retried_with_backoff():
+    _sleeps = []
+    upload = Failing([
+        get_http_error(503, "ServerBusy"),
+        get_http_error(500),
+        ServiceRequestError("connection reset")
+    ])
+    _counters_before = get_counters()
+    assert get_uploader(sleeps=_sleeps).call(upload) == "done"
+    assert upload.calls == 4
+    assert len(_sleeps) == 3
+    assert get_increase(_counters_before) == {
+        "throttled": 1,
+        "retries": 3,
+        "upload_failures": 0
+    }
+
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=30.0, jitter=lambda: 1.0)
+    assert [policy.get_delay(_attempt) for _attempt in range(8)
+            ] == [0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 30.0, 30.0]
+    policy = RetryPolicy(base_delay=0.5, jitter=lambda: 0.25)
+    assert policy.get_delay(2) == 0.5
+
+
+def test_non_retryable_error_is_raised_at_once():
+    _sleeps = []
+    upload = Failing(
+        [get_http_error(409, "BlobAlreadyExists", ResourceExistsError)])
+    _counters_before = get_counters()
+    with pytest.raises(ResourceExistsError):
+        get_uploader(sleeps=_sleeps).call(upload)
+    assert upload.calls == 1
+    assert _sleeps == []
+    assert get_increase(_counters_before) == {
+        "throttled": 0,
+        "retries": 0,
+        "upload_failures": 1
+    }
+
+
+def test_retries_give_up_after_max_attempts():
+    limiter = AdaptiveLimiter(4)
+    upload = Failing([get_http_error(503, "ServerBusy")] * 10)
+    _counters_before = get_counters()
+    with pytest.raises(Exception) as error:
+        get_uploader(limiter, max_attempts=3).call(upload)
+    assert error.value.status_code == 503
+    assert upload.calls == 3
+    assert get_increase(_counters_before) == {
+        "throttled": 2,
+        "retries": 2,
+        "upload_failures": 1
+    }
+    # every slot is given back
+    assert limiter.active == 0
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from GenerateTimeSeriesData.signals import models
+from GenerateTimeSeriesData.value_generator import (ValueGenerator,
+                                                    get_timestamps, step)
+
+last_timestamp = datetime(2020, 10, 13, 2, 1)
+
+
+def get_value_generator(tags, enable_anomaly=False, previous_values=None):
+    return ValueGenerator(tags,
+                          enable_anomaly,
+                          seed=0,
+                          previous_values=previous_values or [5.0] *
+                          len(tags),
+                          last_timestamps=[last_timestamp] * len(tags))
+
+
+def test_golden_values(registry_path):
+    # pins the counter RNG and the signal models, any change to either
+    # changes every file ever generated
+    np.testing.assert_array_equal(
+        get_value_generator(models).get_values(3),
+        [[6.36, 4.97, 5.0, 4.67, 5.22], [3.39, 4.95, 5.01, 4.7, 5.13],
+         [4.34, 5.17, 5.03, 4.86, 5.21]])
+
+
+@pytest.mark.parametrize("enable_anomaly", [False, True])
+@pytest.mark.parametrize("chunk_minutes", [1, 7, 60, 1000])
+def test_chunking_does_not_change_values(registry_path, enable_anomaly,
+                                         chunk_minutes):
+    _serial = get_value_generator(models, enable_anomaly).get_values(500)
+    _chunked = np.vstack(
+        list(
+            get_value_generator(models, enable_anomaly).iter_values(
+                500, chunk_minutes)))
+    np.testing.assert_array_equal(_chunked, _serial)
+
+
+@pytest.mark.parametrize("enable_anomaly", [False, True])
+def test_tag_order_does_not_change_values(registry_path, enable_anomaly):
+    _values = get_value_generator(models, enable_anomaly).get_values(100)
+    _order = [3, 0, 4, 2, 1]
+    _reordered = get_value_generator([models[_column] for _column in _order],
+                                     enable_anomaly).get_values(100)
+    np.testing.assert_array_equal(_reordered, _values[:, _order])
+    # a tag alone gets the series it has among the others
+    for _column, _model in enumerate(models):
+        _alone = get_value_generator([_model], enable_anomaly).get_values(100)
+        np.testing.assert_array_equal(_alone[:, 0], _values[:, _column])
+
+
+@pytest.mark.parametrize("enable_anomaly", [False, True])
+def test_resumed_run_equals_continuous_run(registry_path, enable_anomaly):
+    _values = get_value_generator(models, enable_anomaly).get_values(200)
+    # a run resumes from the timestamp and values of last-records.json
+    _resumed = ValueGenerator(
+        models,
+        enable_anomaly,
+        seed=0,
+        previous_values=_values[119].tolist(),
+        last_timestamps=[last_timestamp + step * 120] * len(models))
+    np.testing.assert_array_equal(_resumed.get_values(80), _values[120:])
+
+
+def test_get_timestamps_steps_from_the_last_timestamp():
+    _timestamps = get_timestamps(last_timestamp, 3, 4)
+    assert _timestamps == [
+        last_timestamp + timedelta(minutes=_minute) for _minute in range(3, 7)
+    ]
+    _timestamps = get_timestamps(last_timestamp, 1, 2,
+                                 timedelta(milliseconds=100))
+    assert _timestamps == [
+        datetime(2020, 10, 13, 2, 1, 0, 100000),
+        datetime(2020, 10, 13, 2, 1, 0, 200000)
+    ]